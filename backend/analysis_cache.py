@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+
+from backend.metrics import metrics
+
+logger = logging.getLogger("reimagine")
+
+
+def analysis_cache_key(image_digest: str, prompt_text: str, model: str) -> str:
+    prompt_digest = hashlib.sha256((prompt_text or "").encode("utf-8")).hexdigest()
+    return f"{model}:{image_digest}:{prompt_digest}"
+
+
+class AnalysisCache:
+    """SQLite-backed cache of parsed qwen3-vl analysis JSON.
+
+    Keys are ``model:image_sha256:prompt_sha256`` (see ``analysis_cache_key``).
+    Entries expire after ``ttl_seconds``; when the stored payload exceeds
+    ``max_bytes`` the least recently used entries are evicted. Hits and misses
+    are counted in ``backend.metrics`` as ``analysis_cache.hit`` / ``.miss``.
+    """
+
+    def __init__(self, db_path: Path, ttl_seconds: float = 7 * 24 * 3600, max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.db_path = Path(db_path)
+        self.ttl_seconds = float(ttl_seconds)
+        self.max_bytes = int(max_bytes)
+        self._ready = False
+
+    def _open(self) -> sqlite3.Connection:
+        if not self._ready:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=5)
+        if not self._ready:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS analysis_cache (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    result_json TEXT NOT NULL,
+                    size_bytes INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_hit_at REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_cache_lru ON analysis_cache(last_hit_at)")
+            conn.commit()
+            self._ready = True
+        return conn
+
+    @contextlib.contextmanager
+    def _conn(self) -> Iterator[sqlite3.Connection]:
+        # one short-lived connection per call: commit (or roll back) the transaction, then close it
+        with contextlib.closing(self._open()) as conn, conn:
+            yield conn
+
+    def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        try:
+            with self._conn() as conn:
+                row = conn.execute("SELECT result_json, created_at FROM analysis_cache WHERE key = ?", (key,)).fetchone()
+                if row is not None and now - row[1] > self.ttl_seconds:
+                    conn.execute("DELETE FROM analysis_cache WHERE key = ?", (key,))
+                    metrics.incr("analysis_cache.expired")
+                    row = None
+                if row is None:
+                    metrics.incr("analysis_cache.miss")
+                    return None
+                conn.execute("UPDATE analysis_cache SET hits = hits + 1, last_hit_at = ? WHERE key = ?", (now, key))
+            value = json.loads(row[0])
+        except Exception as exc:
+            logger.warning("analysis cache read failed: %s", exc)
+            metrics.incr("analysis_cache.miss")
+            return None
+        metrics.incr("analysis_cache.hit")
+        return value
+
+    def put(self, key: str, model: str, result: dict) -> None:
+        if not isinstance(result, dict) or not result:
+            return
+        now = time.time()
+        try:
+            raw = json.dumps(result, ensure_ascii=False)
+            with self._conn() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO analysis_cache (key, model, result_json, size_bytes, created_at, last_hit_at, hits) VALUES (?, ?, ?, ?, ?, ?, 0)",
+                    (key, model, raw, len(raw.encode("utf-8")), now, now),
+                )
+                self._evict(conn, now)
+            metrics.incr("analysis_cache.store")
+        except Exception as exc:
+            logger.warning("analysis cache write failed: %s", exc)
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        cur = conn.execute("DELETE FROM analysis_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        evicted = cur.rowcount or 0
+        total = conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM analysis_cache").fetchone()[0]
+        if total > self.max_bytes:
+            for key, size in conn.execute("SELECT key, size_bytes FROM analysis_cache ORDER BY last_hit_at ASC").fetchall():
+                if total <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM analysis_cache WHERE key = ?", (key,))
+                total -= size
+                evicted += 1
+        if evicted:
+            metrics.incr("analysis_cache.evicted", evicted)
+
+    def clear(self) -> None:
+        with self._conn() as conn:
+            conn.execute("DELETE FROM analysis_cache")
+
+    def stats(self) -> dict:
+        try:
+            with self._conn() as conn:
+                entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM analysis_cache").fetchone()
+        except Exception:
+            entries, size = None, None
+        return {
+            "entries": entries,
+            "size_bytes": size,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": int(metrics.get("analysis_cache.hit")),
+            "misses": int(metrics.get("analysis_cache.miss")),
+        }
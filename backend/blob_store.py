@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import re
+import stat
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+from uuid import uuid4
+
+import anyio
+from starlette.datastructures import Headers, QueryParams
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+logger = logging.getLogger("reimagine")
+
+_BLOB_NAME_RE = re.compile(r"^([0-9a-f]{64})(\.[A-Za-z0-9]{1,8})?$")
+_EXT_ALIASES = {".jpeg": ".jpg", ".tif": ".tiff"}
+
+# served names are content hashes (blobs) or unique uuid names (legacy), never rewritten
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def normalize_ext(filename_or_ext: Optional[str], default: str = ".png") -> str:
+    s = (filename_or_ext or "").strip()
+    ext = s if s.startswith(".") and "/" not in s else Path(s).suffix
+    ext = (ext or default).lower()
+    if not re.fullmatch(r"\.[a-z0-9]{1,8}", ext):
+        ext = default
+    return _EXT_ALIASES.get(ext, ext)
+
+
+class BlobStore:
+    """Content-addressed file store: ``root/ab/cd/<sha256><ext>``.
+
+    Every unique payload is written exactly once (atomically, via a temp file and
+    ``os.replace``); saving the same bytes again returns the existing path even if
+    the upload carried a different file name. The two-level shard keeps each
+    directory small no matter how many images accumulate. Reference counts live
+    in the application database, not here.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def digest(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def shard_dir(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest[2:4]
+
+    def find(self, digest: str) -> Optional[Path]:
+        d = self.shard_dir(digest)
+        try:
+            with os.scandir(d) as it:
+                for entry in it:
+                    if entry.name.startswith(digest) and _BLOB_NAME_RE.match(entry.name):
+                        return Path(entry.path)
+        except FileNotFoundError:
+            return None
+        return None
+
+    def put(self, data: bytes, ext: str = ".png") -> tuple[str, Path, bool]:
+        """Store ``data``; returns ``(digest, path, created)``."""
+        digest = self.digest(data)
+        existing = self.find(digest)
+        if existing is not None:
+            return digest, existing, False
+        d = self.shard_dir(digest)
+        d.mkdir(parents=True, exist_ok=True)
+        dest = d / f"{digest}{normalize_ext(ext)}"
+        tmp = d / f".tmp-{uuid4().hex}"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, dest)
+        return digest, dest, True
+
+    def parse_name(self, name: str) -> Optional[str]:
+        m = _BLOB_NAME_RE.match(Path(name or "").name)
+        return m.group(1) if m else None
+
+    def resolve(self, name: str) -> Optional[Path]:
+        """Map a served name (``<sha256><ext>``) back to its sharded path."""
+        digest = self.parse_name(name)
+        if not digest:
+            return None
+        p = self.shard_dir(digest) / Path(name).name
+        if p.is_file():
+            return p
+        return self.find(digest)
+
+    def owns(self, path: str | Path) -> Optional[str]:
+        """Return the digest if ``path`` points inside this store."""
+        try:
+            p = Path(path).resolve()
+            p.relative_to(self.root.resolve())
+        except Exception:
+            return None
+        return self.parse_name(p.name)
+
+    def delete(self, digest: str) -> bool:
+        p = self.find(digest)
+        if p is None:
+            return False
+        try:
+            p.unlink()
+            return True
+        except FileNotFoundError:
+            return False
+
+
+class BlobStaticFiles(StaticFiles):
+    """StaticFiles that serves ``/<sha256><ext>`` from the blob store and falls
+    back to the legacy flat images directory for everything else.
+
+    Responses carry an immutable ``Cache-Control`` and, for blobs, the content
+    digest as a strong ETag. ``FileResponse`` already handles ``Range`` and
+    uses ``http.response.pathsend`` (sendfile) when the server supports it.
+    With ``accel_redirect=(prefix, root)`` the body is left to nginx: the
+    response only carries ``X-Accel-Redirect: <prefix>/<path relative to root>``.
+
+    Requests with any of ``VARIANT_PARAMS`` in the query string are handed to
+    ``variants(full_path, stat_result, scope)`` instead (resized / re-encoded
+    copies, see ``server._static_variant``).
+    """
+
+    VARIANT_PARAMS = ("w", "h", "fmt")
+
+    def __init__(
+        self,
+        *,
+        store: BlobStore,
+        accel_redirect: Optional[tuple[str, Path]] = None,
+        variants: Optional[Callable[[str, os.stat_result, Scope], Awaitable[Response]]] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(**kwargs)
+        self.store = store
+        self.accel_redirect = (accel_redirect[0].rstrip("/"), Path(accel_redirect[1]).resolve()) if accel_redirect else None
+        self.variants = variants
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        if self.variants is not None and scope["method"] in ("GET", "HEAD"):
+            query = QueryParams(scope.get("query_string", b""))
+            if any(query.get(k) for k in self.VARIANT_PARAMS):
+                try:
+                    full_path, stat_result = await anyio.to_thread.run_sync(self.lookup_path, path)
+                except (OSError, ValueError):
+                    stat_result = None
+                if stat_result is not None and stat.S_ISREG(stat_result.st_mode):
+                    return await self.variants(full_path, stat_result, scope)
+        return await super().get_response(path, scope)
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        if status_code != 200:
+            return super().file_response(full_path, stat_result, scope, status_code)
+        headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL}
+        digest = self.store.parse_name(Path(full_path).name)
+        if digest:
+            headers["ETag"] = f'"{digest}"'
+        response = FileResponse(full_path, headers=headers, stat_result=stat_result)
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        if self.accel_redirect is not None:
+            prefix, root = self.accel_redirect
+            try:
+                rel = Path(full_path).resolve().relative_to(root).as_posix()
+            except ValueError:
+                return response
+            accel = {k: v for k, v in response.headers.items() if k in ("cache-control", "etag", "last-modified", "accept-ranges")}
+            accel["X-Accel-Redirect"] = f"{prefix}/{rel}"
+            return Response(headers=accel, media_type=response.media_type)
+        return response
+
+    def lookup_path(self, path: str) -> tuple[str, os.stat_result | None]:
+        if self.store.parse_name(path) and "/" not in path and "\\" not in path:
+            p = self.store.resolve(path)
+            if p is not None:
+                try:
+                    return str(p), os.stat(p)
+                except FileNotFoundError:
+                    pass
+        return super().lookup_path(path)
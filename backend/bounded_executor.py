@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import logging
+import math
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+from backend.metrics import metrics
+
+logger = logging.getLogger("reimagine")
+
+T = TypeVar("T")
+
+
+class Saturated(RuntimeError):
+    """Raised by ``BoundedExecutor.submit`` when every worker is busy and the queue is full."""
+
+    def __init__(self, name: str, retry_after: int) -> None:
+        super().__init__(f"{name} executor saturated")
+        self.retry_after = retry_after
+
+
+class BoundedExecutor:
+    """Named thread pool with admission control for long-running background jobs.
+
+    At most ``workers`` jobs run at once and at most ``max_queue`` more wait
+    for a worker; beyond that ``submit`` raises ``Saturated`` immediately
+    instead of queueing, carrying a ``retry_after`` hint (seconds) derived
+    from the average job duration. Jobs are fire-and-forget: failures are
+    logged, and results stay available on the returned future.
+
+    ``reserve()`` performs the same admission without a job yet, so a caller
+    can reject a request before it has side effects; the returned
+    ``Reservation`` is later ``submit``-ted or ``release``-d.
+
+    Records ``executor.<name>.submitted``, ``.rejected``, ``.errors``,
+    ``.seconds`` and ``.queue_seconds``.
+    """
+
+    def __init__(self, name: str, workers: int, max_queue: int = 0, default_retry_after: int = 5) -> None:
+        self.name = name
+        self.workers = max(1, int(workers))
+        self.max_queue = max(0, int(max_queue))
+        self.default_retry_after = max(1, int(default_retry_after))
+        self._lock = threading.Lock()
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._inflight = 0
+        self._avg_seconds: Optional[float] = None
+
+    def _executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+            return self._pool
+
+    def saturated(self) -> bool:
+        with self._lock:
+            return self._inflight >= self.workers + self.max_queue
+
+    def reserve(self) -> "Reservation":
+        with self._lock:
+            if self._inflight >= self.workers + self.max_queue:
+                retry_after = self._retry_after_locked()
+                metrics.incr(f"executor.{self.name}.rejected")
+                raise Saturated(self.name, retry_after)
+            self._inflight += 1
+        return Reservation(self)
+
+    def submit(self, fn: Callable[..., T], *args, **kwargs) -> "Future[T]":
+        return self.reserve().submit(fn, *args, **kwargs)
+
+    def _unreserve(self) -> None:
+        with self._lock:
+            self._inflight -= 1
+
+    def _submit_reserved(self, fn: Callable[..., T], *args, **kwargs) -> "Future[T]":
+        submitted = time.perf_counter()
+
+        def _run():
+            started = time.perf_counter()
+            metrics.incr(f"executor.{self.name}.queue_seconds", started - submitted)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._finished(time.perf_counter() - started)
+
+        try:
+            fut = self._executor().submit(_run)
+        except RuntimeError:
+            self._unreserve()
+            raise
+        metrics.incr(f"executor.{self.name}.submitted")
+        fut.add_done_callback(self._log_failure)
+        return fut
+
+    def _finished(self, seconds: float) -> None:
+        metrics.incr(f"executor.{self.name}.seconds", seconds)
+        with self._lock:
+            self._inflight -= 1
+            # EWMA of job duration, for the Retry-After hint
+            self._avg_seconds = seconds if self._avg_seconds is None else 0.8 * self._avg_seconds + 0.2 * seconds
+
+    def _log_failure(self, fut: Future) -> None:
+        if fut.cancelled():
+            with self._lock:
+                self._inflight -= 1
+            return
+        exc = fut.exception()
+        if exc is not None:
+            logger.warning("%s job failed: %s", self.name, exc)
+            metrics.incr(f"executor.{self.name}.errors")
+
+    def _retry_after_locked(self) -> int:
+        if self._avg_seconds is None:
+            return self.default_retry_after
+        # time until a queue slot frees up if jobs finish at the average rate
+        waiting = max(1, self._inflight - self.workers + 1)
+        return max(1, min(120, math.ceil(self._avg_seconds * waiting / self.workers)))
+
+    def retry_after(self) -> int:
+        with self._lock:
+            return self._retry_after_locked()
+
+    def stats(self) -> dict:
+        with self._lock:
+            inflight = self._inflight
+            avg = self._avg_seconds
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "running": min(inflight, self.workers),
+            "queued": max(0, inflight - self.workers),
+            "avg_seconds": round(avg, 3) if avg is not None else None,
+            "rejected": int(metrics.get(f"executor.{self.name}.rejected")),
+        }
+
+    def shutdown(self) -> None:
+        # the pool is recreated lazily if work arrives after shutdown
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+class Reservation:
+    """An admitted slot on a ``BoundedExecutor``; exactly one of ``submit`` / ``release`` takes effect."""
+
+    def __init__(self, executor: BoundedExecutor) -> None:
+        self._executor = executor
+        self._done = False
+
+    def submit(self, fn: Callable[..., T], *args, **kwargs) -> "Future[T]":
+        if self._done:
+            raise RuntimeError("reservation already used")
+        self._done = True
+        return self._executor._submit_reserved(fn, *args, **kwargs)
+
+    def release(self) -> None:
+        if not self._done:
+            self._done = True
+            self._executor._unreserve()
@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, Optional, TypeVar
+
+from backend.metrics import metrics
+
+logger = logging.getLogger("reimagine")
+
+T = TypeVar("T")
+
+
+def _timed(fn: Callable[..., T], args: tuple, kwargs: dict):
+    # runs on the worker (thread or process); wall clock so the parent can
+    # compare it with its own submit time
+    started = time.time()
+    result = fn(*args, **kwargs)
+    return result, started, time.time()
+
+
+def _metric_deltas(before: Dict[str, float]) -> Dict[str, float]:
+    return {k: v - before.get(k, 0) for k, v in metrics.counters().items() if v != before.get(k, 0)}
+
+
+def _timed_process(fn: Callable[..., T], args: tuple, kwargs: dict):
+    # a worker process has its own ``metrics``: ship what the task recorded
+    # (decode.<fmt>.* and the like) back so the parent can merge it. Each
+    # worker runs one task at a time, so the delta is this task's alone.
+    before = metrics.counters()
+    try:
+        result, started, finished = _timed(fn, args, kwargs)
+    except BaseException as exc:
+        exc._metric_deltas = _metric_deltas(before)
+        raise
+    return result, started, finished, _metric_deltas(before)
+
+
+class CPUPool:
+    """Worker pools for CPU-bound image work (decode, resample, encode).
+
+    ``run(fn, ...)`` executes on a thread pool by default: Pillow releases the
+    GIL inside its codecs and resamplers, so JPEG/PNG/WebP work scales across
+    cores without a process hop. ``run(fn, ..., process=True)`` uses a
+    spawn-based process pool for decoders that hold the GIL or need a lot of
+    memory (RAW demosaic, HEIF); ``fn`` and its arguments must be picklable,
+    so pass encoded bytes in and out rather than PIL images. Counters the
+    task records in the worker process are merged into the parent's
+    ``metrics``. With ``processes=0`` everything runs on threads.
+
+    Per task name (``fn.__name__``) it records ``cpu_pool.<name>.count``,
+    ``.seconds`` (time on the worker), ``.queue_seconds`` (submit to start)
+    and ``.errors``.
+    """
+
+    def __init__(self, threads: Optional[int] = None, processes: int = 0) -> None:
+        self.threads = max(1, int(threads or os.cpu_count() or 1))
+        self.processes = max(0, int(processes or 0))
+        self._lock = threading.Lock()
+        self._pools: Dict[str, Executor] = {}
+        self._inflight = {"thread": 0, "process": 0}
+
+    def _executor(self, kind: str) -> Executor:
+        pool = self._pools.get(kind)
+        if pool is not None:
+            return pool
+        with self._lock:
+            pool = self._pools.get(kind)
+            if pool is None:
+                if kind == "process":
+                    pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"))
+                else:
+                    pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="cpu")
+                self._pools[kind] = pool
+        return pool
+
+    async def run(self, fn: Callable[..., T], *args, process: bool = False, **kwargs) -> T:
+        kind = "process" if process and self.processes else "thread"
+        name = getattr(fn, "__name__", "task")
+        submitted = time.time()
+        with self._lock:
+            self._inflight[kind] += 1
+        try:
+            if kind == "process":
+                fut = self._executor(kind).submit(_timed_process, fn, args, kwargs)
+                result, started, finished, deltas = await asyncio.wrap_future(fut)
+                metrics.merge(deltas)
+            else:
+                fut = self._executor(kind).submit(_timed, fn, args, kwargs)
+                result, started, finished = await asyncio.wrap_future(fut)
+        except BaseException as exc:
+            metrics.merge(getattr(exc, "_metric_deltas", None) or {})
+            metrics.incr(f"cpu_pool.{name}.errors")
+            raise
+        finally:
+            with self._lock:
+                self._inflight[kind] -= 1
+        metrics.incr(f"cpu_pool.{name}.count")
+        metrics.incr(f"cpu_pool.{name}.seconds", finished - started)
+        metrics.incr(f"cpu_pool.{name}.queue_seconds", max(0.0, started - submitted))
+        return result
+
+    def submit(self, fn: Callable[..., T], *args, **kwargs) -> "Future[T]":
+        """Fire-and-forget variant of ``run`` (thread pool) for background work started from sync code."""
+        name = getattr(fn, "__name__", "task")
+        submitted = time.time()
+        with self._lock:
+            self._inflight["thread"] += 1
+        fut = self._executor("thread").submit(_timed, fn, args, kwargs)
+
+        def _done(f: "Future") -> None:
+            with self._lock:
+                self._inflight["thread"] -= 1
+            if f.cancelled():
+                return
+            exc = f.exception()
+            if exc is not None:
+                logger.warning("background task %s failed: %s", name, exc)
+                metrics.incr(f"cpu_pool.{name}.errors")
+                return
+            _result, started, finished = f.result()
+            metrics.incr(f"cpu_pool.{name}.count")
+            metrics.incr(f"cpu_pool.{name}.seconds", finished - started)
+            metrics.incr(f"cpu_pool.{name}.queue_seconds", max(0.0, started - submitted))
+
+        fut.add_done_callback(_done)
+        return fut
+
+    def stats(self) -> dict:
+        with self._lock:
+            inflight = dict(self._inflight)
+        return {
+            "threads": self.threads,
+            "processes": self.processes,
+            "inflight": inflight,
+            # tasks waiting for a free worker
+            "queued": {
+                "thread": max(0, inflight["thread"] - self.threads),
+                "process": max(0, inflight["process"] - self.processes),
+            },
+        }
+
+    def close(self) -> None:
+        # pools are recreated lazily if work arrives after close
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Callable, Optional, TypeVar
+
+from backend.metrics import metrics
+
+logger = logging.getLogger("reimagine")
+
+T = TypeVar("T")
+
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -20000,  # KiB, i.e. ~20 MB page cache per connection
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+    "foreign_keys": "ON",
+}
+
+_STOP = object()
+
+
+class Database:
+    """SQLite access layer: per-thread readers plus one batched writer thread.
+
+    Reads go through ``reader()``, a connection cached per thread; in WAL mode
+    they never block on the writer. All writes are functions submitted to
+    ``write(fn, ...)``: a single writer thread drains whatever jobs are queued,
+    runs them inside one ``BEGIN IMMEDIATE`` transaction (each job in its own
+    savepoint, so one failing job does not roll back the others) and commits
+    once. The caller blocks until its batch is committed and gets ``fn``'s
+    return value, so read-after-write from the same request stays consistent.
+
+    ``close()`` stops the writer; like the executors, a later write starts a
+    new one, so the app can go through its lifespan more than once.
+    """
+
+    def __init__(self, path: Path, pragmas: Optional[dict] = None, max_batch: int = 128, batch_wait: float = 0.0) -> None:
+        self.path = Path(path)
+        self.pragmas = dict(DEFAULT_PRAGMAS, **(pragmas or {}))
+        self.max_batch = max(1, int(max_batch))
+        self.batch_wait = max(0.0, float(batch_wait))
+        self._local = threading.local()
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._writer_lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=self.pragmas.get("busy_timeout", 5000) / 1000, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            try:
+                conn.execute(f"PRAGMA {name}={value}")
+            except sqlite3.DatabaseError as exc:
+                logger.warning("sqlite pragma %s=%s failed: %s", name, value, exc)
+        return conn
+
+    def reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self.connect()
+            self._local.conn = conn
+        return conn
+
+    def write(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        return self.submit(fn, *args, **kwargs).result()
+
+    def submit(self, fn: Callable[..., T], *args, **kwargs) -> "Future[T]":
+        self._ensure_writer()
+        fut: "Future[T]" = Future()
+        self._queue.put((fn, args, kwargs, fut))
+        return fut
+
+    def execute(self, sql: str, params: tuple = ()) -> int:
+        """Run one write statement through the writer; returns ``rowcount``."""
+        return self.write(lambda conn: conn.execute(sql, params).rowcount)
+
+    def _ensure_writer(self) -> None:
+        if self._writer is not None and self._writer.is_alive():
+            return
+        with self._writer_lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._run_writer, name="sqlite-writer", daemon=True)
+                self._writer.start()
+
+    def _run_writer(self) -> None:
+        conn = self.connect()
+        try:
+            while True:
+                job = self._queue.get()
+                if job is _STOP:
+                    return
+                batch = [job]
+                if self.batch_wait:
+                    time.sleep(self.batch_wait)
+                stop = False
+                while len(batch) < self.max_batch:
+                    try:
+                        nxt = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if nxt is _STOP:
+                        stop = True
+                        break
+                    batch.append(nxt)
+                self._commit_batch(conn, batch)
+                if stop:
+                    return
+        finally:
+            conn.close()
+
+    def _commit_batch(self, conn: sqlite3.Connection, batch: list) -> None:
+        results: list = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, args, kwargs, fut in batch:
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT job")
+                try:
+                    value = fn(conn, *args, **kwargs)
+                except BaseException as exc:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((fut, None, exc))
+                else:
+                    conn.execute("RELEASE job")
+                    results.append((fut, value, None))
+            conn.execute("COMMIT")
+        except BaseException as exc:
+            logger.warning("sqlite batch of %d failed: %s", len(batch), exc)
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            for _fn, _args, _kwargs, fut in batch:
+                if not fut.done():
+                    if not fut.running():
+                        fut.set_running_or_notify_cancel()
+                    fut.set_exception(exc)
+            return
+        metrics.incr("db.write_batches")
+        metrics.incr("db.write_jobs", len(results))
+        for fut, value, exc in results:
+            if exc is not None:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(value)
+
+    def close(self) -> None:
+        with self._writer_lock:
+            writer, self._writer = self._writer, None
+            if writer is not None and writer.is_alive():
+                self._queue.put(_STOP)
+                writer.join(timeout=5)
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
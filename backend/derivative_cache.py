@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Optional
+from uuid import uuid4
+
+from backend.metrics import metrics
+
+logger = logging.getLogger("reimagine")
+
+
+def derivative_key(source_digest: str, op: str, params: dict) -> str:
+    raw = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(f"{op}\n{source_digest}\n{raw}".encode("utf-8")).hexdigest()
+
+
+class DerivativeCache:
+    """Disk cache of encoded derivatives (previews, conversions) keyed by
+    ``derivative_key(source sha256, op, normalized params)``.
+
+    Files live at ``root/<key[:2]>/<key><ext>``; a hit refreshes the file's
+    mtime, and once the total exceeds ``max_bytes`` the least recently used
+    files are removed. The key doubles as a strong ETag, since identical keys
+    always produce identical bytes.
+    """
+
+    def __init__(self, root: Path, max_bytes: int = 512 * 1024 * 1024) -> None:
+        self.root = Path(root)
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self._total: Optional[int] = None
+
+    def path_for(self, key: str, ext: str) -> Path:
+        return self.root / key[:2] / f"{key}{ext}"
+
+    def get(self, key: str, ext: str) -> Optional[Path]:
+        path = self.path_for(key, ext)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            metrics.incr("derivative_cache.miss")
+            return None
+        except OSError as exc:
+            logger.warning("derivative cache touch failed %s: %s", path, exc)
+        metrics.incr("derivative_cache.hit")
+        return path
+
+    def put(self, key: str, ext: str, data: bytes) -> Optional[Path]:
+        path = self.path_for(key, ext)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f".tmp-{uuid4().hex}")
+            tmp.write_bytes(data)
+            with self._lock:
+                try:
+                    replaced = path.stat().st_size
+                except FileNotFoundError:
+                    replaced = 0
+                os.replace(tmp, path)
+        except OSError as exc:
+            logger.warning("derivative cache write failed %s: %s", path, exc)
+            return None
+        metrics.incr("derivative_cache.store")
+        with self._lock:
+            if self._total is None:
+                self._total = self._scan_total()
+            else:
+                # 覆盖已有的 key 时只计增量，否则预算会越算越大
+                self._total += len(data) - replaced
+            if self._total > self.max_bytes:
+                self._evict(keep=path)
+        return path
+
+    def _files(self):
+        if not self.root.exists():
+            return []
+        return [p for p in self.root.glob("*/*") if p.is_file() and not p.name.startswith(".tmp-")]
+
+    def _scan_total(self) -> int:
+        total = 0
+        for p in self._files():
+            try:
+                total += p.stat().st_size
+            except OSError:
+                pass
+        return total
+
+    def _evict(self, keep: Path) -> None:
+        entries = []
+        for p in self._files():
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+        entries.sort()
+        total = sum(size for _mtime, size, _p in entries)
+        evicted = 0
+        for _mtime, size, p in entries:
+            if total <= self.max_bytes:
+                break
+            if p == keep:
+                continue
+            try:
+                p.unlink()
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        self._total = total
+        if evicted:
+            metrics.incr("derivative_cache.evicted", evicted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            if self._total is None:
+                self._total = self._scan_total()
+            total = self._total
+        return {
+            "size_bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": int(metrics.get("derivative_cache.hit")),
+            "misses": int(metrics.get("derivative_cache.miss")),
+        }
@@ -0,0 +1,279 @@
+from __future__ import annotations
+
+import contextlib
+import importlib.util
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Iterator, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from backend.resilience import Resilience, remaining_budget
+
+logger = logging.getLogger("reimagine")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, "") or default)
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, "") or default)
+    except ValueError:
+        return default
+
+
+def _origin(url: str) -> str:
+    parts = urlsplit(url)
+    if parts.scheme not in {"http", "https"} or not parts.netloc:
+        raise ValueError(f"not an absolute http(s) url: {url!r}")
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+
+class UpstreamHTTPPool:
+    """One keep-alive, connection-pooled httpx client per upstream origin.
+
+    Clients are created lazily on first use (so scripts and tests work without a
+    lifespan) and shared by every request, SSE worker and OpenAI SDK client that
+    talks to the same host. HTTP/2 is negotiated when the ``h2`` package is
+    installed and ``UPSTREAM_HTTP2`` is not disabled.
+
+    Provider origins are ``pin``-ned (as is every origin handed to
+    ``openai_client``). Other origins -- ``/proxy_image`` and result
+    downloads reach arbitrary hosts -- are capped at ``max_origins`` and
+    evicted least recently used; an evicted client is closed once its
+    in-flight requests have finished, or at ``close()``.
+
+    Requests made with ``endpoint=<name>`` go through ``resilience``: the
+    breaker for that name may reject them up front, the timeout passed in
+    becomes a ceiling for the latency-derived one, and transport errors,
+    429s and 5xx count as failures. For ``stream`` the derived timeout only
+    covers connect/write/pool; reads between body chunks keep the ceiling,
+    since a slow stream is not a slow response.
+    """
+
+    def __init__(self, resilience: Optional[Resilience] = None) -> None:
+        self.resilience = resilience
+        self._lock = threading.Lock()
+        self._clients: "OrderedDict[str, httpx.Client]" = OrderedDict()
+        self._pinned: set[str] = set()
+        self._inflight: dict[httpx.Client, int] = {}
+        self._retired: set[httpx.Client] = set()
+        self._openai_clients: dict[tuple[str, str], object] = {}
+        self.max_connections = max(1, _env_int("UPSTREAM_POOL_MAX_CONNECTIONS", 100))
+        self.max_keepalive = max(1, _env_int("UPSTREAM_POOL_MAX_KEEPALIVE", 20))
+        self.keepalive_expiry = max(1.0, _env_float("UPSTREAM_KEEPALIVE_EXPIRY", 120.0))
+        self.connect_timeout = max(1.0, _env_float("UPSTREAM_CONNECT_TIMEOUT", 10.0))
+        # /proxy_image can reach arbitrary hosts; cap how many origins keep a pool open
+        self.max_origins = max(1, _env_int("UPSTREAM_POOL_MAX_ORIGINS", 32))
+        want_http2 = (os.getenv("UPSTREAM_HTTP2", "1") or "1").strip().lower() not in {"0", "false", "no", "off"}
+        self.http2 = want_http2 and importlib.util.find_spec("h2") is not None
+
+    def pin(self, urls: Iterable[str]) -> None:
+        """Exempt the origins of ``urls`` from eviction."""
+        with self._lock:
+            for u in urls:
+                try:
+                    self._pinned.add(_origin(u))
+                except ValueError:
+                    continue
+
+    def _evict_locked(self) -> list[httpx.Client]:
+        closable = []
+        unpinned = [k for k in self._clients if k not in self._pinned]
+        while len(unpinned) >= self.max_origins:
+            old_key = unpinned.pop(0)
+            evicted = self._clients.pop(old_key)
+            if self._inflight.get(evicted):
+                self._retired.add(evicted)
+            else:
+                closable.append(evicted)
+        return closable
+
+    def client(self, url: str) -> httpx.Client:
+        key = _origin(url)
+        closable: list[httpx.Client] = []
+        with self._lock:
+            c = self._clients.get(key)
+            if c is None or c.is_closed:
+                closable = self._evict_locked()
+                c = httpx.Client(
+                    http2=self.http2,
+                    limits=httpx.Limits(
+                        max_connections=self.max_connections,
+                        max_keepalive_connections=self.max_keepalive,
+                        keepalive_expiry=self.keepalive_expiry,
+                    ),
+                    timeout=httpx.Timeout(120.0, connect=self.connect_timeout),
+                    follow_redirects=True,
+                )
+                self._clients[key] = c
+                logger.info("upstream pool: new client origin=%s http2=%s max_connections=%d", key, self.http2, self.max_connections)
+            else:
+                self._clients.move_to_end(key)
+        for old in closable:
+            self._close_quietly(old)
+        return c
+
+    @staticmethod
+    def _close_quietly(c: httpx.Client) -> None:
+        try:
+            c.close()
+        except Exception:
+            pass
+
+    @contextlib.contextmanager
+    def _checkout(self, url: str) -> Iterator[httpx.Client]:
+        # 统计在途请求，淘汰的 client 等请求结束后再关闭
+        c = self.client(url)
+        with self._lock:
+            self._inflight[c] = self._inflight.get(c, 0) + 1
+        try:
+            yield c
+        finally:
+            with self._lock:
+                left = self._inflight[c] = self._inflight[c] - 1
+                drained = left == 0 and c in self._retired
+                if left == 0:
+                    del self._inflight[c]
+                if drained:
+                    self._retired.discard(c)
+            if drained:
+                self._close_quietly(c)
+
+    def request(self, method: str, url: str, endpoint: Optional[str] = None, **kwargs) -> httpx.Response:
+        if endpoint is None or self.resilience is None:
+            with self._checkout(url) as c:
+                return c.request(method, url, **kwargs)
+        kwargs["timeout"] = self.resilience.guard(endpoint, kwargs.get("timeout") or 120.0)
+        start = time.perf_counter()
+        try:
+            with self._checkout(url) as c:
+                resp = c.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.resilience.failure(endpoint)
+            raise
+        except BaseException:
+            self.resilience.abandon(endpoint)
+            raise
+        self._record(endpoint, resp, time.perf_counter() - start)
+        return resp
+
+    def _record(self, endpoint: str, resp: httpx.Response, seconds: float) -> None:
+        if resp.status_code == 429 or resp.status_code >= 500:
+            self.resilience.failure(endpoint)
+        else:
+            self.resilience.success(endpoint, seconds)
+
+    def get(self, url: str, **kwargs) -> httpx.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> httpx.Response:
+        return self.request("POST", url, **kwargs)
+
+    @contextlib.contextmanager
+    def stream(self, method: str, url: str, endpoint: Optional[str] = None, **kwargs) -> Iterator[httpx.Response]:
+        if endpoint is None or self.resilience is None:
+            with self._checkout(url) as c, c.stream(method, url, **kwargs) as resp:
+                yield resp
+            return
+        ceiling = float(kwargs.get("timeout") or 120.0)
+        headers_timeout = self.resilience.guard(endpoint, ceiling)
+        # 延迟样本只是到响应头的时间，不能拿来卡正文：流式正文的读超时仍用调用方给的上限（受请求预算约束）
+        left = remaining_budget()
+        read_timeout = ceiling if left is None else max(headers_timeout, min(ceiling, left))
+        kwargs["timeout"] = httpx.Timeout(headers_timeout, read=read_timeout)
+        start = time.perf_counter()
+        recorded = False
+        try:
+            with self._checkout(url) as c, c.stream(method, url, **kwargs) as resp:
+                # latency to response headers; errors while reading the body still count as failures
+                self._record(endpoint, resp, time.perf_counter() - start)
+                recorded = True
+                yield resp
+        except httpx.HTTPError:
+            self.resilience.failure(endpoint)
+            raise
+        except BaseException:
+            if not recorded:
+                self.resilience.abandon(endpoint)
+            raise
+
+    def openai_client(self, api_key: Optional[str], base_url: str):
+        """Return a cached OpenAI SDK client that reuses the pooled transport for ``base_url``."""
+        from openai import OpenAI
+
+        key = (api_key or "", base_url)
+        # the SDK holds on to this transport, so its origin is never evicted
+        self.pin([base_url])
+        with self._lock:
+            oc = self._openai_clients.get(key)
+        if oc is not None:
+            return oc
+        oc = OpenAI(api_key=api_key, base_url=base_url, http_client=self.client(base_url))
+        with self._lock:
+            return self._openai_clients.setdefault(key, oc)
+
+    def prewarm(self, urls: Iterable[str], connections: int = 2, timeout: float = 10.0) -> threading.Thread:
+        """Open ``connections`` keep-alive connections per origin in the background.
+
+        The probe is a HEAD on the origin root; the status code is irrelevant, the
+        point is to have TCP+TLS (and ALPN) done before the first user request.
+        """
+        origins = []
+        for u in urls:
+            try:
+                o = _origin(u)
+            except ValueError:
+                continue
+            if o not in origins:
+                origins.append(o)
+
+        def _probe(origin: str) -> None:
+            try:
+                self.client(origin).head(origin + "/", timeout=timeout)
+            except Exception as exc:
+                logger.info("upstream pool: prewarm %s failed: %s", origin, exc)
+
+        def _run() -> None:
+            threads = []
+            for o in origins:
+                for _ in range(max(1, connections)):
+                    t = threading.Thread(target=_probe, args=(o,), name="upstream-prewarm", daemon=True)
+                    t.start()
+                    threads.append(t)
+            for t in threads:
+                t.join()
+            if origins:
+                logger.info("upstream pool: prewarmed %s", ", ".join(origins))
+
+        runner = threading.Thread(target=_run, name="upstream-prewarm", daemon=True)
+        runner.start()
+        return runner
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "http2": self.http2,
+                "max_connections": self.max_connections,
+                "max_keepalive": self.max_keepalive,
+                "keepalive_expiry": self.keepalive_expiry,
+                "origins": sorted(k for k, c in self._clients.items() if not c.is_closed),
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            clients = list(self._clients.values()) + list(self._retired)
+            self._clients.clear()
+            self._retired.clear()
+            self._openai_clients.clear()
+        for c in clients:
+            self._close_quietly(c)
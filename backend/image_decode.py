@@ -0,0 +1,288 @@
+from __future__ import annotations
+
+import io
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from backend.metrics import metrics
+
+
+class UnsupportedImage(ValueError):
+    pass
+
+
+# Extensions whose payload is a TIFF-style container that should go to rawpy first.
+RAW_EXTS = {".dng", ".raw", ".arw", ".cr2", ".nef", ".nrw", ".orf", ".rw2", ".raf", ".pef", ".srw", ".3fr", ".erf", ".kdc", ".mos", ".mrw", ".x3f", ".cr3", ".crw"}
+
+_HEIF_BRANDS = {b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"hevm", b"hevs", b"mif1", b"msf1"}
+_AVIF_BRANDS = {b"avif", b"avis"}
+
+
+def sniff_format(data: bytes, filename: str = "") -> str:
+    """Identify the container from its leading bytes.
+
+    Returns one of ``jpeg``, ``png``, ``gif``, ``webp``, ``bmp``, ``heif``,
+    ``avif``, ``raw``, ``tiff`` or ``unknown``. TIFF-based RAW variants that are
+    indistinguishable from plain TIFF by signature alone (NEF, ARW, DNG, ...)
+    use the file extension as a tie-breaker.
+    """
+    head = data[:32]
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[4:8] == b"ftyp":
+        brand = head[8:12]
+        if brand in _AVIF_BRANDS:
+            return "avif"
+        if brand in _HEIF_BRANDS:
+            return "heif"
+        if brand == b"crx ":
+            return "raw"  # Canon CR3
+        compat = data[16 : min(len(data), 64)]
+        if any(compat[i : i + 4] in _AVIF_BRANDS for i in range(0, len(compat) - 3, 4)):
+            return "avif"
+        if any(compat[i : i + 4] in _HEIF_BRANDS for i in range(0, len(compat) - 3, 4)):
+            return "heif"
+        return "unknown"
+    if head[:4] in (b"IIRO", b"IIRS", b"MMOR") or head[:4] == b"IIU\x00":
+        return "raw"  # Olympus ORF, Panasonic RW2
+    if head.startswith(b"FUJIFILMCCD-RAW") or head.startswith(b"FOVb") or head.startswith(b"\x00MRM"):
+        return "raw"  # Fuji RAF, Sigma X3F, Minolta MRW
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        if head[8:10] == b"CR":
+            return "raw"  # Canon CR2
+        if Path(filename or "").suffix.lower() in RAW_EXTS:
+            return "raw"
+        return "tiff"
+    if head.startswith(b"II\x1a\x00\x00\x00HEAPCCDR"):
+        return "raw"  # Canon CRW
+    if head[:2] == b"BM":
+        return "bmp"
+    return "unknown"
+
+
+Size = Tuple[int, int]
+
+
+def fit_size(size: Size, max_side: int) -> Size:
+    """Output size of fitting ``size`` inside a ``max_side`` square (never upscales)."""
+    w, h = size
+    m = int(max_side)
+    if w <= m and h <= m:
+        return w, h
+    if w >= h:
+        return m, max(1, int(h * m / w))
+    return max(1, int(w * m / h)), m
+
+
+def resize_to(img, size: Size):
+    """Resample ``img`` to exactly ``size``.
+
+    Large integer shrink factors go through ``Image.reduce`` (a cheap box
+    average) first, so the final LANCZOS pass only covers the last < 2x.
+    """
+    from PIL import Image as _Image
+
+    size = (max(1, int(size[0])), max(1, int(size[1])))
+    if img.size == size:
+        return img
+    factor = min(img.size[0] // size[0], img.size[1] // size[1])
+    if factor >= 2:
+        img = img.reduce(factor)
+        if img.size == size:
+            return img
+    return img.resize(size, _Image.LANCZOS)
+
+
+def fit_within(img, max_side: int):
+    return resize_to(img, fit_size(img.size, max_side))
+
+
+class FitBox(tuple):
+    """A ``max_side`` square bound for sources whose size was not probed.
+
+    It behaves as ``(max_side, max_side)``; decoders that learn the real
+    size (``_decode_raw``) use ``fit_target`` to get the actual fit instead.
+    """
+
+    def __new__(cls, max_side: int) -> "FitBox":
+        return super().__new__(cls, (int(max_side), int(max_side)))
+
+    def __getnewargs__(self):
+        return (self[0],)
+
+
+def fit_target(src: Size, box: Size) -> Size:
+    """The size a decode of ``src`` has to reach for ``box``."""
+    return fit_size(src, box[0]) if isinstance(box, FitBox) else box
+
+
+def _covers(size: Size, box: Size) -> bool:
+    # orientation may still be swapped by the decoder, so compare long/short sides
+    return max(size) >= max(box) and min(size) >= min(box)
+
+
+def _decode_pil(data: bytes, box: Optional[Size] = None):
+    from PIL import Image as _Image
+
+    img = _Image.open(io.BytesIO(data))
+    if box is not None:
+        # JPEG: let libjpeg scale the DCT by 1/2, 1/4 or 1/8 while staying >= box
+        img.draft("RGB", box)
+    return img.convert("RGB")
+
+
+def _decode_heif(data: bytes, box: Optional[Size] = None):
+    import pillow_heif as _pheif
+    from PIL import Image as _Image
+
+    heif = _pheif.read_heif(data)
+    return _Image.frombytes(heif.mode, heif.size, heif.data)
+
+
+def _decode_raw(data: bytes, box: Optional[Size] = None):
+    import rawpy as _rawpy
+    from PIL import Image as _Image
+
+    with _rawpy.imread(io.BytesIO(data)) as raw:
+        # half_size skips demosaicing (one pixel per 2x2 Bayer block): ~4x less work
+        w, h = raw.sizes.width, raw.sizes.height
+        half = box is not None and _covers((w // 2, h // 2), fit_target((w, h), box))
+        rgb = raw.postprocess(use_camera_wb=True, no_auto_bright=True, output_bps=8, gamma=(1, 1), half_size=half)
+    return _Image.fromarray(rgb)
+
+
+def _decode_raw_thumb(data: bytes, box: Optional[Size] = None):
+    """The camera's embedded preview JPEG, if there is one at least ``box`` large.
+
+    Only the long side is compared: previews ask for a fit-inside square and
+    embedded previews are usually 3:2 at 1600-ish px or full sensor size.
+    """
+    import rawpy as _rawpy
+    from PIL import Image as _Image
+
+    with _rawpy.imread(io.BytesIO(data)) as raw:
+        thumb = raw.extract_thumb()
+    if thumb.format == _rawpy.ThumbFormat.JPEG:
+        img = _Image.open(io.BytesIO(thumb.data))
+    elif thumb.format == _rawpy.ThumbFormat.BITMAP:
+        img = _Image.fromarray(thumb.data)
+    else:
+        raise UnsupportedImage(f"unsupported thumbnail format {thumb.format}")
+    if box is not None and max(img.size) < max(box):
+        raise UnsupportedImage(f"embedded thumbnail too small: {img.size}")
+    if box is not None:
+        img.draft("RGB", box)
+    return img.convert("RGB")
+
+
+DECODERS: Dict[str, Callable[..., object]] = {
+    "pil": _decode_pil,
+    "heif": _decode_heif,
+    "raw": _decode_raw,
+    "raw_thumb": _decode_raw_thumb,
+}
+
+# Decoders to try, in order, for each sniffed format. "unknown" keeps the old
+# try-everything chain for payloads we cannot classify.
+DISPATCH: Dict[str, List[str]] = {
+    "jpeg": ["pil"],
+    "png": ["pil"],
+    "gif": ["pil"],
+    "webp": ["pil"],
+    "bmp": ["pil"],
+    "heif": ["heif", "pil"],
+    "avif": ["pil", "heif"],
+    "raw": ["raw", "pil"],
+    "tiff": ["pil", "raw"],
+    "unknown": ["heif", "raw", "pil"],
+}
+
+# Overrides used for preview decodes: RAW files show the embedded camera JPEG
+# and only demosaic (half-size, via the box) when there is none big enough.
+PREVIEW_DISPATCH: Dict[str, List[str]] = {
+    "raw": ["raw_thumb", "raw", "pil"],
+}
+
+
+def register_decoder(name: str, fn: Callable[..., object], formats: Optional[List[str]] = None, first: bool = True) -> None:
+    DECODERS[name] = fn
+    for fmt in formats or []:
+        chain = [d for d in DISPATCH.setdefault(fmt, []) if d != name]
+        DISPATCH[fmt] = [name] + chain if first else chain + [name]
+
+
+def _probe_size(data: bytes) -> Optional[Size]:
+    try:
+        from PIL import Image as _Image
+
+        with _Image.open(io.BytesIO(data)) as probe:
+            return probe.size
+    except Exception:
+        return None
+
+
+# formats whose header Pillow reads cheaply and whose reported size is the image's own
+_PROBE_FORMATS = {"jpeg", "png", "gif", "webp", "bmp"}
+
+
+def probe_size(data: bytes, filename: str = "") -> Optional[Size]:
+    """Source size from the header alone, or ``None`` when it cannot be trusted (HEIF, RAW, TIFF, ...)."""
+    if sniff_format(data, filename) not in _PROBE_FORMATS:
+        return None
+    return _probe_size(data)
+
+
+def decode_image(data: bytes, filename: str = "", max_side: Optional[int] = None, size: Optional[Size] = None, preview: bool = False):
+    """Decode ``data`` to a PIL image using the decoder chain for its sniffed format.
+
+    ``max_side`` fits the result inside that square; ``size`` resamples to
+    exactly that size. Either way decoders are told the bound (``box``) so
+    they can decode at reduced resolution instead of full size and shrink.
+    Decoders are called as ``fn(data, box)``; ``box`` is a ``FitBox`` when
+    only ``max_side`` is known. ``preview=True`` allows
+    lower-fidelity sources (``PREVIEW_DISPATCH``) such as embedded RAW thumbnails.
+
+    Raises ``ImportError`` if Pillow itself is missing and ``UnsupportedImage``
+    when no decoder accepts the payload. Timing is recorded per format as
+    ``decode.<fmt>.count`` / ``decode.<fmt>.seconds`` (and ``.fallbacks`` when
+    the first decoder in the chain rejected the payload).
+    """
+    import PIL  # noqa: F401  (fail loudly when Pillow is absent)
+
+    fmt = sniff_format(data, filename)
+    start = time.perf_counter()
+    box: Optional[Size] = None
+    if size is not None:
+        box = (max(1, int(size[0])), max(1, int(size[1])))
+    elif max_side:
+        # only JPEG headers are cheap and trustworthy to probe (a TIFF-based RAW
+        # reports its embedded thumbnail); elsewhere decoders get a FitBox and
+        # fit against the size they read themselves
+        src = _probe_size(data) if fmt == "jpeg" else None
+        box = fit_size(src, max_side) if src is not None else FitBox(max_side)
+    last_exc: Optional[BaseException] = None
+    chain = (PREVIEW_DISPATCH.get(fmt) if preview else None) or DISPATCH.get(fmt) or DISPATCH["unknown"]
+    for i, name in enumerate(chain):
+        try:
+            img = DECODERS[name](data, box)
+        except Exception as exc:
+            last_exc = exc
+            continue
+        if size is not None:
+            img = resize_to(img, box)
+        elif max_side:
+            img = fit_within(img, max_side)
+        metrics.incr(f"decode.{fmt}.count")
+        metrics.incr(f"decode.{fmt}.seconds", time.perf_counter() - start)
+        if i:
+            metrics.incr(f"decode.{fmt}.fallbacks")
+        return img
+    metrics.incr(f"decode.{fmt}.errors")
+    raise UnsupportedImage(f"cannot decode {fmt} payload: {last_exc}")
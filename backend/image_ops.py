@@ -0,0 +1,349 @@
+from __future__ import annotations
+
+import io
+import json
+from typing import Optional, Tuple
+
+import numpy as _np
+
+from backend.image_decode import decode_image, probe_size, resize_to
+
+# Image jobs run on backend.cpu_pool workers, possibly in another process:
+# keep them top-level, picklable and free of server / FastAPI imports. Inputs
+# and outputs are encoded bytes, never PIL images, so a process hop costs one
+# copy of the compressed payload instead of the decoded pixels.
+
+
+class UnsupportedOutputFormat(ValueError):
+    pass
+
+
+class InvalidMaskSpec(ValueError):
+    pass
+
+
+# mask specs come from the client; bound the canvas before allocating anything for it
+MAX_MASK_SPEC_SIDE = 8192
+
+
+def can_encode(fmt: str) -> bool:
+    """Whether this Pillow build has an encoder for ``fmt`` (AVIF needs Pillow >= 11.2 or a plugin)."""
+    from PIL import Image as _Image
+
+    _Image.init()
+    return {"jpg": "JPEG"}.get(fmt.lower(), fmt.upper()) in _Image.SAVE
+
+
+def pil_to_bytes(img, fmt: str, quality: int | None = None, compression: int | None = None, extra_info: dict | None = None):
+    buf = io.BytesIO()
+    f = (fmt or 'jpeg').lower()
+    if f == 'jpeg':
+        q = int(quality or 90)
+        try:
+            img.save(buf, format='JPEG', quality=q, subsampling=0)
+        except Exception:
+            img.save(buf, format='JPEG', quality=q)
+        mime = 'image/jpeg'
+    elif f == 'png':
+        c = int(compression or 6)
+        try:
+            from PIL.PngImagePlugin import PngInfo
+            pi = PngInfo()
+            if extra_info:
+                for k, v in extra_info.items():
+                    try:
+                        pi.add_text(str(k), str(v))
+                    except Exception:
+                        pass
+                if extra_info.get('DateTime'):
+                    try:
+                        pi.add_text('CreationTime', str(extra_info['DateTime']))
+                    except Exception:
+                        pass
+            img.save(buf, format='PNG', compress_level=c, pnginfo=pi)
+        except Exception:
+            img.save(buf, format='PNG', compress_level=c)
+        mime = 'image/png'
+    elif f in ('webp', 'avif'):
+        q = int(quality or (85 if f == 'webp' else 60))
+        try:
+            img.save(buf, format=f.upper(), quality=q)
+        except (KeyError, OSError) as exc:
+            # Pillow built without this encoder (KeyError) or unable to write the image mode
+            raise UnsupportedOutputFormat(f"Cannot encode {fmt}: {exc}")
+        mime = f'image/{f}'
+    elif f == 'tiff':
+        try:
+            from PIL.TiffImagePlugin import ImageFileDirectory_v2
+            ifd = ImageFileDirectory_v2()
+            if extra_info:
+                desc = str(extra_info.get('Description') or '')
+                cr = str(extra_info.get('Copyright') or '')
+                artist = str(extra_info.get('Artist') or '')
+                software = str(extra_info.get('Software') or '')
+                dt = str(extra_info.get('DateTime') or '')
+                if desc:
+                    ifd[270] = desc
+                if cr:
+                    ifd[33432] = cr
+                if artist:
+                    ifd[315] = artist
+                if software:
+                    ifd[305] = software
+                if dt:
+                    ifd[306] = dt
+            img.save(buf, format='TIFF', tiffinfo=ifd)
+        except Exception:
+            img.save(buf, format='TIFF')
+        mime = 'image/tiff'
+    else:
+        raise UnsupportedOutputFormat(f"Unsupported output format: {fmt}")
+    return buf.getvalue(), mime
+
+
+def render_preview(data: bytes, filename: str, max_side: int = 1600) -> Tuple[bytes, str]:
+    img = decode_image(data, filename, max_side=max_side, preview=True)
+    return pil_to_bytes(img, "png")
+
+
+def render_model_input(data: bytes, filename: str, fmt: str, max_side: int) -> Tuple[bytes, Tuple[int, int]]:
+    img = decode_image(data, filename, max_side=max_side)
+    out, _ = pil_to_bytes(img, fmt, quality=90 if fmt == "jpeg" else None)
+    return out, img.size
+
+
+def render_mask(data: bytes, filename: str, size: Tuple[int, int]) -> bytes:
+    img = decode_image(data, filename, size=size)
+    return pil_to_bytes(img, "png")[0]
+
+
+def fit_box(size: Tuple[int, int], w: Optional[int] = None, h: Optional[int] = None) -> Tuple[int, int]:
+    """Largest size with ``size``'s aspect ratio inside ``w`` x ``h`` (either may be None); never upscales."""
+    sw, sh = size
+    scale = min(w / sw if w else 1.0, h / sh if h else 1.0, 1.0)
+    return max(1, round(sw * scale)), max(1, round(sh * scale))
+
+
+def render_variant(data: bytes, filename: str, w: Optional[int], h: Optional[int], fmt: str, quality: Optional[int] = None) -> Tuple[bytes, str]:
+    src = probe_size(data, filename)
+    if src is not None:
+        img = decode_image(data, filename, size=fit_box(src, w, h))
+    else:
+        # HEIF / AVIF / RAW: only the decoder knows the real size
+        img = decode_image(data, filename)
+        img = resize_to(img, fit_box(img.size, w, h))
+    return pil_to_bytes(img, fmt, quality=quality)
+
+
+def _rle_to_mask(counts, src: Tuple[int, int], size: Tuple[int, int]):
+    from PIL import Image as _Image
+
+    sw, sh = src
+    if any(c < 0 for c in counts) or sum(counts) != sw * sh:
+        raise InvalidMaskSpec(f"rle counts must be non-negative and sum to {sw}x{sh}")
+    # sample the run list directly at the output grid: pixel p is masked
+    # when it falls in an odd-numbered run (runs alternate off/on)
+    ends = _np.cumsum(_np.asarray(counts, dtype=_np.int64))
+    ys = ((_np.arange(size[1]) + 0.5) * sh / size[1]).astype(_np.int64)
+    xs = ((_np.arange(size[0]) + 0.5) * sw / size[0]).astype(_np.int64)
+    run = _np.searchsorted(ends, ys[:, None] * sw + xs[None, :], side="right")
+    return _Image.fromarray(((run & 1) * 255).astype(_np.uint8), "L")
+
+
+def rasterize_mask_spec(spec: dict, size: Tuple[int, int]):
+    """Rasterize a compact mask description straight at ``size``.
+
+    ``spec`` is ``{"size": [w, h], "rle": [...], "strokes": [...]}`` in the
+    coordinates of the client canvas (``size``); both parts are optional and
+    are unioned:
+
+    - ``rle``: row-major run lengths alternating unmasked / masked, starting
+      with unmasked (a leading 0 if the first pixel is masked);
+    - ``strokes``: ``{"points": [x0, y0, x1, y1, ...], "width": px}`` polylines
+      with round caps and joints.
+    """
+    from PIL import Image as _Image, ImageChops as _ImageChops, ImageDraw as _ImageDraw
+
+    try:
+        sw, sh = (int(v) for v in spec["size"])
+    except (KeyError, TypeError, ValueError):
+        raise InvalidMaskSpec("mask spec needs size: [width, height]")
+    if sw <= 0 or sh <= 0:
+        raise InvalidMaskSpec("mask size must be positive")
+    if max(sw, sh) > MAX_MASK_SPEC_SIDE:
+        raise InvalidMaskSpec(f"mask size must be at most {MAX_MASK_SPEC_SIDE} per side")
+    sx, sy = size[0] / sw, size[1] / sh
+    mask = _Image.new("L", size, 0)
+    rle = spec.get("rle")
+    if rle:
+        try:
+            counts = [int(c) for c in rle]
+        except (TypeError, ValueError):
+            raise InvalidMaskSpec("rle must be a list of integers")
+        mask = _rle_to_mask(counts, (sw, sh), size)
+    strokes = spec.get("strokes") or []
+    if strokes:
+        draw = _ImageDraw.Draw(mask)
+        for stroke in strokes:
+            try:
+                pts = [float(v) for v in stroke["points"]]
+                width = max(1.0, float(stroke.get("width", 8)) * (sx + sy) / 2)
+            except (KeyError, TypeError, ValueError):
+                raise InvalidMaskSpec("stroke needs points: [x0, y0, ...] and a numeric width")
+            xy = [(pts[i] * sx, pts[i + 1] * sy) for i in range(0, len(pts) - 1, 2)]
+            if not xy:
+                continue
+            if len(xy) > 1:
+                draw.line(xy, fill=255, width=int(round(width)), joint="curve")
+            r = width / 2
+            for x, y in (xy[0], xy[-1]):
+                draw.ellipse([x - r, y - r, x + r, y + r], fill=255)
+    return mask
+
+
+def render_mask_spec(data: bytes, filename: str, size: Tuple[int, int]) -> bytes:
+    try:
+        spec = json.loads(data)
+    except ValueError as exc:
+        raise InvalidMaskSpec(f"mask spec is not valid JSON: {exc}")
+    if not isinstance(spec, dict):
+        raise InvalidMaskSpec("mask spec must be a JSON object")
+    return pil_to_bytes(rasterize_mask_spec(spec, tuple(size)), "png")[0]
+
+
+Box = Tuple[int, int, int, int]
+
+
+def mask_bbox(mask, threshold: int = 127) -> Optional[Box]:
+    """``(left, top, right, bottom)`` of mask pixels above ``threshold``, or None if there are none."""
+    mask = mask.convert("L")
+    on = _np.asarray(mask) > threshold
+    rows = _np.flatnonzero(on.any(axis=1))
+    cols = _np.flatnonzero(on.any(axis=0))
+    if not rows.size:
+        return None
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+
+def pad_box(box: Box, size: Tuple[int, int], padding: int, min_side: int = 0) -> Box:
+    """Grow ``box`` by ``padding`` (and to at least ``min_side`` per axis), clamped to ``size``."""
+    out = []
+    for lo, hi, limit in ((box[0], box[2], size[0]), (box[1], box[3], size[1])):
+        lo, hi = lo - padding, hi + padding
+        short = max(0, min(min_side, limit) - (hi - lo))
+        lo -= short // 2
+        hi += short - short // 2
+        shift = max(0, -lo) - max(0, hi - limit)
+        out.append((max(0, lo + shift), min(limit, hi + shift)))
+    return out[0][0], out[1][0], out[0][1], out[1][1]
+
+
+def prepare_mask_crop(
+    image: bytes, filename: str, mask: bytes, padding: int = 64, min_side: int = 256, max_fraction: float = 0.6
+) -> Optional[Tuple[bytes, bytes, Box]]:
+    """Crop a model-input image and its mask to the padded mask bounding box.
+
+    Returns ``(image_png, mask_png, box)`` with ``box`` in model-input
+    coordinates, or None when the mask is empty or the crop would cover more
+    than ``max_fraction`` of the image (sending the whole frame is then cheaper
+    than a composite round trip).
+    """
+    from PIL import Image as _Image
+
+    img = _Image.open(io.BytesIO(image))
+    m = _Image.open(io.BytesIO(mask)).convert("L")
+    bbox = mask_bbox(m)
+    if bbox is None:
+        return None
+    box = pad_box(bbox, img.size, padding, min_side)
+    if (box[2] - box[0]) * (box[3] - box[1]) > max_fraction * img.size[0] * img.size[1]:
+        return None
+    return pil_to_bytes(img.convert("RGB").crop(box), "png")[0], pil_to_bytes(m.crop(box), "png")[0], box
+
+
+def composite_mask_crop(
+    original: bytes, filename: str, edit: bytes, mask: bytes, box: Box, model_size: Tuple[int, int], feather: float = 4.0
+) -> Tuple[bytes, str]:
+    """Blend an edited crop back into the full-resolution original.
+
+    ``mask`` and ``box`` are in model-input coordinates (``model_size``) and are
+    scaled to the original. The edit is resampled into the box and pasted
+    through the feathered mask, so pixels farther than ``feather`` from the
+    mask keep the original values exactly; the result is PNG for that reason.
+    """
+    from PIL import Image as _Image, ImageFilter as _ImageFilter
+
+    base = decode_image(original, filename)
+    sx, sy = base.size[0] / model_size[0], base.size[1] / model_size[1]
+    full = (
+        int(box[0] * sx),
+        int(box[1] * sy),
+        min(base.size[0], int(round(box[2] * sx))),
+        min(base.size[1], int(round(box[3] * sy))),
+    )
+    size = (full[2] - full[0], full[3] - full[1])
+    patch = resize_to(decode_image(edit, "edit.png"), size)
+    alpha = _Image.open(io.BytesIO(mask)).convert("L")
+    if alpha.size != (box[2] - box[0], box[3] - box[1]):
+        alpha = alpha.crop(box)
+    alpha = alpha.resize(size, _Image.BILINEAR)
+    if feather > 0:
+        alpha = alpha.filter(_ImageFilter.GaussianBlur(feather * max(sx, sy)))
+    base.paste(patch, full[:2], alpha)
+    return pil_to_bytes(base, "png")
+
+
+def draw_watermark(img, text: str, pos: str = "BR", opacity: float = 0.0, size: int = 24):
+    txt = (text or "").strip()
+    pos = (pos or "BR").upper()
+    op = float(opacity or 0.0)
+    sz = int(size or 24)
+    if not txt or op <= 0:
+        return img
+    from PIL import Image, ImageDraw, ImageFont
+
+    base = img.convert("RGBA")
+    layer = Image.new("RGBA", base.size, (0, 0, 0, 0))
+    d = ImageDraw.Draw(layer)
+    try:
+        fnt = ImageFont.truetype("arial.ttf", sz)
+    except Exception:
+        from PIL import ImageFont as _IF
+
+        fnt = _IF.load_default()
+    tw, th = d.textsize(txt, font=fnt)
+    margin = max(8, sz // 2)
+    if pos == "TL":
+        x = margin
+        y = margin
+    else:
+        x = base.size[0] - tw - margin
+        y = base.size[1] - th - margin
+    bg = int(255 * op * 0.6)
+    fg = int(255 * op)
+    d.rectangle([x - 6, y - 4, x + tw + 6, y + th + 4], fill=(0, 0, 0, bg))
+    d.text((x, y), txt, font=fnt, fill=(255, 255, 255, fg))
+    return Image.alpha_composite(base, layer).convert("RGB")
+
+
+def render_convert(
+    data: bytes,
+    filename: str,
+    fmt: str,
+    quality: Optional[int] = None,
+    compression: Optional[int] = None,
+    size: Optional[Tuple[int, int]] = None,
+    color: str = "RGB",
+    watermark: Optional[dict] = None,
+    extra_info: Optional[dict] = None,
+) -> Tuple[bytes, str]:
+    img = decode_image(data, filename, size=size)
+    try:
+        img = img.convert("L" if (color or "RGB").upper() == "GRAY" else "RGB")
+    except Exception:
+        pass
+    try:
+        img = draw_watermark(img, **(watermark or {}))
+    except Exception:
+        pass
+    return pil_to_bytes(img, fmt, quality, compression, extra_info=extra_info)
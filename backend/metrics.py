@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import threading
+from collections import defaultdict
+from typing import Callable, Dict
+
+
+class Metrics:
+    """Process-local counters plus named stats providers, served by ``GET /metrics``."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = defaultdict(float)
+        self._providers: Dict[str, Callable[[], dict]] = {}
+
+    def incr(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] += value
+
+    def get(self, name: str) -> float:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def counters(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._counters)
+
+    def merge(self, deltas: Dict[str, float]) -> None:
+        """Add counters recorded elsewhere (e.g. in a pool worker process)."""
+        with self._lock:
+            for name, value in deltas.items():
+                self._counters[name] += value
+
+    def register(self, name: str, provider: Callable[[], dict]) -> None:
+        self._providers[name] = provider
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = {k: (int(v) if float(v).is_integer() else round(v, 6)) for k, v in sorted(self._counters.items())}
+        out: dict = {"counters": counters}
+        for name, provider in list(self._providers.items()):
+            try:
+                out[name] = provider()
+            except Exception as exc:
+                out[name] = {"error": str(exc)}
+        return out
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+
+
+metrics = Metrics()
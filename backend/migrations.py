@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import logging
+import sqlite3
+from typing import Callable, List, Tuple
+
+logger = logging.getLogger("reimagine")
+
+Migration = Tuple[int, str, Callable[[sqlite3.Connection], None]]
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> set:
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _v1_baseline(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            prompt TEXT NOT NULL,
+            thinking TEXT,
+            image_path TEXT NOT NULL,
+            logs TEXT,
+            original_name TEXT,
+            raw_response TEXT,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+    # databases created before these columns existed
+    cols = _columns(conn, "records")
+    if "original_name" not in cols:
+        conn.execute("ALTER TABLE records ADD COLUMN original_name TEXT")
+    if "raw_response" not in cols:
+        conn.execute("ALTER TABLE records ADD COLUMN raw_response TEXT")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS record_images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            record_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            image_path TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS smart_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_path TEXT NOT NULL,
+            original_name TEXT,
+            spec_json TEXT NOT NULL,
+            facts_json TEXT,
+            template_selected TEXT,
+            template_candidates_json TEXT,
+            status TEXT NOT NULL,
+            record_id INTEGER,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS smart_session_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS blobs (
+            digest TEXT PRIMARY KEY,
+            ext TEXT NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+
+
+def _archive_orphans(conn: sqlite3.Connection, table: str, orphan_where: str) -> None:
+    # 子表里父记录已不存在的行不能带进有外键约束的新表：先原样复制到 <table>_orphaned 再丢弃，不静默删数据
+    count = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE {orphan_where}").fetchone()[0]
+    if not count:
+        return
+    archive = f"{table}_orphaned"
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {archive} AS SELECT * FROM {table} WHERE 0")
+    conn.execute(f"INSERT INTO {archive} SELECT * FROM {table} WHERE {orphan_where}")
+    logger.warning("schema migration: moved %d %s rows without a parent to %s", count, table, archive)
+
+
+def _v2_foreign_keys(conn: sqlite3.Connection) -> None:
+    # SQLite cannot add constraints in place: rebuild the child tables. Rows whose
+    # parent no longer exists are archived (see _archive_orphans), not carried over.
+    dangling = conn.execute(
+        "SELECT COUNT(*) FROM smart_sessions s WHERE s.record_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM records r WHERE r.id = s.record_id)"
+    ).fetchone()[0]
+    if dangling:
+        logger.warning("schema migration: clearing record_id on %d smart_sessions whose record no longer exists", dangling)
+    conn.execute(
+        """
+        CREATE TABLE smart_sessions_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_path TEXT NOT NULL,
+            original_name TEXT,
+            spec_json TEXT NOT NULL,
+            facts_json TEXT,
+            template_selected TEXT,
+            template_candidates_json TEXT,
+            status TEXT NOT NULL,
+            record_id INTEGER REFERENCES records(id) ON DELETE SET NULL,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        INSERT INTO smart_sessions_new
+        SELECT s.id, s.image_path, s.original_name, s.spec_json, s.facts_json, s.template_selected,
+               s.template_candidates_json, s.status,
+               CASE WHEN EXISTS (SELECT 1 FROM records r WHERE r.id = s.record_id) THEN s.record_id END,
+               s.created_at, s.updated_at
+        FROM smart_sessions s
+        """
+    )
+    conn.execute("DROP TABLE smart_sessions")
+    conn.execute("ALTER TABLE smart_sessions_new RENAME TO smart_sessions")
+
+    conn.execute(
+        """
+        CREATE TABLE record_images_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            record_id INTEGER NOT NULL REFERENCES records(id) ON DELETE CASCADE,
+            kind TEXT NOT NULL,
+            image_path TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+    _archive_orphans(conn, "record_images", "NOT EXISTS (SELECT 1 FROM records r WHERE r.id = record_images.record_id)")
+    conn.execute(
+        """
+        INSERT INTO record_images_new (id, record_id, kind, image_path, created_at)
+        SELECT i.id, i.record_id, i.kind, i.image_path, i.created_at
+        FROM record_images i
+        WHERE EXISTS (SELECT 1 FROM records r WHERE r.id = i.record_id)
+        """
+    )
+    conn.execute("DROP TABLE record_images")
+    conn.execute("ALTER TABLE record_images_new RENAME TO record_images")
+
+    conn.execute(
+        """
+        CREATE TABLE smart_session_messages_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER NOT NULL REFERENCES smart_sessions(id) ON DELETE CASCADE,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+    _archive_orphans(
+        conn, "smart_session_messages", "NOT EXISTS (SELECT 1 FROM smart_sessions s WHERE s.id = smart_session_messages.session_id)"
+    )
+    conn.execute(
+        """
+        INSERT INTO smart_session_messages_new (id, session_id, role, content, created_at)
+        SELECT m.id, m.session_id, m.role, m.content, m.created_at
+        FROM smart_session_messages m
+        WHERE EXISTS (SELECT 1 FROM smart_sessions s WHERE s.id = m.session_id)
+        """
+    )
+    conn.execute("DROP TABLE smart_session_messages")
+    conn.execute("ALTER TABLE smart_session_messages_new RENAME TO smart_session_messages")
+
+
+def _v3_indexes(conn: sqlite3.Connection) -> None:
+    # _list_records: ORDER BY created_at DESC (id breaks ties for stable paging)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_records_created_at ON records(created_at, id)")
+    # _list_record_images: WHERE record_id = ? ORDER BY created_at; covers every selected column
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_record_images_record ON record_images(record_id, created_at, kind, image_path)")
+    # _list_smart_session_messages: WHERE session_id = ? ORDER BY id (rowid is implicit in the index)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_smart_session_messages_session ON smart_session_messages(session_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_smart_sessions_record ON smart_sessions(record_id)")
+    # for blob GC, which was later dropped (see v4)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced ON blobs(created_at) WHERE refcount <= 0")
+
+
+def _v4_drop_blob_gc_index(conn: sqlite3.Connection) -> None:
+    # blobs are never garbage-collected, nothing reads this index
+    conn.execute("DROP INDEX IF EXISTS idx_blobs_unreferenced")
+
+
+MIGRATIONS: List[Migration] = [
+    (1, "baseline tables", _v1_baseline),
+    (2, "foreign keys on record_images, smart_sessions, smart_session_messages", _v2_foreign_keys),
+    (3, "secondary indexes", _v3_indexes),
+    (4, "drop unused blob GC index", _v4_drop_blob_gc_index),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(conn: sqlite3.Connection, migrations: List[Migration] = MIGRATIONS) -> Tuple[int, int]:
+    """Apply pending migrations in order, tracking progress in ``PRAGMA user_version``.
+
+    Must run inside a transaction (``Database.write`` provides one), so a failing
+    step leaves the schema at the previous version. Returns ``(from, to)``.
+    """
+    current = int(conn.execute("PRAGMA user_version").fetchone()[0])
+    target = current
+    for version, name, step in migrations:
+        if version <= current:
+            continue
+        logger.info("schema migration v%d: %s", version, name)
+        step(conn)
+        conn.execute(f"PRAGMA user_version = {int(version)}")
+        target = version
+    if target != current:
+        problems = conn.execute("PRAGMA foreign_key_check").fetchall()
+        if problems:
+            raise sqlite3.IntegrityError(f"foreign key check failed after migration: {problems[:5]}")
+    return current, target
@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import logging
+import math
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Sequence, Tuple, TypeVar
+
+from backend.metrics import metrics
+
+logger = logging.getLogger("reimagine")
+
+T = TypeVar("T")
+Backend = Tuple[str, str]  # (provider, model)
+
+POLICIES = ("fastest", "tail", "primary")
+
+
+def _percentile(ordered: List[float], q: float) -> float:
+    return ordered[min(len(ordered) - 1, max(0, int(math.ceil(q * len(ordered))) - 1))]
+
+
+class ProviderRouter:
+    """Orders (provider, model) backends for a task and fails over between them.
+
+    Every attempt is recorded per ``task`` and backend in a rolling window of
+    ``window`` outcomes; ``stats()`` reports p50/p95 latency of successes and
+    the error rate. ``rank(task, backends)`` puts unhealthy backends (error
+    rate above ``max_error_rate`` over at least ``min_samples`` attempts, or
+    rejected by the ``healthy(task, provider, model)`` hook, e.g. an open
+    circuit on the endpoint that task calls)
+    last, and orders the rest by ``policy``:
+
+    - ``fastest``: lowest p50;
+    - ``tail``: lowest p95;
+    - ``primary``: the configured order.
+
+    Backends without ``min_samples`` successes keep their configured position
+    relative to each other and sort after measured ones, so traffic does not
+    move to an unmeasured backend until failover has exercised it.
+
+    ``run`` / ``arun`` call ``call(provider, model)`` on each ranked backend
+    until one succeeds; exceptions for which ``retryable(exc)`` is false are
+    raised immediately. Records ``router.<task>.failovers``.
+    """
+
+    def __init__(
+        self,
+        policy: str = "fastest",
+        window: int = 100,
+        min_samples: int = 5,
+        max_error_rate: float = 0.5,
+        healthy: Optional[Callable[[str, str, str], bool]] = None,
+        retryable: Optional[Callable[[BaseException], bool]] = None,
+    ) -> None:
+        self.policy = policy if policy in POLICIES else "fastest"
+        self.window = max(1, int(window))
+        self.min_samples = max(1, int(min_samples))
+        self.max_error_rate = float(max_error_rate)
+        self.healthy = healthy
+        self.retryable = retryable or (lambda exc: True)
+        self._lock = threading.Lock()
+        self._outcomes: Dict[Tuple[str, Backend], Deque[Tuple[bool, float]]] = {}
+
+    def record(self, task: str, provider: str, model: str, seconds: float, ok: bool) -> None:
+        with self._lock:
+            q = self._outcomes.get((task, (provider, model)))
+            if q is None:
+                q = self._outcomes[(task, (provider, model))] = deque(maxlen=self.window)
+            q.append((bool(ok), float(seconds)))
+
+    def _summary_locked(self, task: str, backend: Backend) -> dict:
+        outcomes = list(self._outcomes.get((task, backend)) or ())
+        ok = sorted(s for good, s in outcomes if good)
+        return {
+            "attempts": len(outcomes),
+            "error_rate": round(1 - len(ok) / len(outcomes), 3) if outcomes else 0.0,
+            "p50": round(_percentile(ok, 0.5), 3) if ok else None,
+            "p95": round(_percentile(ok, 0.95), 3) if ok else None,
+            "successes": len(ok),
+        }
+
+    def _is_healthy(self, task: str, summary: dict, backend: Backend) -> bool:
+        if summary["attempts"] >= self.min_samples and summary["error_rate"] > self.max_error_rate:
+            return False
+        if self.healthy is not None:
+            try:
+                return bool(self.healthy(task, *backend))
+            except Exception:
+                return True
+        return True
+
+    def rank(self, task: str, backends: Sequence[Backend]) -> List[Backend]:
+        with self._lock:
+            summaries = {b: self._summary_locked(task, b) for b in backends}
+
+        def key(item):
+            index, backend = item
+            s = summaries[backend]
+            unhealthy = not self._is_healthy(task, s, backend)
+            if self.policy == "primary" or s["successes"] < self.min_samples:
+                return (unhealthy, 1, 0.0, index)
+            latency = s["p95"] if self.policy == "tail" else s["p50"]
+            return (unhealthy, 0, latency, index)
+
+        return [b for _i, b in sorted(enumerate(backends), key=key)]
+
+    def run(self, task: str, backends: Sequence[Backend], call: Callable[[str, str], T]) -> T:
+        last: Optional[BaseException] = None
+        for attempt, (provider, model) in enumerate(self.rank(task, backends)):
+            if attempt:
+                metrics.incr(f"router.{task}.failovers")
+                logger.warning("%s failing over to %s/%s after: %s", task, provider, model, last)
+            started = time.monotonic()
+            try:
+                result = call(provider, model)
+            except Exception as exc:
+                retry = self.retryable(exc)
+                self.record(task, provider, model, time.monotonic() - started, ok=not retry)
+                if not retry:
+                    raise
+                last = exc
+                continue
+            self.record(task, provider, model, time.monotonic() - started, ok=True)
+            return result
+        if last is None:
+            raise LookupError(f"no backend configured for {task}")
+        raise last
+
+    async def arun(self, task: str, backends: Sequence[Backend], call: Callable[[str, str], Awaitable[T]]) -> T:
+        last: Optional[BaseException] = None
+        for attempt, (provider, model) in enumerate(self.rank(task, backends)):
+            if attempt:
+                metrics.incr(f"router.{task}.failovers")
+                logger.warning("%s failing over to %s/%s after: %s", task, provider, model, last)
+            started = time.monotonic()
+            try:
+                result = await call(provider, model)
+            except Exception as exc:
+                retry = self.retryable(exc)
+                self.record(task, provider, model, time.monotonic() - started, ok=not retry)
+                if not retry:
+                    raise
+                last = exc
+                continue
+            self.record(task, provider, model, time.monotonic() - started, ok=True)
+            return result
+        if last is None:
+            raise LookupError(f"no backend configured for {task}")
+        raise last
+
+    def stats(self) -> dict:
+        with self._lock:
+            keys = list(self._outcomes)
+            out: dict = {"policy": self.policy}
+            for task, backend in keys:
+                out.setdefault(task, {})[f"{backend[0]}/{backend[1]}"] = self._summary_locked(task, backend)
+            return out
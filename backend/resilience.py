@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import contextvars
+import math
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from backend.metrics import metrics
+
+# absolute time.monotonic() by which the current request must be answered
+request_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("request_deadline", default=None)
+
+
+class CircuitOpen(RuntimeError):
+    """The endpoint's breaker is open; ``retry_after`` is the seconds until the next probe."""
+
+    def __init__(self, endpoint: str, retry_after: float) -> None:
+        super().__init__(f"circuit open for {endpoint}")
+        self.endpoint = endpoint
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+def remaining_budget() -> Optional[float]:
+    """Seconds left before ``request_deadline``, or ``None`` when the request has no deadline."""
+    deadline = request_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+class _Endpoint:
+    def __init__(self, window: int) -> None:
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.latencies: Deque[float] = deque(maxlen=window)
+
+
+class Resilience:
+    """Per-endpoint circuit breakers and latency-derived timeouts for upstream calls.
+
+    ``guard(endpoint, default_timeout)`` is called before a request and
+    returns the timeout to use: the ``percentile`` of recent successful
+    latencies times ``multiplier`` (once ``min_samples`` are known), clamped
+    to ``[min_timeout, default_timeout]`` and cut to the request's remaining
+    deadline. It raises ``CircuitOpen`` while the breaker is open and
+    ``DeadlineExceeded`` when less than ``min_timeout`` of budget is left.
+    The caller then reports ``success(endpoint, seconds)`` or
+    ``failure(endpoint)``.
+
+    ``failure_threshold`` consecutive failures open the breaker; after
+    ``cooldown`` seconds it lets a single probe through (half-open), which
+    closes it on success or reopens it on failure.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        cooldown: float = 30.0,
+        min_timeout: float = 5.0,
+        multiplier: float = 2.0,
+        percentile: float = 0.99,
+        min_samples: int = 20,
+        window: int = 200,
+    ) -> None:
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.cooldown = max(0.0, float(cooldown))
+        self.min_timeout = max(0.1, float(min_timeout))
+        self.multiplier = max(1.0, float(multiplier))
+        self.percentile = min(1.0, max(0.5, float(percentile)))
+        self.min_samples = max(1, int(min_samples))
+        self.window = max(self.min_samples, int(window))
+        self._lock = threading.Lock()
+        self._endpoints: Dict[str, _Endpoint] = {}
+
+    def _get(self, endpoint: str) -> _Endpoint:
+        ep = self._endpoints.get(endpoint)
+        if ep is None:
+            ep = self._endpoints[endpoint] = _Endpoint(self.window)
+        return ep
+
+    def _adaptive_timeout_locked(self, ep: _Endpoint, default_timeout: float) -> float:
+        if len(ep.latencies) < self.min_samples:
+            return default_timeout
+        ordered = sorted(ep.latencies)
+        p = ordered[min(len(ordered) - 1, int(math.ceil(self.percentile * len(ordered))) - 1)]
+        return min(default_timeout, max(self.min_timeout, p * self.multiplier))
+
+    def guard(self, endpoint: str, default_timeout: float) -> float:
+        now = time.monotonic()
+        with self._lock:
+            ep = self._get(endpoint)
+            if ep.state == "open":
+                if now - ep.opened_at < self.cooldown:
+                    metrics.incr(f"circuit.{endpoint}.rejected")
+                    raise CircuitOpen(endpoint, self.cooldown - (now - ep.opened_at))
+                ep.state = "half_open"
+            if ep.state == "half_open":
+                if ep.probing:
+                    metrics.incr(f"circuit.{endpoint}.rejected")
+                    raise CircuitOpen(endpoint, 1)
+                ep.probing = True
+            timeout = self._adaptive_timeout_locked(ep, float(default_timeout))
+        left = remaining_budget()
+        if left is not None:
+            if left < self.min_timeout:
+                self.abandon(endpoint)
+                metrics.incr(f"circuit.{endpoint}.deadline_exceeded")
+                raise DeadlineExceeded(f"{endpoint}: {max(0.0, left):.1f}s of request budget left")
+            timeout = min(timeout, left)
+        return timeout
+
+    def is_open(self, endpoint: str) -> bool:
+        """True while ``endpoint`` rejects calls (open and still cooling down)."""
+        with self._lock:
+            ep = self._endpoints.get(endpoint)
+            return ep is not None and ep.state == "open" and time.monotonic() - ep.opened_at < self.cooldown
+
+    def abandon(self, endpoint: str) -> None:
+        """Give up a guarded call without a verdict (frees a half-open probe)."""
+        with self._lock:
+            self._get(endpoint).probing = False
+
+    def success(self, endpoint: str, seconds: float) -> None:
+        with self._lock:
+            ep = self._get(endpoint)
+            ep.latencies.append(float(seconds))
+            if ep.state != "closed":
+                metrics.incr(f"circuit.{endpoint}.closed")
+            ep.state = "closed"
+            ep.failures = 0
+            ep.probing = False
+
+    def failure(self, endpoint: str) -> None:
+        with self._lock:
+            ep = self._get(endpoint)
+            ep.failures += 1
+            metrics.incr(f"circuit.{endpoint}.failures")
+            if ep.state == "half_open" or ep.failures >= self.failure_threshold:
+                if ep.state != "open":
+                    metrics.incr(f"circuit.{endpoint}.opened")
+                ep.state = "open"
+                ep.opened_at = time.monotonic()
+            ep.probing = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = {}
+            for name, ep in self._endpoints.items():
+                out[name] = {
+                    "state": ep.state,
+                    "failures": ep.failures,
+                    "samples": len(ep.latencies),
+                    "timeout": round(self._adaptive_timeout_locked(ep, float("inf")), 2) if len(ep.latencies) >= self.min_samples else None,
+                }
+            return out
@@ -1,12 +1,13 @@
 from __future__ import annotations
 
 import base64
+import hashlib
 import os
-import tempfile
 from pathlib import Path
 from typing import Optional
 
 from fastapi import APIRouter, Depends, File, Form, HTTPException, Request, UploadFile
+from starlette.concurrency import run_in_threadpool
 
 import server as impl
 
@@ -15,8 +16,11 @@ router = APIRouter(dependencies=[Depends(impl.require_api_auth)])
 
 @router.post("/magic_edit")
 async def magic_edit(
-    image: UploadFile = File(...),
+    image: Optional[UploadFile] = File(None),
     mask: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    mask_id: Optional[str] = Form(None),
+    mask_spec: Optional[str] = Form(None),
     prompt: str = Form(""),
     n: int = Form(1),
     size: str = Form(""),
@@ -26,294 +30,337 @@ async def magic_edit(
     aspect_ratio: Optional[str] = Form(None),
     resolution: Optional[str] = Form(None),
     step: Optional[int] = Form(None),
+    crop_to_mask: bool = Form(False),
+    mask_padding: int = Form(64),
     request: Request = None,  # 新增：获取请求Host
 ):
     vision_api_key = os.getenv("VISION_API_KEY")
     image_edit_endpoint = os.getenv("IMAGE_EDIT_ENDPOINT")
-    model = os.getenv("IMAGE_EDIT_MODEL", "gemini-3-pro-image-preview")
-
-    if not vision_api_key:
+    dashscope_api_key = os.getenv("DASHSCOPE_API_KEY") if impl.MultiModalConversation is not None else None
+
+    # 两个提供方都已配置时由 _provider_router 按延迟 / 错误率排序，失败自动切换
+    backends = []
+    if vision_api_key:
+        backends.append(("gemini", os.getenv("IMAGE_EDIT_MODEL", "gemini-3-pro-image-preview")))
+    if dashscope_api_key:
+        default_qwen = "qwen-image-edit-plus" if vision_api_key else os.getenv("IMAGE_EDIT_MODEL", "qwen-image-edit-plus")
+        backends.append(("dashscope", os.getenv("DASHSCOPE_IMAGE_EDIT_MODEL") or default_qwen))
+    if not backends:
         if impl.MultiModalConversation is None:
             raise HTTPException(status_code=500, detail="dashscope SDK not available on server")
-        api_key = os.getenv("DASHSCOPE_API_KEY")
-        if not api_key:
-            raise HTTPException(status_code=500, detail="Neither VISION_API_KEY nor DASHSCOPE_API_KEY configured")
-    else:
-        api_key = vision_api_key
-
-    payload = await image.read()
-    impl.logger.info("magic_edit received bytes=%d", len(payload or b""))
-    if not payload:
-        raise HTTPException(status_code=400, detail="No image payload")
-    original_local_path = impl._save_image_bytes(image.filename or "image.png", payload)
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=Path(image.filename or "image").suffix or ".png")
-    tmp.write(payload)
-    tmp.flush()
-    tmp.close()
-
-    try:
+        raise HTTPException(status_code=500, detail="Neither VISION_API_KEY nor DASHSCOPE_API_KEY configured")
+
+    original_local_path, image_name, payload = await impl._read_image_input(image, image_id)
+    impl.logger.info("magic_edit input=%s bytes=%s", Path(original_local_path).name, len(payload) if payload is not None else "cached")
+
+    # 已规范化（≤2048px）的模型输入按图片哈希缓存，引用同一 image_id 的后续步骤无需重新解码/编码
+    process_bin, input_fmt, input_mime, model_size = await impl._model_input_for(original_local_path, image_name, payload)
+    img_data = base64.b64encode(process_bin).decode("utf-8")
+
+    mask_data = None
+    mask_bin = None
+    if isinstance(mask_id, str) and mask_id.strip():
+        _mask_path, mask_bin = await run_in_threadpool(impl._read_image_handle, mask_id)
+    elif mask:
+        mask_bin = await mask.read()
+    mask_proc = None
+    if isinstance(mask_spec, str) and mask_spec.strip():
+        # 紧凑 mask（RLE / 笔画 JSON）：直接按模型输入尺寸栅格化，无需上传与解码整张 PNG；格式错误返回 400
+        mask_proc = await impl._run_image_job(impl.render_mask_spec, mask_spec.encode("utf-8"), "mask.json", model_size)
+        mask_data = base64.b64encode(mask_proc).decode("utf-8")
+    elif mask_bin:
         try:
-            img = impl._load_image_from_bytes(payload, image.filename or "image.bin")
-        except Exception:
-            from PIL import Image as _Image
-
-            img = _Image.open(tmp.name)
-        img = impl._resize_image_max(img, 2048)
-
-        ext = (Path(image.filename or "").suffix or "").lower()
-        raw_heic_exts = {".heic", ".heif", ".dng", ".raw", ".arw", ".cr2", ".nef", ".raf", ".orf", ".rw2"}
-        if ext in [".jpg", ".jpeg"] or ext in raw_heic_exts:
-            input_fmt = "jpeg"
-            input_mime = "image/jpeg"
-        else:
-            input_fmt = "png"
+            mask_proc = await impl._run_image_job(impl.render_mask, mask_bin, "mask.png", model_size)
+            mask_data = base64.b64encode(mask_proc).decode("utf-8")
+        except Exception as e:
+            impl.logger.warning("Failed to process mask: %s", e)
+
+    # 裁剪模式：只把 mask 外接框（加边距）内的图像与 mask 发给模型，结果羽化后贴回全分辨率原图
+    crop_box = None
+    if crop_to_mask and mask_proc and vision_api_key:
+        crop = await impl._run_image_job(impl.prepare_mask_crop, process_bin, "model_input", mask_proc, max(0, int(mask_padding)))
+        if crop is not None:
+            crop_img, crop_mask, crop_box = crop
+            img_data = base64.b64encode(crop_img).decode("utf-8")
+            mask_data = base64.b64encode(crop_mask).decode("utf-8")
             input_mime = "image/png"
+            impl.logger.info("magic_edit crop_to_mask box=%s model_size=%s", crop_box, model_size)
+
+    # 合并相同编辑请求的 key：按图片 / mask 哈希与参数计算，不序列化 base64 载荷，也不含 API key
+    image_digest = impl._image_digest(original_local_path)
+    mask_digest = hashlib.sha256(mask_proc).hexdigest() if mask_data and mask_proc else None
 
-        process_bin, _ = impl._pil_to_bytes(img, input_fmt, quality=90 if input_fmt == "jpeg" else None)
-        img_data = base64.b64encode(process_bin).decode("utf-8")
-
-        mask_data = None
-        if mask:
-            mask_bin = await mask.read()
-            if mask_bin:
-                try:
-                    mask_img = impl._load_image_from_bytes(mask_bin, "mask.png")
-                    mask_img = mask_img.resize(img.size)
-                    mask_proc, _ = impl._pil_to_bytes(mask_img, "png")
-                    mask_data = base64.b64encode(mask_proc).decode("utf-8")
-                except Exception as e:
-                    impl.logger.warning("Failed to process mask: %s", e)
+    # DashScope 不支持 mask：带 mask 的编辑只交给 Gemini
+    if mask_data and vision_api_key:
+        backends = [b for b in backends if b[0] == "gemini"]
 
+    async def edit_with_gemini(model: str):
         urls = []
         local_paths = []
+        impl.logger.info("使用 Google Gemini (Native/REST) 接口进行图片编辑: %s", model)
+
+        base_url = image_edit_endpoint.replace("/openai/", "") if image_edit_endpoint else "https://generativelanguage.googleapis.com/v1beta"
+        native_url = f"{base_url.rstrip('/')}/models/{model}:generateContent?key={vision_api_key}"
+
+        final_prompt = f"[Standard Quality Requirements]\n{impl.GEMINI_BASE_PROMPT}\n\n[User Specific Edit Instruction]\n{prompt}"
+        if mask_data:
+            final_prompt += "\n\nA mask image is provided as the second image. White areas are the ONLY regions to modify. Black areas must remain unchanged. Keep everything else identical."
+
+        print("\n" + "=" * 50)
+        print("FINAL PROMPT SENT TO GEMINI (MAGIC_EDIT):")
+        print(final_prompt)
+        print("=" * 50 + "\n")
+        impl.logger.info("FINAL PROMPT SENT TO GEMINI (MAGIC_EDIT): \n%s", final_prompt)
+
+        parts = [
+            {"text": final_prompt},
+            {"inline_data": {"mime_type": input_mime, "data": img_data}},
+        ]
+        if mask_data:
+            parts.append({"inline_data": {"mime_type": "image/png", "data": mask_data}})
+
+        payload_json = {
+            "contents": [{"parts": parts}],
+            "generationConfig": {"responseModalities": ["TEXT", "IMAGE"]},
+        }
+
+        if aspect_ratio or resolution:
+            image_config = {}
+            if aspect_ratio:
+                image_config["aspectRatio"] = aspect_ratio
+            if resolution:
+                image_config["imageSize"] = resolution
+            payload_json["generationConfig"]["imageConfig"] = image_config
+
+        impl.logger.info("发送请求到 Google Native API: %s (MIME: %s, Ratio: %s, Res: %s)", native_url, input_mime, aspect_ratio, resolution)
+        resp_google = await impl._run_upstream_coalesced(
+            impl.flight_key(
+                "magic_edit",
+                "gemini",
+                base_url,
+                model,
+                image_digest,
+                mask_digest,
+                prompt,
+                payload_json["generationConfig"],
+                {"crop_box": crop_box, "mask_padding": mask_padding if crop_box else None, "model_size": model_size, "mime": input_mime},
+            ),
+            impl._http_pool.post,
+            native_url,
+            upstream=("gemini", "generation", model),
+            endpoint=f"gemini.image.{model}",
+            json=payload_json,
+            timeout=90,
+        )
+
+        if resp_google.status_code == 200:
+            result = resp_google.json()
+            impl.logger.info("Google API 响应成功，正在解析内容...")
+            try:
+                candidates = result.get("candidates", [])
+                if not candidates:
+                    impl.logger.warning("Gemini 未返回任何候选结果。完整响应: %s", result)
+
+                for cand in candidates:
+                    finish_reason = cand.get("finishReason")
+                    if finish_reason and finish_reason != "STOP":
+                        impl.logger.warning("Gemini 任务未正常停止，原因: %s", finish_reason)
+
+                    parts = cand.get("content", {}).get("parts", [])
+                    if not parts:
+                        impl.logger.warning("Gemini 候选结果中没有 parts。候选内容: %s", cand)
+
+                    for part in parts:
+                        img_part = part.get("inline_data") or part.get("inlineData")
+                        if img_part:
+                            b64_out = img_part.get("data")
+                            if not b64_out:
+                                continue
+                            out_bytes = base64.b64decode(b64_out)
+
+                            mime_type = img_part.get("mime_type") or img_part.get("mimeType") or "image/png"
+                            if crop_box is not None:
+                                original_bin = payload if payload is not None else await run_in_threadpool(Path(original_local_path).read_bytes)
+                                out_bytes, mime_type = await impl._run_image_job(
+                                    impl.composite_mask_crop, original_bin, image_name, out_bytes, crop_mask, crop_box, model_size
+                                )
+                            ext = ".png"
+                            if mime_type and ("jpeg" in mime_type or "jpg" in mime_type):
+                                ext = ".jpg"
+
+                            step_str = f"_step{step}" if step is not None else ""
+                            out_filename = f"gen{step_str}{ext}"
+                            out_path = await run_in_threadpool(impl._save_image_bytes, out_filename, out_bytes)
+                            local_paths.append(out_path)
+
+                            # 根据请求Host构造URL（支持局域网访问）
+                            if request:
+                                host = request.headers.get('host', 'localhost:8000')
+                                if ':' not in host:
+                                    host = f'{host}:8000'
+                                base = f"http://{host}".rstrip("/")
+                            else:
+                                base = os.getenv("SERVER_BASE_URL", "http://localhost:8000").rstrip("/")
+                            urls.append(f"{base}/static/{Path(out_path).name}")
+                            impl.logger.info("成功提取并保存生成图像: %s", out_path)
+                        elif "file_data" in part or "fileData" in part:
+                            impl.logger.info("Gemini 返回了 file_data: %s", part.get("file_data") or part.get("fileData"))
+                        elif "text" in part:
+                            impl.logger.info("Gemini 返回文本消息: %s", part["text"])
+            except Exception as e:
+                impl.logger.error("解析 Gemini 返回数据失败: %s. 完整响应: %s", str(e), result)
+
+            size_used = size
+        else:
+            impl.logger.error("Google API 返回错误: %d %s", resp_google.status_code, resp_google.text)
+            raise HTTPException(status_code=resp_google.status_code, detail=f"Google API error: {resp_google.text}")
 
-        if vision_api_key:
-            impl.logger.info("使用 Google Gemini (Native/REST) 接口进行图片编辑: %s", model)
+        if not urls:
+            error_msg = "Google Gemini 未能生成图像。请检查提示词是否合规或模型是否支持此操作。"
+            if "result" in locals() and result.get("promptFeedback", {}).get("blockReason"):
+                error_msg = f"提示词被安全过滤拦截: {result['promptFeedback']['blockReason']}"
+            elif "result" in locals() and result.get("candidates") and result["candidates"][0].get("finishReason") == "SAFETY":
+                error_msg = "响应因安全策略被拦截。"
 
-            base_url = image_edit_endpoint.replace("/openai/", "") if image_edit_endpoint else "https://generativelanguage.googleapis.com/v1beta"
-            native_url = f"{base_url.rstrip('/')}/models/{model}:generateContent?key={vision_api_key}"
+            impl.logger.error(error_msg)
+            raise HTTPException(status_code=400, detail=error_msg)
+        return urls, local_paths, size_used
 
-            final_prompt = f"[Standard Quality Requirements]\n{impl.GEMINI_BASE_PROMPT}\n\n[User Specific Edit Instruction]\n{prompt}"
-            if mask_data:
-                final_prompt += "\n\nA mask image is provided as the second image. White areas are the ONLY regions to modify. Black areas must remain unchanged. Keep everything else identical."
+    async def edit_with_dashscope(model: str):
+        urls = []
+        fmt = input_fmt
+        mime = input_mime
+        b64 = img_data
+        data_url = f"data:{mime};base64,{b64}"
+        contents: list[dict] = [{"image": data_url}]
+        impl.logger.info("magic_edit prompt len=%d", len(prompt or ""))
+        print("magic_edit 提示词:", prompt)
+        if prompt:
+            contents.append({"text": prompt})
+        messages = [{"role": "user", "content": contents}]
+
+        kwargs = dict(
+            api_key=dashscope_api_key,
+            model=model,
+            messages=messages,
+            stream=False,
+            n=n,
+            watermark=watermark,
+            negative_prompt=negative_prompt or " ",
+            prompt_extend=prompt_extend,
+        )
+        size_used = impl._normalize_size_param(size, n)
+        if size_used:
+            kwargs["size"] = size_used
+
+        resp = await impl._run_upstream_coalesced(
+            impl.flight_key(
+                "magic_edit", "dashscope", {k: v for k, v in kwargs.items() if k not in ("api_key", "messages")}, image_digest, model_size, input_mime, prompt
+            ),
+            impl._call_guarded_sdk,
+            f"dashscope.image.{model}",
+            impl.MultiModalConversation.call,
+            upstream=("dashscope", "generation", model),
+            **kwargs,
+        )
+        if getattr(resp, "status_code", None) == 200:
+            try:
+                for c in resp.output.choices[0].message.content:
+                    if isinstance(c, dict) and c.get("image"):
+                        urls.append(c["image"])
+            except Exception:
+                pass
+        else:
+            impl.logger.error(
+                "magic_edit 非200 status=%s code=%s message=%s",
+                getattr(resp, "status_code", None),
+                getattr(resp, "code", None),
+                getattr(resp, "message", None),
+            )
+            raise HTTPException(status_code=getattr(resp, "status_code", 500), detail=getattr(resp, "message", "image edit failed"))
+        return urls, [], size_used
 
-            print("\n" + "=" * 50)
-            print("FINAL PROMPT SENT TO GEMINI (MAGIC_EDIT):")
-            print(final_prompt)
-            print("=" * 50 + "\n")
-            impl.logger.info("FINAL PROMPT SENT TO GEMINI (MAGIC_EDIT): \n%s", final_prompt)
+    async def edit_with(provider: str, model: str):
+        result = await (edit_with_gemini if provider == "gemini" else edit_with_dashscope)(model)
+        return provider, model, result
 
-            parts = [
-                {"text": final_prompt},
-                {"inline_data": {"mime_type": input_mime, "data": img_data}},
-            ]
-            if mask_data:
-                parts.append({"inline_data": {"mime_type": "image/png", "data": mask_data}})
+    provider, model, (urls, local_paths, size_used) = await impl._provider_router.arun("image_edit", backends, edit_with)
 
-            payload_json = {
-                "contents": [{"parts": parts}],
-                "generationConfig": {"responseModalities": ["TEXT", "IMAGE"]},
+    if urls:
+        try:
+            if provider == "dashscope":
+                for u in urls:
+                    p = await impl._run_upstream_coalesced(impl.flight_key("download", u), impl._download_and_save_image, u)
+                    if p:
+                        local_paths.append(p)
+
+            params = {
+                "model": model,
+                "n": n,
+                "size": size_used or size,
+                "watermark": watermark,
+                "negative_prompt": negative_prompt,
+                "prompt_extend": prompt_extend,
+                "endpoint": image_edit_endpoint or os.getenv("IMAGE_EDIT_ENDPOINT", "https://dashscope.aliyuncs.com/api/v1"),
+                "crop_box": list(crop_box) if crop_box else None,
             }
-
-            if aspect_ratio or resolution:
-                image_config = {}
-                if aspect_ratio:
-                    image_config["aspectRatio"] = aspect_ratio
-                if resolution:
-                    image_config["imageSize"] = resolution
-                payload_json["generationConfig"]["imageConfig"] = image_config
-
-            impl.logger.info("发送请求到 Google Native API: %s (MIME: %s, Ratio: %s, Res: %s)", native_url, input_mime, aspect_ratio, resolution)
-            resp_google = impl.requests.post(native_url, json=payload_json, timeout=90)
-
-            if resp_google.status_code == 200:
-                result = resp_google.json()
-                impl.logger.info("Google API 响应成功，正在解析内容...")
-                try:
-                    candidates = result.get("candidates", [])
-                    if not candidates:
-                        impl.logger.warning("Gemini 未返回任何候选结果。完整响应: %s", result)
-
-                    for cand in candidates:
-                        finish_reason = cand.get("finishReason")
-                        if finish_reason and finish_reason != "STOP":
-                            impl.logger.warning("Gemini 任务未正常停止，原因: %s", finish_reason)
-
-                        parts = cand.get("content", {}).get("parts", [])
-                        if not parts:
-                            impl.logger.warning("Gemini 候选结果中没有 parts。候选内容: %s", cand)
-
-                        for part in parts:
-                            img_part = part.get("inline_data") or part.get("inlineData")
-                            if img_part:
-                                b64_out = img_part.get("data")
-                                if not b64_out:
-                                    continue
-                                out_bytes = base64.b64decode(b64_out)
-
-                                mime_type = img_part.get("mime_type") or img_part.get("mimeType") or "image/png"
-                                ext = ".png"
-                                if mime_type and ("jpeg" in mime_type or "jpg" in mime_type):
-                                    ext = ".jpg"
-
-                                step_str = f"_step{step}" if step is not None else ""
-                                out_filename = f"gen{step_str}{ext}"
-                                out_path = impl._save_image_bytes(out_filename, out_bytes)
-                                local_paths.append(out_path)
-
-                                # 根据请求Host构造URL（支持局域网访问）
-                                if request:
-                                    host = request.headers.get('host', 'localhost:8000')
-                                    if ':' not in host:
-                                        host = f'{host}:8000'
-                                    base = f"http://{host}".rstrip("/")
-                                else:
-                                    base = os.getenv("SERVER_BASE_URL", "http://localhost:8000").rstrip("/")
-                                urls.append(f"{base}/static/{Path(out_path).name}")
-                                impl.logger.info("成功提取并保存生成图像: %s", out_path)
-                            elif "file_data" in part or "fileData" in part:
-                                impl.logger.info("Gemini 返回了 file_data: %s", part.get("file_data") or part.get("fileData"))
-                            elif "text" in part:
-                                impl.logger.info("Gemini 返回文本消息: %s", part["text"])
-                except Exception as e:
-                    impl.logger.error("解析 Gemini 返回数据失败: %s. 完整响应: %s", str(e), result)
-
-                size_used = size
-            else:
-                impl.logger.error("Google API 返回错误: %d %s", resp_google.status_code, resp_google.text)
-                raise HTTPException(status_code=resp_google.status_code, detail=f"Google API error: {resp_google.text}")
-
-            if not urls:
-                error_msg = "Google Gemini 未能生成图像。请检查提示词是否合规或模型是否支持此操作。"
-                if "result" in locals() and result.get("promptFeedback", {}).get("blockReason"):
-                    error_msg = f"提示词被安全过滤拦截: {result['promptFeedback']['blockReason']}"
-                elif "result" in locals() and result.get("candidates") and result["candidates"][0].get("finishReason") == "SAFETY":
-                    error_msg = "响应因安全策略被拦截。"
-
-                impl.logger.error(error_msg)
-                raise HTTPException(status_code=400, detail=error_msg)
-        else:
-            fmt = input_fmt
-            mime = input_mime
-            b64 = img_data
-            data_url = f"data:{mime};base64,{b64}"
-            contents: list[dict] = [{"image": data_url}]
-            impl.logger.info("magic_edit prompt len=%d", len(prompt or ""))
-            print("magic_edit 提示词:", prompt)
-            if prompt:
-                contents.append({"text": prompt})
-            messages = [{"role": "user", "content": contents}]
-
-            model = os.getenv("IMAGE_EDIT_MODEL", "qwen-image-edit-plus")
-            kwargs = dict(
-                api_key=api_key,
-                model=model,
-                messages=messages,
-                stream=False,
-                n=n,
-                watermark=watermark,
-                negative_prompt=negative_prompt or " ",
-                prompt_extend=prompt_extend,
+            steps = [{"text": prompt}] if prompt else []
+            events = [
+                {"level": "INFO", "message": "magic_edit 完成", "outputs": len(urls)},
+                {"level": "DEBUG", "message": "请求参数", "value": params},
+            ]
+            log_path = await run_in_threadpool(
+                impl._write_json_log,
+                "magic_edit",
+                original_local_path,
+                urls,
+                params,
+                steps,
+                prompt,
+                events,
+                local_output_paths=local_paths,
+            )
+            rec = await run_in_threadpool(
+                impl._insert_record,
+                prompt=prompt or "",
+                thinking=None,
+                image_path=original_local_path,
+                logs=log_path,
+                original_name=image.filename if image is not None else image_name,
+                raw_response=impl._safe_json_dump({"urls": urls}),
             )
-            size_used = impl._normalize_size_param(size, n)
-            if size_used:
-                kwargs["size"] = size_used
-
-            resp = impl.MultiModalConversation.call(**kwargs)
-            if getattr(resp, "status_code", None) == 200:
-                try:
-                    for c in resp.output.choices[0].message.content:
-                        if isinstance(c, dict) and c.get("image"):
-                            urls.append(c["image"])
-                except Exception:
-                    pass
-            else:
-                impl.logger.error(
-                    "magic_edit 非200 status=%s code=%s message=%s",
-                    getattr(resp, "status_code", None),
-                    getattr(resp, "code", None),
-                    getattr(resp, "message", None),
-                )
-                raise HTTPException(status_code=getattr(resp, "status_code", 500), detail=getattr(resp, "message", "image edit failed"))
-
-        if urls:
             try:
-                if not vision_api_key:
-                    for u in urls:
-                        p = impl._download_and_save_image(u)
-                        if p:
-                            local_paths.append(p)
-
-                params = {
-                    "model": model,
-                    "n": n,
-                    "size": size_used or size,
-                    "watermark": watermark,
-                    "negative_prompt": negative_prompt,
-                    "prompt_extend": prompt_extend,
-                    "endpoint": image_edit_endpoint or os.getenv("IMAGE_EDIT_ENDPOINT", "https://dashscope.aliyuncs.com/api/v1"),
-                }
-                steps = [{"text": prompt}] if prompt else []
-                events = [
-                    {"level": "INFO", "message": "magic_edit 完成", "outputs": len(urls)},
-                    {"level": "DEBUG", "message": "请求参数", "value": params},
-                ]
-                log_path = impl._write_json_log(
-                    "magic_edit",
-                    original_local_path,
-                    urls,
-                    params,
-                    steps,
-                    prompt,
-                    events,
-                    local_output_paths=local_paths,
-                )
-                rec = impl._insert_record(
-                    prompt=prompt or "",
-                    thinking=None,
-                    image_path=original_local_path,
-                    logs=log_path,
-                    original_name=image.filename,
-                    raw_response=impl._safe_json_dump({"urls": urls}),
-                )
-                try:
-                    impl._insert_record_image(record_id=rec.id, kind="input", image_path=original_local_path)
-                except Exception:
-                    pass
-                try:
-                    if local_paths:
-                        if len(local_paths) == 1:
-                            impl._insert_record_image(record_id=rec.id, kind="final", image_path=local_paths[0])
-                        else:
-                            for p in local_paths[:-1]:
-                                impl._insert_record_image(record_id=rec.id, kind="intermediate", image_path=p)
-                            impl._insert_record_image(record_id=rec.id, kind="final", image_path=local_paths[-1])
-                except Exception as exc:
-                    impl.logger.warning("保存输出图片记录失败: %s", exc)
-            except Exception as exc:
-                impl.logger.warning("magic_edit 写日志失败: %s", exc)
+                await run_in_threadpool(impl._insert_record_image, record_id=rec.id, kind="input", image_path=original_local_path)
+            except Exception:
+                pass
             try:
-                served_urls: list[str] = []
                 if local_paths:
-                    # 根据请求Host构造URL（支持局域网访问）
-                    if request:
-                        host = request.headers.get('host', 'localhost:8000')
-                        if ':' not in host:
-                            host = f'{host}:8000'
-                        base = f"http://{host}".rstrip("/")
+                    if len(local_paths) == 1:
+                        await run_in_threadpool(impl._insert_record_image, record_id=rec.id, kind="final", image_path=local_paths[0])
                     else:
-                        base = os.getenv("SERVER_BASE_URL", "http://localhost:8000").rstrip("/")
-                    served_urls = [f"{base}/static/{Path(p).name}" for p in local_paths]
-                else:
-                    served_urls = urls
-                return {"urls": served_urls}
-            except Exception:
-                return {"urls": urls}
-
-        raise HTTPException(status_code=502, detail="Model returned no image URLs")
-
-    finally:
+                        for p in local_paths[:-1]:
+                            await run_in_threadpool(impl._insert_record_image, record_id=rec.id, kind="intermediate", image_path=p)
+                        await run_in_threadpool(impl._insert_record_image, record_id=rec.id, kind="final", image_path=local_paths[-1])
+            except Exception as exc:
+                impl.logger.warning("保存输出图片记录失败: %s", exc)
+        except Exception as exc:
+            impl.logger.warning("magic_edit 写日志失败: %s", exc)
         try:
-            os.unlink(tmp.name)
+            served_urls: list[str] = []
+            if local_paths:
+                # 根据请求Host构造URL（支持局域网访问）
+                if request:
+                    host = request.headers.get('host', 'localhost:8000')
+                    if ':' not in host:
+                        host = f'{host}:8000'
+                    base = f"http://{host}".rstrip("/")
+                else:
+                    base = os.getenv("SERVER_BASE_URL", "http://localhost:8000").rstrip("/")
+                served_urls = [f"{base}/static/{Path(p).name}" for p in local_paths]
+            else:
+                served_urls = urls
+            return {"urls": served_urls}
         except Exception:
-            pass
+            return {"urls": urls}
+
+    raise HTTPException(status_code=502, detail="Model returned no image URLs")
@@ -1,9 +1,12 @@
 from __future__ import annotations
 
 import io
+from pathlib import Path
+from typing import Optional
 
-from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile
-from starlette.responses import StreamingResponse
+from fastapi import APIRouter, Depends, File, Form, HTTPException, Request, UploadFile
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, StreamingResponse
 
 import server as impl
 
@@ -11,23 +14,51 @@ router = APIRouter()
 
 
 @router.post("/preview")
-async def preview(image: UploadFile = File(...), _auth: None = Depends(impl.require_api_auth)):
+async def preview(request: Request, image: UploadFile = File(...), _auth: None = Depends(impl.require_api_auth)):
     payload = await image.read()
     if not payload:
         raise HTTPException(status_code=400, detail="No image payload")
-    img = impl._load_image_from_bytes(payload, image.filename or "image.bin")
+    return await impl._cached_derivative(request, payload, image.filename or "image.bin", "preview", {"max_side": 1600}, ".png", impl.render_preview, 1600)
+
+
+@router.post("/images")
+async def upload_image(
+    image: Optional[UploadFile] = File(None),
+    ref: Optional[str] = Form(None),
+    _auth: None = Depends(impl.require_api_auth),
+):
+    """Store an image once and return a reusable ``image_id``.
+
+    ``ref`` registers an existing ``/static/...`` output (e.g. the previous
+    magic_edit step) without uploading it again.
+    """
+    if isinstance(ref, str) and ref.strip():
+        p = await run_in_threadpool(impl._resolve_image_handle, ref)
+    else:
+        p = Path((await impl._read_image_input(image, None))[0])
+    width = height = None
     try:
-        img.thumbnail((1600, 1600))
+        from PIL import Image as _Image
+
+        with _Image.open(p) as probe:
+            width, height = probe.size
     except Exception:
         pass
-    data, mime = impl._pil_to_bytes(img, "png")
-    return StreamingResponse(io.BytesIO(data), media_type=mime, headers={"Cache-Control": "no-cache"})
+    return {
+        "image_id": p.name,
+        "url": f"/static/{p.name}",
+        "size_bytes": p.stat().st_size,
+        "width": width,
+        "height": height,
+    }
 
 
 @router.post("/convert")
 async def convert(
+    request: Request,
     _auth: None = Depends(impl.require_api_auth),
-    image: UploadFile = File(...),
+    image: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
     format: str = Form("jpeg"),
     quality: int = Form(90),
     compression: int = Form(6),
@@ -41,56 +72,23 @@ async def convert(
     wm_opacity: float = Form(0.0),
     wm_size: int = Form(24),
 ):
-    payload = await image.read()
+    digest = None
+    if isinstance(image_id, str) and image_id.strip():
+        src, payload = await run_in_threadpool(impl._read_image_handle, image_id)
+        filename = src.name
+        digest = impl._blob_store.owns(src)
+    else:
+        if image is None:
+            raise HTTPException(status_code=400, detail="image or image_id is required")
+        payload, filename = await image.read(), image.filename or "image.bin"
     if not payload:
         raise HTTPException(status_code=400, detail="No image payload")
-    img = impl._load_image_from_bytes(payload, image.filename or "image.bin")
-    try:
-        if resize_w and resize_h and resize_w > 0 and resize_h > 0:
-            img = img.resize((int(resize_w), int(resize_h)))
-    except Exception:
-        pass
-    try:
-        col = (color or "RGB").upper()
-        if col == "GRAY":
-            img = img.convert("L")
-        else:
-            img = img.convert("RGB")
-    except Exception:
-        pass
-
-    try:
-        txt = (wm_text or "").strip()
-        pos = (wm_pos or "BR").upper()
-        op = float(wm_opacity or 0.0)
-        sz = int(wm_size or 24)
-        if txt and op > 0:
-            from PIL import Image, ImageDraw, ImageFont
-
-            base = img.convert("RGBA")
-            layer = Image.new("RGBA", base.size, (0, 0, 0, 0))
-            d = ImageDraw.Draw(layer)
-            try:
-                fnt = ImageFont.truetype("arial.ttf", sz)
-            except Exception:
-                from PIL import ImageFont as _IF
-
-                fnt = _IF.load_default()
-            tw, th = d.textsize(txt, font=fnt)
-            margin = max(8, sz // 2)
-            if pos == "TL":
-                x = margin
-                y = margin
-            else:
-                x = base.size[0] - tw - margin
-                y = base.size[1] - th - margin
-            bg = int(255 * op * 0.6)
-            fg = int(255 * op)
-            d.rectangle([x - 6, y - 4, x + tw + 6, y + th + 4], fill=(0, 0, 0, bg))
-            d.text((x, y), txt, font=fnt, fill=(255, 255, 255, fg))
-            img = Image.alpha_composite(base, layer).convert("RGB")
-    except Exception:
-        pass
+    fmt = (format or "jpeg").lower()
+    ext = impl.OUTPUT_FORMAT_EXTS.get(fmt)
+    if ext is None:
+        raise HTTPException(status_code=400, detail="Unsupported output format")
+    target = (int(resize_w), int(resize_h)) if resize_w and resize_h and resize_w > 0 and resize_h > 0 else None
+    wm = {"text": (wm_text or "").strip(), "pos": (wm_pos or "BR").upper(), "opacity": float(wm_opacity or 0.0), "size": int(wm_size or 24)}
 
     extra = {}
     try:
@@ -118,8 +116,44 @@ async def convert(
         except Exception:
             pass
 
-    data, mime = impl._pil_to_bytes(img, format.lower(), quality, compression, extra_info=extra)
-    return StreamingResponse(io.BytesIO(data), media_type=mime, headers={"Cache-Control": "no-cache"})
+    params = {
+        "format": fmt,
+        "quality": int(quality or 0),
+        "compression": int(compression or 0),
+        "size": target,
+        "color": (color or "RGB").upper(),
+        "watermark": wm,
+        "extra": extra,
+    }
+    return await impl._cached_derivative(
+        request,
+        payload,
+        filename,
+        "convert",
+        params,
+        ext,
+        impl.render_convert,
+        fmt,
+        quality,
+        compression,
+        size=target,
+        color=color,
+        watermark=wm,
+        extra_info=extra,
+        digest=digest,
+    )
+
+
+# 与 /static 一样不鉴权：地址由内容哈希构成，且需要能被 <img> / 瓦片查看器直接加载
+@router.get("/tiles/{image}/info.json")
+async def tile_info(image: str):
+    return await impl._tile_info(image)
+
+
+@router.get("/tiles/{image}/{z}/{x}_{y}.webp")
+async def tile(image: str, z: int, x: int, y: int):
+    path = await impl._tile_file(image, z, x, y)
+    return FileResponse(path, media_type="image/webp", headers={"Cache-Control": impl.IMMUTABLE_CACHE_CONTROL})
 
 
 @router.get("/proxy_image")
@@ -127,7 +161,7 @@ def proxy_image(url: str, _auth: None = Depends(impl.require_api_auth)):
     if not isinstance(url, str) or not url.lower().startswith(("http://", "https://")):
         raise HTTPException(status_code=400, detail="invalid url")
     try:
-        r = impl.requests.get(url, timeout=30)
+        r = impl._http_pool.get(url, timeout=30)
         if r.status_code != 200:
             raise HTTPException(status_code=502, detail=f"fetch failed {r.status_code}")
         ct = r.headers.get("content-type") or "application/octet-stream"
@@ -0,0 +1,12 @@
+from __future__ import annotations
+
+from fastapi import APIRouter, Depends
+
+import server as impl
+
+router = APIRouter(dependencies=[Depends(impl.require_api_auth)])
+
+
+@router.get("/metrics")
+def get_metrics():
+    return impl.metrics.snapshot()
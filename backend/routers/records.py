@@ -3,6 +3,7 @@ from __future__ import annotations
 from typing import Optional
 
 from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
 
 import server as impl
 
@@ -20,8 +21,9 @@ async def create_record(
     original_name: Optional[str] = Form(None),
 ):
     payload = await image.read()
-    image_path = impl._save_image_bytes(image.filename or "image.png", payload)
-    record = impl._insert_record(
+    image_path = await run_in_threadpool(impl._save_image_bytes, image.filename or "image.png", payload)
+    record = await run_in_threadpool(
+        impl._insert_record,
         prompt=prompt or "",
         thinking=thinking,
         image_path=image_path,
@@ -29,15 +31,15 @@ async def create_record(
         original_name=original_name or image.filename,
         raw_response=raw_response,
     )
-    impl._insert_record_image(record_id=record.id, kind="input", image_path=image_path)
+    await run_in_threadpool(impl._insert_record_image, record_id=record.id, kind="input", image_path=image_path)
     return record
 
 
-@router.get("/records", response_model=impl.RecordListResponse)
-def list_records(limit: int = 50, offset: int = 0):
+@router.get("/records", response_model=impl.RecordListResponse, response_model_exclude_unset=True)
+def list_records(limit: int = 50, offset: int = 0, after: Optional[str] = None, fields: Optional[str] = None):
     limit = max(1, min(limit, 200))
     offset = max(0, offset)
-    return impl._list_records(limit=limit, offset=offset)
+    return impl._list_records(limit=limit, offset=offset, after=after, fields=fields)
 
 
 @router.get("/records/{record_id}", response_model=impl.RecordDetailModel)
@@ -68,6 +70,6 @@ async def upload_record_image(
     if not impl._get_record(record_id):
         raise HTTPException(status_code=404, detail=f"record {record_id} not found")
     payload = await image.read()
-    image_path = impl._save_image_bytes(image.filename or "image.png", payload)
-    record_image = impl._insert_record_image(record_id=record_id, kind=kind, image_path=image_path)
+    image_path = await run_in_threadpool(impl._save_image_bytes, image.filename or "image.png", payload)
+    record_image = await run_in_threadpool(impl._insert_record_image, record_id=record_id, kind=kind, image_path=image_path)
     return record_image
@@ -1,15 +1,14 @@
 from __future__ import annotations
 
-import asyncio
 import base64
 import json
 import os
-import tempfile
-import threading
+import time
 from pathlib import Path
 from typing import Optional
 
-from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile
+from fastapi import APIRouter, Depends, File, Form, HTTPException, Request, UploadFile
+from starlette.concurrency import run_in_threadpool
 from starlette.responses import StreamingResponse
 
 import server as impl
@@ -18,31 +17,38 @@ router = APIRouter(dependencies=[Depends(impl.require_api_auth)])
 
 
 @router.post("/smart/start", response_model=impl.SmartSessionStartResponse)
-async def smart_start(image: UploadFile = File(...), message: str = Form("")):
-    payload = await image.read()
-    if not payload:
-        raise HTTPException(status_code=400, detail="No image payload")
-    saved_image_path = impl._save_image_bytes(image.filename or "image.png", payload)
+async def smart_start(
+    image: Optional[UploadFile] = File(None),
+    message: str = Form(""),
+    image_id: Optional[str] = Form(None),
+    no_cache: bool = Form(False),
+):
+    saved_image_path, image_name, _payload = await impl._read_image_input(image, image_id)
+    original_name = image.filename if image is not None else image_name
 
     record_id: Optional[int] = None
     try:
-        rec = impl._insert_record(
+        rec = await run_in_threadpool(
+            impl._insert_record,
             prompt=(message or "").strip(),
             thinking=None,
             image_path=saved_image_path,
             logs=None,
-            original_name=image.filename,
+            original_name=original_name,
             raw_response=None,
         )
         record_id = rec.id
         try:
-            impl._insert_record_image(record_id=rec.id, kind="input", image_path=saved_image_path)
+            await run_in_threadpool(impl._insert_record_image, record_id=rec.id, kind="input", image_path=saved_image_path)
         except Exception:
             pass
     except Exception as exc:
         impl.logger.warning("smart_start create record failed: %s", exc)
 
-    facts = impl._analyze_image_facts_best_effort(saved_image_path, user_prompt=message or "")
+    facts = await impl._singleflight.do(
+        impl.flight_key("smart_facts", impl._image_digest(saved_image_path), message or "", bool(no_cache)),
+        lambda: impl._analyze_image_facts_best_effort(saved_image_path, user_prompt=message or "", use_cache=not no_cache),
+    )
     spec = impl._default_spec(facts, message or "")
 
     selected, candidates = impl._route_templates(spec, facts)
@@ -55,7 +61,15 @@ async def smart_start(image: UploadFile = File(...), message: str = Form("")):
     llm_selected = None
     if impl._get_gemini_api_key():
         try:
-            patch, questions, llm_selected = impl._llm_clarify_next(spec, facts, messages, candidates)
+            patch, questions, llm_selected = await impl._run_upstream_coalesced(
+                impl.flight_key("smart_clarify", spec, facts, messages, candidates),
+                impl._llm_clarify_next,
+                spec,
+                facts,
+                messages,
+                candidates,
+                upstream=("gemini", "analysis", os.getenv("SMART_LLM_MODEL", "gemini-2.0-flash")),
+            )
         except Exception as exc:
             impl.logger.warning("smart_start llm_clarify failed: %s", exc)
 
@@ -83,13 +97,13 @@ async def smart_start(image: UploadFile = File(...), message: str = Form("")):
 
     status = "ready" if (not questions and impl._is_ready_to_render(spec, selected)) else "needs_input"
 
-    session_id = impl._insert_smart_session(saved_image_path, image.filename, spec, facts, status=status, record_id=record_id)
+    session_id = await run_in_threadpool(impl._insert_smart_session, saved_image_path, original_name, spec, facts, status=status, record_id=record_id)
     try:
         if isinstance(message, str) and message.strip():
-            impl._add_smart_session_message(session_id, "user", message.strip())
+            await run_in_threadpool(impl._add_smart_session_message, session_id, "user", message.strip())
     except Exception:
         pass
-    impl._update_smart_session(session_id, template_selected=selected, template_candidates=candidates, status=status)
+    await run_in_threadpool(impl._update_smart_session, session_id, template_selected=selected, template_candidates=candidates, status=status)
 
     prompt_preview = None
     if status == "ready":
@@ -98,7 +112,8 @@ async def smart_start(image: UploadFile = File(...), message: str = Form("")):
         except Exception:
             prompt_preview = None
 
-    log_path = impl._write_json_log(
+    log_path = await run_in_threadpool(
+        impl._write_json_log,
         "smart_start",
         saved_image_path,
         [],
@@ -119,7 +134,7 @@ async def smart_start(image: UploadFile = File(...), message: str = Form("")):
     )
     if record_id:
         try:
-            impl._update_record_logs(record_id, log_path)
+            await run_in_threadpool(impl._update_record_logs, record_id, log_path)
         except Exception:
             pass
 
@@ -140,58 +155,93 @@ async def smart_start(image: UploadFile = File(...), message: str = Form("")):
 
 
 @router.post("/smart/start_stream")
-async def smart_start_stream(image: UploadFile = File(...), message: str = Form("")):
-    payload = await image.read()
-    if not payload:
-        raise HTTPException(status_code=400, detail="No image payload")
-    saved_image_path = impl._save_image_bytes(image.filename or "image.png", payload)
+async def smart_start_stream(
+    request: Request,
+    image: Optional[UploadFile] = File(None),
+    message: str = Form(""),
+    image_id: Optional[str] = Form(None),
+    no_cache: bool = Form(False),
+):
+    impl._check_stream_capacity()
+    saved_image_path, image_name, _payload = await impl._read_image_input(image, image_id)
+    original_name = image.filename if image is not None else image_name
+
+    stream_key = impl.flight_key("smart_start_stream", impl._image_digest(saved_image_path), message or "", bool(no_cache))
+    flight = impl._sse_flights.join(stream_key)
+    if flight is not None:
+        impl.logger.info("smart_start_stream 合并到进行中的相同请求")
+        return StreamingResponse(impl._sse_stream(flight, request), media_type="text/event-stream", headers=impl.SSE_HEADERS)
+    flight = impl._sse_flights.start(stream_key)
+    slot = impl._reserve_stream_worker(flight)
 
     record_id: Optional[int] = None
     try:
-        rec = impl._insert_record(
-            prompt=(message or "").strip(),
-            thinking=None,
-            image_path=saved_image_path,
-            logs=None,
-            original_name=image.filename,
-            raw_response=None,
-        )
-        record_id = rec.id
         try:
-            impl._insert_record_image(record_id=rec.id, kind="input", image_path=saved_image_path)
-        except Exception:
-            pass
-    except Exception as exc:
-        impl.logger.warning("smart_start_stream create record failed: %s", exc)
-
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-    tmp.write(payload)
-    tmp.flush()
-    tmp.close()
+            rec = await run_in_threadpool(
+                impl._insert_record,
+                prompt=(message or "").strip(),
+                thinking=None,
+                image_path=saved_image_path,
+                logs=None,
+                original_name=original_name,
+                raw_response=None,
+            )
+            record_id = rec.id
+            try:
+                await run_in_threadpool(impl._insert_record_image, record_id=rec.id, kind="input", image_path=saved_image_path)
+            except Exception:
+                pass
+        except Exception as exc:
+            impl.logger.warning("smart_start_stream create record failed: %s", exc)
+    except BaseException:
+        # 请求在入库期间被取消：归还预留的工作线程并结束 flight，否则合并进来的相同请求会一直挂起
+        slot.release()
+        flight.close()
+        raise
 
     base_url = os.getenv("DASHSCOPE_COMPAT_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
     api_key = os.getenv("DASHSCOPE_API_KEY")
 
-    async def gen():
-        queue: asyncio.Queue = asyncio.Queue()
-        loop = asyncio.get_running_loop()
-        buffer = ""
-        sent = 0
-        sent_ids: set = set()
-
-        def push(evt: dict):
-            try:
-                asyncio.run_coroutine_threadsafe(queue.put(evt), loop)
-            except Exception as exc:
-                impl.logger.warning("smart_start_stream push 失败: %s", exc)
-
-        def worker():
-            fallback_result = None
-            try:
-                from openai import OpenAI
-
-                client = OpenAI(api_key=api_key, base_url=base_url)
-                with open(tmp.name, "rb") as f:
+    parser = impl.AnalysisStreamParser()
+    sent = 0
+    sent_ids: set = set()
+
+    def push(evt: dict):
+        flight.publish(evt)
+
+    def handle_text(c: str):
+        nonlocal sent
+        for key, it in parser.feed(c):
+            if key != impl.STREAM_ITEMS_KEY:
+                push({"type": "section", "key": key, "value": it})
+                continue
+            impl.logger.info("smart_start_stream 提取项 序号=%d 类别=%s 类型=%s", sent + 1, it.get("category"), it.get("type"))
+            sent += 1
+            ui = {"professional_analysis": [it]}
+            plans = impl._parse_ui_to_plan_items(ui)
+            for p in plans:
+                pid = p.get("id")
+                if pid and pid in sent_ids:
+                    continue
+                if pid:
+                    sent_ids.add(pid)
+                push({"type": "item", "item": p})
+
+    def worker():
+        fallback_result = None
+        started = time.monotonic()
+        chunks = 0
+        fallback_skipped = False
+        cache_key = impl._analysis_cache_key(saved_image_path, message or "", impl.QWEN_STREAM_MODEL, not no_cache)
+        cached = impl._analysis_cache.get(cache_key) if cache_key else None
+        try:
+            if cached is not None:
+                # 命中缓存：按原样回放，事件序列与实时流一致
+                impl.logger.info("smart_start_stream 命中分析缓存")
+                handle_text(json.dumps(cached, ensure_ascii=False))
+            else:
+                client = impl._http_pool.openai_client(api_key, base_url)
+                with open(saved_image_path, "rb") as f:
                     b64 = base64.b64encode(f.read()).decode("utf-8")
                 data_url = f"data:image/jpeg;base64,{b64}"
                 messages = [
@@ -203,229 +253,241 @@ async def smart_start_stream(image: UploadFile = File(...), message: str = Form(
                         ],
                     }
                 ]
-                resp = client.chat.completions.create(
-                    model="qwen3-vl-plus",
-                    messages=messages,
-                    stream=True,
-                    temperature=0.1,
-                    top_p=0.1,
-                    extra_body={"enable_thinking": False, "thinking_budget": 81920},
-                )
-                impl.logger.info("smart_start_stream 连接建立，开始流式分析")
-                for chunk in resp:
-                    try:
-                        delta = chunk.choices[0].delta
-                        if delta and getattr(delta, "content", None):
-                            c = delta.content
-                            if c:
-                                if os.getenv("SSE_LOG_CHUNK", "0") == "1":
-                                    impl.logger.info("smart_start_stream chunk 长度=%d", len(c))
-                                if os.getenv("SSE_LOG_TEXT", "0") == "1":
-                                    impl.logger.info("%s", c)
-                            nonlocal buffer, sent
-                            buffer += c
-                            new_items = impl._extract_professional_items(buffer, sent)
-                            for it in new_items:
-                                impl.logger.info("smart_start_stream 提取项 序号=%d 类别=%s 类型=%s", sent + 1, it.get("category"), it.get("type"))
-                                sent += 1
-                                ui = {"professional_analysis": [it]}
-                                plans = impl._parse_ui_to_plan_items(ui)
-                                for p in plans:
-                                    pid = p.get("id")
-                                    if pid and pid in sent_ids:
-                                        continue
-                                    if pid:
-                                        sent_ids.add(pid)
-                                    push({"type": "item", "item": p})
-                    except Exception:
-                        continue
-            except Exception as e:
-                impl.logger.warning("smart_start_stream 流式调用失败: %s", e)
-                try:
-                    fallback_result = impl.analyze_image_with_qwen3_vl_plus(
-                        tmp.name, user_prompt=message or "", stream_output=False, enable_thinking=True
+                # 占用 dashscope 分析通道的并发 / 限速配额，直到流结束
+                with impl._upstream_slot_sync("dashscope", "analysis", impl.QWEN_STREAM_MODEL, cancel=flight.cancelled):
+                    # 排队期间客户端可能已全部断开：拿到配额后先检查，再建立上游流
+                    flight.raise_if_cancelled()
+                    resp = client.chat.completions.create(
+                        model=impl.QWEN_STREAM_MODEL,
+                        messages=messages,
+                        stream=True,
+                        temperature=0.1,
+                        top_p=0.1,
+                        extra_body={"enable_thinking": False, "thinking_budget": 81920},
                     )
+                    impl.logger.info("smart_start_stream 连接建立，开始流式分析")
+                    for chunk in resp:
+                        if flight.cancelled.is_set():
+                            # 所有客户端已断开：关闭上游连接，不再消耗 token
+                            if hasattr(resp, "close"):
+                                resp.close()
+                            break
+                        try:
+                            delta = chunk.choices[0].delta
+                            if delta and getattr(delta, "content", None):
+                                c = delta.content
+                                if c:
+                                    if os.getenv("SSE_LOG_CHUNK", "0") == "1":
+                                        impl.logger.info("smart_start_stream chunk 长度=%d", len(c))
+                                    if os.getenv("SSE_LOG_TEXT", "0") == "1":
+                                        impl.logger.info("%s", c)
+                                chunks += 1
+                                handle_text(c)
+                        except Exception:
+                            continue
+                    if not flight.cancelled.is_set():
+                        impl._stream_cost.completed("smart_start_stream", time.monotonic() - started, chunks)
+        except (impl.FlightCancelled, impl.SlotCancelled):
+            pass
+        except Exception as e:
+            impl.logger.warning("smart_start_stream 流式调用失败: %s", e)
+            if flight.cancelled.is_set():
+                fallback_skipped = True
+            else:
+                try:
+                    with impl._upstream_slot_sync("dashscope", "analysis", impl.QWEN_ANALYZE_MODEL, cancel=flight.cancelled):
+                        flight.raise_if_cancelled()
+                        fallback_result = impl.analyze_image_with_qwen3_vl_plus(
+                            saved_image_path, user_prompt=message or "", stream_output=False, enable_thinking=True, use_cache=not no_cache
+                        )
                     impl.logger.info("smart_start_stream 回退分析完成")
+                except (impl.FlightCancelled, impl.SlotCancelled):
+                    fallback_skipped = True
                 except Exception as e2:
                     impl.logger.warning("smart_start_stream 回退调用失败: %s", e2)
+        if flight.cancelled.is_set():
+            # 客户端全部断开：跳过回退分析、记录保存与 JSON 日志
+            impl.logger.info("smart_start_stream 客户端已断开，取消分析 chunks=%d", chunks)
+            if cached is None:
+                impl._stream_cost.cancelled("smart_start_stream", time.monotonic() - started, chunks, fallback_skipped)
+            flight.close()
+            return
 
+        try:
+            cleaned = parser.text().strip()
+            if cleaned.startswith("```json"):
+                cleaned = cleaned[7:]
+            if cleaned.endswith("```"):
+                cleaned = cleaned[:-3]
+            data = json.loads(cleaned) if cleaned else {}
+            if cache_key and cached is None and isinstance(data, dict) and data:
+                impl._analysis_cache.put(cache_key, impl.QWEN_STREAM_MODEL, data)
+            if not isinstance(data, dict) or (isinstance(data, dict) and not data):
+                if isinstance(fallback_result, dict):
+                    data = fallback_result
+
+            ui = data.get("ui_analysis") if isinstance(data, dict) else None
+            final_plans = []
+            if isinstance(ui, dict):
+                final_plans = impl._parse_ui_to_plan_items(ui)
+                for p in final_plans:
+                    pid = p.get("id")
+                    if pid and pid in sent_ids:
+                        continue
+                    if pid:
+                        sent_ids.add(pid)
+                    push({"type": "item", "item": p})
+
+            summary = ""
+            if isinstance(data, dict):
+                summary = data.get("summary_ui") or data.get("summary") or ""
+            if not summary and isinstance(ui, dict):
+                summary = ui.get("summary_ui") or ""
+            if not summary and isinstance(fallback_result, dict):
+                fu = fallback_result.get("ui_analysis") if isinstance(fallback_result, dict) else None
+                summary = fallback_result.get("summary_ui") or fallback_result.get("summary") or ((fu or {}).get("summary_ui") or "")
+            summary = impl.sanitize_summary_ui(summary or "")
+            final_evt = {"type": "final", "summary": summary}
+            if cached is not None:
+                final_evt["cached"] = True
+            push(final_evt)
+
+            facts: dict = {}
             try:
-                cleaned = buffer.strip()
-                if cleaned.startswith("```json"):
-                    cleaned = cleaned[7:]
-                if cleaned.endswith("```"):
-                    cleaned = cleaned[:-3]
-                data = json.loads(cleaned) if cleaned else {}
-                if not isinstance(data, dict) or (isinstance(data, dict) and not data):
-                    if isinstance(fallback_result, dict):
-                        data = fallback_result
-
-                ui = data.get("ui_analysis") if isinstance(data, dict) else None
-                final_plans = []
-                if isinstance(ui, dict):
-                    final_plans = impl._parse_ui_to_plan_items(ui)
-                    for p in final_plans:
-                        pid = p.get("id")
-                        if pid and pid in sent_ids:
-                            continue
-                        if pid:
-                            sent_ids.add(pid)
-                        push({"type": "item", "item": p})
-
-                summary = ""
-                if isinstance(data, dict):
-                    summary = data.get("summary_ui") or data.get("summary") or ""
-                if not summary and isinstance(ui, dict):
-                    summary = ui.get("summary_ui") or ""
-                if not summary and isinstance(fallback_result, dict):
-                    fu = fallback_result.get("ui_analysis") if isinstance(fallback_result, dict) else None
-                    summary = fallback_result.get("summary_ui") or fallback_result.get("summary") or ((fu or {}).get("summary_ui") or "")
-                summary = impl.sanitize_summary_ui(summary or "")
-                push({"type": "final", "summary": summary})
-
-                facts: dict = {}
-                try:
-                    from PIL import Image as _Image
+                from PIL import Image as _Image
 
-                    img = _Image.open(saved_image_path)
-                    w, h = img.size
-                    facts.update(
+                img = _Image.open(saved_image_path)
+                w, h = img.size
+                facts.update(
+                    {
+                        "width": int(w),
+                        "height": int(h),
+                        "orientation": "landscape" if w >= h else "portrait",
+                        "aspect_ratio": impl._best_aspect_ratio(w, h),
+                    }
+                )
+            except Exception:
+                pass
+            if isinstance(ui, dict):
+                facts.update(impl._extract_image_facts_from_ui(ui))
+                facts["analysis_summary"] = summary
+                if ui.get("filter_recommendations"):
+                    facts["filter_recommendations"] = ui.get("filter_recommendations")
+
+            spec = impl._default_spec(facts, message or "")
+            selected, candidates = impl._route_templates(spec, facts)
+            messages = []
+            if isinstance(message, str) and message.strip():
+                messages.append({"role": "user", "content": message.strip()})
+
+            patch = {}
+            questions = []
+            llm_selected = None
+            if impl._get_gemini_api_key():
+                try:
+                    # 与 smart_start / smart_answer 一样占用 gemini 分析通道的配额
+                    with impl._upstream_slot_sync("gemini", "analysis", os.getenv("SMART_LLM_MODEL", "gemini-2.0-flash"), cancel=flight.cancelled):
+                        flight.raise_if_cancelled()
+                        patch, questions, llm_selected = impl._llm_clarify_next(spec, facts, messages, candidates)
+                except (impl.FlightCancelled, impl.SlotCancelled):
+                    pass
+                except Exception as exc:
+                    impl.logger.warning("smart_start_stream llm_clarify failed: %s", exc)
+
+            spec = impl._deep_merge(spec, patch or {})
+            selected, candidates = impl._route_templates(spec, facts)
+            if llm_selected and any(c.get("template") == llm_selected for c in candidates if isinstance(c, dict)):
+                selected = llm_selected
+
+            if not questions:
+                if selected == "text_design" and not ((spec.get("text_overlay") or {}).get("content") or ""):
+                    questions = [{"id": "q_text", "text": "需要渲染的文字内容是什么？请逐字给出。", "choices": None}]
+                if selected == "sticker_icon" and not ((spec.get("output") or {}).get("background") or ""):
+                    questions = [{"id": "q_bg", "text": "贴纸背景要透明还是白色？", "choices": ["transparent", "white"]}]
+                if selected == "negative_space" and not ((spec.get("output") or {}).get("negative_space") or ""):
+                    questions = [
                         {
-                            "width": int(w),
-                            "height": int(h),
-                            "orientation": "landscape" if w >= h else "portrait",
-                            "aspect_ratio": impl._best_aspect_ratio(w, h),
+                            "id": "q_space",
+                            "text": "需要留白的位置是哪里？例如：top-left / top-right / bottom-left / bottom-right / center。",
+                            "choices": ["top-left", "top-right", "bottom-left", "bottom-right", "center"],
                         }
-                    )
-                except Exception:
-                    pass
-                if isinstance(ui, dict):
-                    facts.update(impl._extract_image_facts_from_ui(ui))
-                    facts["analysis_summary"] = summary
-                    if ui.get("filter_recommendations"):
-                        facts["filter_recommendations"] = ui.get("filter_recommendations")
-
-                spec = impl._default_spec(facts, message or "")
-                selected, candidates = impl._route_templates(spec, facts)
-                messages = []
+                    ]
+                face_count = facts.get("face_count")
+                if isinstance(face_count, int) and face_count > 0 and (spec.get("must_keep") or {}).get("identity") is None:
+                    questions = (questions or [])[:1] + [{"id": "q_id", "text": "人物面部/身份是否必须完全不变？", "choices": ["必须不变", "允许略微调整"]}]
+
+            status = "ready" if (not questions and impl._is_ready_to_render(spec, selected)) else "needs_input"
+
+            session_id = impl._insert_smart_session(
+                saved_image_path, original_name, spec, facts, status=status, record_id=record_id
+            )
+            try:
                 if isinstance(message, str) and message.strip():
-                    messages.append({"role": "user", "content": message.strip()})
+                    impl._add_smart_session_message(session_id, "user", message.strip())
+            except Exception:
+                pass
+            impl._update_smart_session(
+                session_id, template_selected=selected, template_candidates=candidates, status=status
+            )
 
-                patch = {}
-                questions = []
-                llm_selected = None
-                if impl._get_gemini_api_key():
-                    try:
-                        patch, questions, llm_selected = impl._llm_clarify_next(spec, facts, messages, candidates)
-                    except Exception as exc:
-                        impl.logger.warning("smart_start_stream llm_clarify failed: %s", exc)
-
-                spec = impl._deep_merge(spec, patch or {})
-                selected, candidates = impl._route_templates(spec, facts)
-                if llm_selected and any(c.get("template") == llm_selected for c in candidates if isinstance(c, dict)):
-                    selected = llm_selected
-
-                if not questions:
-                    if selected == "text_design" and not ((spec.get("text_overlay") or {}).get("content") or ""):
-                        questions = [{"id": "q_text", "text": "需要渲染的文字内容是什么？请逐字给出。", "choices": None}]
-                    if selected == "sticker_icon" and not ((spec.get("output") or {}).get("background") or ""):
-                        questions = [{"id": "q_bg", "text": "贴纸背景要透明还是白色？", "choices": ["transparent", "white"]}]
-                    if selected == "negative_space" and not ((spec.get("output") or {}).get("negative_space") or ""):
-                        questions = [
-                            {
-                                "id": "q_space",
-                                "text": "需要留白的位置是哪里？例如：top-left / top-right / bottom-left / bottom-right / center。",
-                                "choices": ["top-left", "top-right", "bottom-left", "bottom-right", "center"],
-                            }
-                        ]
-                    face_count = facts.get("face_count")
-                    if isinstance(face_count, int) and face_count > 0 and (spec.get("must_keep") or {}).get("identity") is None:
-                        questions = (questions or [])[:1] + [{"id": "q_id", "text": "人物面部/身份是否必须完全不变？", "choices": ["必须不变", "允许略微调整"]}]
-
-                status = "ready" if (not questions and impl._is_ready_to_render(spec, selected)) else "needs_input"
-
-                session_id = impl._insert_smart_session(
-                    saved_image_path, image.filename, spec, facts, status=status, record_id=record_id
-                )
+            prompt_preview = None
+            if status == "ready":
+                try:
+                    prompt_preview, _ = impl._compile_prompt(spec, facts, selected)
+                except Exception:
+                    prompt_preview = None
+
+            log_path = impl._write_json_log(
+                "smart_start_stream",
+                saved_image_path,
+                [],
+                params={
+                    "session_id": session_id,
+                    "template_selected": selected,
+                    "template_candidates": candidates,
+                    "spec": spec,
+                    "facts": facts,
+                    "questions": questions,
+                    "llm_model": os.getenv("SMART_LLM_MODEL", "gemini-2.5-flash"),
+                },
+                steps=[],
+                summary=summary,
+                events=[{"level": "INFO", "message": "smart_start_stream created", "value": {"status": status}}],
+                local_output_paths=[],
+                record_id=record_id,
+            )
+            if record_id:
                 try:
-                    if isinstance(message, str) and message.strip():
-                        impl._add_smart_session_message(session_id, "user", message.strip())
+                    impl._update_record_logs(record_id, log_path)
                 except Exception:
                     pass
-                impl._update_smart_session(
-                    session_id, template_selected=selected, template_candidates=candidates, status=status
-                )
 
-                prompt_preview = None
-                if status == "ready":
-                    try:
-                        prompt_preview, _ = impl._compile_prompt(spec, facts, selected)
-                    except Exception:
-                        prompt_preview = None
-
-                log_path = impl._write_json_log(
-                    "smart_start_stream",
-                    saved_image_path,
-                    [],
-                    params={
-                        "session_id": session_id,
-                        "template_selected": selected,
-                        "template_candidates": candidates,
-                        "spec": spec,
-                        "facts": facts,
-                        "questions": questions,
-                        "llm_model": os.getenv("SMART_LLM_MODEL", "gemini-2.5-flash"),
-                    },
-                    steps=[],
-                    summary=summary,
-                    events=[{"level": "INFO", "message": "smart_start_stream created", "value": {"status": status}}],
-                    local_output_paths=[],
-                    record_id=record_id,
-                )
-                if record_id:
-                    try:
-                        impl._update_record_logs(record_id, log_path)
-                    except Exception:
-                        pass
-
-                session = impl.SmartSessionStartResponse(
-                    session_id=session_id,
-                    record_id=record_id,
-                    status=status,
-                    spec=spec,
-                    facts=facts,
-                    questions=[impl.SmartQuestionModel(**q) for q in questions],
-                    template_selected=selected,
-                    template_candidates=candidates,
-                    prompt_preview=prompt_preview,
-                    image_model=os.getenv("IMAGE_EDIT_MODEL", "gemini-3-pro-image-preview"),
-                    plan_items=impl._spec_to_plan_items(spec, facts),
-                )
-                try:
-                    payload = session.model_dump()
-                except AttributeError:
-                    payload = session.dict()
-                push({"type": "session", "session": payload})
-            except Exception as e:
-                impl.logger.warning("smart_start_stream 最终解析失败: %s", e)
-                push({"type": "final", "summary": ""})
-            finally:
-                push({"type": "__end__"})
-
-        threading.Thread(target=worker, daemon=True).start()
-
-        while True:
-            evt = await queue.get()
-            if isinstance(evt, dict) and evt.get("type") == "__end__":
-                break
-            yield impl._sse_event(evt)
-
-    headers = {
-        "Cache-Control": "no-cache",
-        "Connection": "keep-alive",
-        "X-Accel-Buffering": "no",
-    }
-    return StreamingResponse(gen(), media_type="text/event-stream", headers=headers)
+            session = impl.SmartSessionStartResponse(
+                session_id=session_id,
+                record_id=record_id,
+                status=status,
+                spec=spec,
+                facts=facts,
+                questions=[impl.SmartQuestionModel(**q) for q in questions],
+                template_selected=selected,
+                template_candidates=candidates,
+                prompt_preview=prompt_preview,
+                image_model=os.getenv("IMAGE_EDIT_MODEL", "gemini-3-pro-image-preview"),
+                plan_items=impl._spec_to_plan_items(spec, facts),
+            )
+            try:
+                payload = session.model_dump()
+            except AttributeError:
+                payload = session.dict()
+            push({"type": "session", "session": payload})
+        except Exception as e:
+            impl.logger.warning("smart_start_stream 最终解析失败: %s", e)
+            push({"type": "final", "summary": ""})
+        finally:
+            flight.close()
+
+    impl._start_stream_worker(worker, slot)
+    return StreamingResponse(impl._sse_stream(flight, request), media_type="text/event-stream", headers=impl.SSE_HEADERS)
 
 
 @router.post("/smart/answer", response_model=impl.SmartSessionAnswerResponse)
@@ -445,7 +507,7 @@ async def smart_answer(req: impl.SmartSessionAnswerRequest):
     spec = sess.get("spec") or {}
     facts = sess.get("facts") or {}
     candidates = sess.get("template_candidates") or []
-    impl._add_smart_session_message(sess["id"], "user", message)
+    await run_in_threadpool(impl._add_smart_session_message, sess["id"], "user", message)
 
     history = impl._list_smart_session_messages(sess["id"], limit=50)
     msgs = [{"role": m["role"], "content": m["content"]} for m in history]
@@ -455,7 +517,9 @@ async def smart_answer(req: impl.SmartSessionAnswerRequest):
     llm_selected = None
     if impl._get_gemini_api_key():
         try:
-            patch, questions, llm_selected = impl._llm_clarify_next(spec, facts, msgs, candidates)
+            patch, questions, llm_selected = await impl._run_upstream(
+                impl._llm_clarify_next, spec, facts, msgs, candidates, upstream=("gemini", "analysis", os.getenv("SMART_LLM_MODEL", "gemini-2.0-flash"))
+            )
         except Exception as exc:
             impl.logger.warning("smart_answer llm_clarify failed: %s", exc)
 
@@ -479,7 +543,7 @@ async def smart_answer(req: impl.SmartSessionAnswerRequest):
             ]
 
     status = "ready" if (not questions and impl._is_ready_to_render(spec, selected)) else "needs_input"
-    impl._update_smart_session(sess["id"], spec=spec, facts=facts, template_selected=selected, template_candidates=candidates, status=status)
+    await run_in_threadpool(impl._update_smart_session, sess["id"], spec=spec, facts=facts, template_selected=selected, template_candidates=candidates, status=status)
 
     prompt_preview = None
     if status == "ready":
@@ -488,7 +552,8 @@ async def smart_answer(req: impl.SmartSessionAnswerRequest):
         except Exception:
             prompt_preview = None
 
-    impl._write_json_log(
+    await run_in_threadpool(
+        impl._write_json_log,
         "smart_answer",
         sess["image_path"],
         [],
@@ -560,7 +625,9 @@ async def smart_generate(req: impl.SmartSessionGenerateRequest):
         raise HTTPException(status_code=500, detail="failed to read session image")
     mime_type = impl._infer_mime_from_filename(sess.get("original_name") or sess["image_path"])
 
-    urls, local_paths, raw = impl._gemini_image_edit_native(
+    urls, local_paths, raw = await impl._run_upstream(
+        impl._gemini_image_edit_native,
+        upstream=("gemini", "generation", image_model),
         model=image_model,
         prompt_text=prompt_text,
         image_bytes=image_bytes,
@@ -573,7 +640,7 @@ async def smart_generate(req: impl.SmartSessionGenerateRequest):
     if record_id:
         try:
             for p in local_paths:
-                impl._insert_record_image(record_id=record_id, kind="final", image_path=p)
+                await run_in_threadpool(impl._insert_record_image, record_id=record_id, kind="final", image_path=p)
         except Exception:
             pass
 
@@ -591,7 +658,8 @@ async def smart_generate(req: impl.SmartSessionGenerateRequest):
             else:
                 served_urls.append(f"{base}{url}")
 
-    log_path = impl._write_json_log(
+    log_path = await run_in_threadpool(
+        impl._write_json_log,
         "smart_generate",
         sess["image_path"],
         served_urls,
@@ -612,11 +680,11 @@ async def smart_generate(req: impl.SmartSessionGenerateRequest):
     )
     if record_id:
         try:
-            impl._update_record_logs(record_id, log_path)
+            await run_in_threadpool(impl._update_record_logs, record_id, log_path)
         except Exception:
             pass
 
-    impl._update_smart_session(sess["id"], spec=spec, template_selected=selected, status="generated")
+    await run_in_threadpool(impl._update_smart_session, sess["id"], spec=spec, template_selected=selected, status="generated")
 
     return impl.SmartSessionGenerateResponse(
         session_id=sess["id"],
@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import threading
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from backend.metrics import metrics
+
+
+def flight_key(op: str, *parts: object) -> str:
+    """Stable key for ``op`` over arbitrary JSON-ish params (large values are hashed, not stored)."""
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return f"{op}:{hashlib.sha256(raw.encode('utf-8')).hexdigest()}"
+
+
+def _op(key: str) -> str:
+    return key.split(":", 1)[0]
+
+
+class SingleFlight:
+    """Coalesce identical concurrent async calls onto one in-flight task.
+
+    The first caller for a key starts the work as an independent task; callers
+    that arrive while it is running await the same task and get the same result
+    (or exception). The work is shielded, so a disconnecting caller does not
+    cancel it for the others. Tasks are tracked per event loop.
+    """
+
+    def __init__(self) -> None:
+        self._inflight: Dict[Tuple[int, str], asyncio.Task] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable]):
+        loop = asyncio.get_running_loop()
+        slot = (id(loop), key)
+        task = self._inflight.get(slot)
+        if task is None or task.done():
+            task = loop.create_task(fn())
+            self._inflight[slot] = task
+            task.add_done_callback(lambda t, s=slot: self._forget(s, t))
+        else:
+            metrics.incr("singleflight.coalesced")
+            metrics.incr(f"singleflight.coalesced.{_op(key)}")
+        return await asyncio.shield(task)
+
+    def _forget(self, slot: Tuple[int, str], task: asyncio.Task) -> None:
+        if self._inflight.get(slot) is task:
+            self._inflight.pop(slot, None)
+        if not task.cancelled():
+            task.exception()  # mark retrieved even if every waiter went away
+
+    def inflight(self) -> int:
+        return len(self._inflight)
+
+
+class FlightCancelled(RuntimeError):
+    """Raised by ``EventFanout.raise_if_cancelled`` once every subscriber has left."""
+
+
+class EventFanout:
+    """One producer thread, many SSE subscribers.
+
+    ``publish`` may be called from any thread; events are handed to the loop
+    with ``call_soon_threadsafe``. Subscribers that join late first receive the
+    events published so far, so every client sees the full stream. Once the
+    last subscriber goes away before the stream is closed, ``cancelled`` is
+    set so the producer can stop its upstream work.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, on_close: Optional[Callable[["EventFanout"], None]] = None) -> None:
+        self.loop = loop
+        self._on_close = on_close
+        self._history: List[dict] = []
+        self._queues: List[asyncio.Queue] = []
+        self.closed = False
+        self.subscribers = 0
+        self.cancelled = threading.Event()
+
+    def raise_if_cancelled(self) -> None:
+        if self.cancelled.is_set():
+            raise FlightCancelled("all subscribers disconnected")
+
+    def publish(self, evt: dict) -> None:
+        try:
+            self.loop.call_soon_threadsafe(self._publish, evt)
+        except RuntimeError:
+            pass  # loop already closed: nobody left to deliver to
+
+    def close(self) -> None:
+        try:
+            self.loop.call_soon_threadsafe(self._publish, None)
+        except RuntimeError:
+            pass
+
+    def _publish(self, evt: Optional[dict]) -> None:
+        if self.closed:
+            return
+        if evt is None:
+            self.closed = True
+        else:
+            self._history.append(evt)
+        for q in self._queues:
+            q.put_nowait(evt)
+        if evt is None and self._on_close is not None:
+            self._on_close(self)
+
+    async def subscribe(self) -> AsyncIterator[dict]:
+        q: asyncio.Queue = asyncio.Queue()
+        for evt in self._history:
+            q.put_nowait(evt)
+        if self.closed:
+            q.put_nowait(None)
+        else:
+            self._queues.append(q)
+        self.subscribers += 1
+        try:
+            while True:
+                evt = await q.get()
+                if evt is None:
+                    break
+                yield evt
+        finally:
+            self.subscribers -= 1
+            if q in self._queues:
+                self._queues.remove(q)
+            if self.subscribers == 0 and not self.closed:
+                self.cancelled.set()
+
+
+class StreamCost:
+    """Prices cancelled upstream streams against the average completed one.
+
+    ``completed(op, seconds, chunks)`` feeds a per-operation EWMA;
+    ``cancelled(op, seconds, chunks)`` records ``sse.<op>.cancelled`` and the
+    estimated ``sse.<op>.seconds_saved`` / ``.tokens_saved`` (the average
+    minus what was already consumed; one content delta is counted as one
+    token). ``fallback_skipped`` counts ``sse.<op>.fallbacks_skipped``.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._avg: Dict[str, Tuple[float, float]] = {}
+
+    def completed(self, op: str, seconds: float, chunks: int) -> None:
+        with self._lock:
+            prev = self._avg.get(op)
+            self._avg[op] = (seconds, float(chunks)) if prev is None else (0.8 * prev[0] + 0.2 * seconds, 0.8 * prev[1] + 0.2 * chunks)
+
+    def cancelled(self, op: str, seconds: float, chunks: int, fallback_skipped: bool = False) -> None:
+        with self._lock:
+            avg = self._avg.get(op)
+        metrics.incr(f"sse.{op}.cancelled")
+        if avg is not None:
+            metrics.incr(f"sse.{op}.seconds_saved", max(0.0, avg[0] - seconds))
+            metrics.incr(f"sse.{op}.tokens_saved", max(0, int(round(avg[1] - chunks))))
+        if fallback_skipped:
+            metrics.incr(f"sse.{op}.fallbacks_skipped")
+
+
+class FanoutRegistry:
+    """In-flight SSE streams by key; a duplicate request joins the running one."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._flights: Dict[str, EventFanout] = {}
+
+    def join(self, key: str) -> Optional[EventFanout]:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None or flight.closed or flight.cancelled.is_set() or flight.loop is not loop:
+                return None
+        metrics.incr("singleflight.coalesced")
+        metrics.incr(f"singleflight.coalesced.{_op(key)}")
+        return flight
+
+    def start(self, key: str) -> EventFanout:
+        flight = EventFanout(asyncio.get_running_loop(), on_close=lambda f, k=key: self._finish(k, f))
+        with self._lock:
+            self._flights[key] = flight
+        return flight
+
+    def _finish(self, key: str, flight: EventFanout) -> None:
+        with self._lock:
+            if self._flights.get(key) is flight:
+                self._flights.pop(key, None)
+
+    def inflight(self) -> int:
+        with self._lock:
+            return len(self._flights)
@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import json
+import re
+from typing import List, Optional, Tuple
+
+# Keys whose values are emitted as soon as they close.
+SECTION_KEYS = ("photo_basic_info", "photo_quality_analysis", "summary_ui")
+ITEMS_KEY = "professional_analysis"
+
+# Structural characters outside / inside a JSON string.
+_STRUCT_RE = re.compile(r'[{}\[\]",:]')
+_STRING_RE = re.compile(r'["\\]')
+
+
+class _Frame:
+    __slots__ = ("kind", "expect_key", "key", "items")
+
+    def __init__(self, kind: str, items: bool = False) -> None:
+        self.kind = kind
+        self.expect_key = kind == "{"
+        self.key: Optional[str] = None
+        self.items = items
+
+
+class AnalysisStreamParser:
+    """Resumable tokenizer for the streamed qwen3-vl analysis JSON.
+
+    ``feed()`` scans each chunk exactly once and keeps its position between
+    calls, so the whole stream costs O(total bytes) instead of rescanning the
+    accumulated buffer per chunk. It returns ``(key, value)`` events:
+
+    - ``("professional_analysis", obj)`` once per completed array element;
+    - ``("photo_basic_info" | "photo_quality_analysis" | "summary_ui", value)``
+      the first time each of those values closes.
+
+    Text before the first ``{`` (e.g. a ```json fence) is ignored. Elements that
+    fail to parse are skipped, matching the old best-effort extractor.
+    """
+
+    def __init__(self) -> None:
+        self._chunks: List[str] = []
+        self._stack: List[_Frame] = []
+        self._in_string = False
+        self._escape = False
+        # current string being read as an object key
+        self._key_parts: Optional[List[str]] = None
+        # active capture: (role, stack depth it closes at, parts)
+        self._capture_role: Optional[str] = None
+        self._capture_depth = 0
+        self._capture_parts: List[str] = []
+        self._capture_start: Optional[int] = None
+        self._seen: set = set()
+        self.items_emitted = 0
+
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+    def feed(self, chunk: str) -> List[Tuple[str, object]]:
+        if not chunk:
+            return []
+        self._chunks.append(chunk)
+        events: List[Tuple[str, object]] = []
+        n = len(chunk)
+        i = 0
+        key_start: Optional[int] = 0 if self._key_parts is not None else None
+        if self._capture_role is not None:
+            self._capture_start = 0
+        while i < n:
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                    i += 1
+                    continue
+                m = _STRING_RE.search(chunk, i)
+                if m is None:
+                    break
+                i = m.start()
+                if chunk[i] == "\\":
+                    self._escape = True
+                    i += 1
+                    continue
+                # closing quote
+                self._in_string = False
+                if self._key_parts is not None:
+                    self._key_parts.append(chunk[key_start:i])
+                    self._stack[-1].key = "".join(self._key_parts)
+                    self._key_parts = None
+                    key_start = None
+                elif self._capture_role is not None and self._capture_depth == len(self._stack) and self._capture_role == "summary_ui":
+                    self._finish_capture(chunk, i, events)
+                i += 1
+                continue
+
+            m = _STRUCT_RE.search(chunk, i)
+            if m is None:
+                break
+            i = m.start()
+            ch = chunk[i]
+            top = self._stack[-1] if self._stack else None
+            if top is None and ch != "{":
+                # noise around the top-level object (code fences, prose)
+                i += 1
+                continue
+            if ch == '"':
+                self._in_string = True
+                if top is not None and top.kind == "{" and top.expect_key:
+                    self._key_parts = []
+                    key_start = i + 1
+                elif self._capture_role is None and top is not None and top.kind == "{" and top.key == "summary_ui" and "summary_ui" not in self._seen:
+                    self._begin_capture("summary_ui", len(self._stack), i)
+            elif ch in "{[":
+                if self._capture_role is None and top is not None:
+                    if ch == "{" and top.kind == "[" and top.items:
+                        self._begin_capture(ITEMS_KEY, len(self._stack) + 1, i)
+                    elif ch == "{" and top.kind == "{" and top.key in SECTION_KEYS and top.key not in self._seen:
+                        self._begin_capture(top.key, len(self._stack) + 1, i)
+                is_items = ch == "[" and top is not None and top.kind == "{" and top.key == ITEMS_KEY
+                self._stack.append(_Frame(ch, items=is_items))
+            elif ch in "}]":
+                if self._stack:
+                    depth = len(self._stack)
+                    self._stack.pop()
+                    if self._capture_role is not None and self._capture_depth == depth:
+                        self._finish_capture(chunk, i, events)
+            elif ch == ":":
+                if top is not None and top.kind == "{":
+                    top.expect_key = False
+            elif ch == ",":
+                if top is not None and top.kind == "{":
+                    top.expect_key = True
+                    top.key = None
+            i += 1
+
+        if self._key_parts is not None and key_start is not None:
+            self._key_parts.append(chunk[key_start:])
+        if self._capture_role is not None and self._capture_start is not None:
+            self._capture_parts.append(chunk[self._capture_start:])
+            self._capture_start = None
+        return events
+
+    def _begin_capture(self, role: str, depth: int, start: int) -> None:
+        self._capture_role = role
+        self._capture_depth = depth
+        self._capture_parts = []
+        self._capture_start = start
+
+    def _finish_capture(self, chunk: str, end: int, events: List[Tuple[str, object]]) -> None:
+        role = self._capture_role
+        start = self._capture_start if self._capture_start is not None else 0
+        self._capture_parts.append(chunk[start : end + 1])
+        raw = "".join(self._capture_parts)
+        self._capture_role = None
+        self._capture_parts = []
+        self._capture_start = None
+        try:
+            value = json.loads(raw)
+        except Exception:
+            return
+        if role == ITEMS_KEY:
+            self.items_emitted += 1
+        else:
+            self._seen.add(role)
+        events.append((role, value))
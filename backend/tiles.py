@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+import contextlib
+import io
+import json
+import logging
+import math
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple
+from uuid import uuid4
+
+from backend.image_decode import decode_image
+from backend.metrics import metrics
+
+logger = logging.getLogger("reimagine")
+
+
+def pyramid_levels(width: int, height: int, tile_size: int) -> int:
+    """Number of levels; level 0 fits in one tile, the last one is full resolution."""
+    longest = max(width, height, 1)
+    if longest <= tile_size:
+        return 1
+    return math.ceil(math.log2(longest / tile_size)) + 1
+
+
+def level_size(width: int, height: int, levels: int, z: int) -> Tuple[int, int]:
+    # ceil matches Image.reduce(2), so levels can be built by repeated halving
+    f = 2 ** (levels - 1 - z)
+    return max(1, math.ceil(width / f)), max(1, math.ceil(height / f))
+
+
+class TilePyramid:
+    """Deep-zoom tiles for stored images: ``root/<digest>/<z>/<x>_<y>.webp``.
+
+    Level ``z`` is the image scaled by ``2 ** (z - last)``; tiles are
+    ``tile_size`` squares cut from it (edge tiles are smaller, no overlap).
+    Levels are rendered whole, either on demand by ``tile()`` or all at once
+    by ``build()`` (one decode, then repeated 2x reductions). A ``.done``
+    marker per level makes both paths idempotent; per-level locks keep them
+    from rendering the same level twice and are dropped once it is done.
+
+    Like ``DerivativeCache``, the tree is capped at ``max_bytes``: serving a
+    tile refreshes its level's ``.done`` mtime, and the least recently used
+    levels are removed whole (marker first) once the total is exceeded.
+    """
+
+    def __init__(self, root: Path, tile_size: int = 256, quality: int = 80, max_bytes: int = 1024 * 1024 * 1024) -> None:
+        self.root = Path(root)
+        self.tile_size = int(tile_size)
+        self.quality = int(quality)
+        self.max_bytes = int(max_bytes)
+        self._locks: Dict[Tuple[str, int], threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+        self._budget_lock = threading.Lock()
+        self._total: Optional[int] = None
+
+    @contextlib.contextmanager
+    def _level_lock(self, digest: str, z: int) -> Iterator[None]:
+        key = (digest, z)
+        with self._locks_guard:
+            lock = self._locks.setdefault(key, threading.Lock())
+        try:
+            with lock:
+                yield
+        finally:
+            if self._level_done(digest, z):
+                with self._locks_guard:
+                    if self._locks.get(key) is lock:
+                        del self._locks[key]
+
+    def info(self, digest: str, src: str) -> dict:
+        path = self.root / digest / "info.json"
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except (FileNotFoundError, ValueError):
+            pass
+        from PIL import Image as _Image
+
+        with _Image.open(src) as probe:
+            width, height = probe.size
+        info = {
+            "width": width,
+            "height": height,
+            "tile_size": self.tile_size,
+            "levels": pyramid_levels(width, height, self.tile_size),
+            "format": "webp",
+        }
+        self._write(path, json.dumps(info).encode("utf-8"))
+        return info
+
+    def tile_path(self, digest: str, z: int, x: int, y: int) -> Path:
+        return self.root / digest / str(z) / f"{x}_{y}.webp"
+
+    def tile(self, digest: str, src: str, z: int, x: int, y: int) -> Path:
+        """Path of tile ``(z, x, y)``, rendering its level first if needed; ``IndexError`` if out of range."""
+        path = self.tile_path(digest, z, x, y)
+        if path.is_file():
+            self._touch(digest, z)
+            return path
+        info = self.info(digest, src)
+        if not 0 <= z < info["levels"]:
+            raise IndexError(f"level {z} out of range")
+        w, h = level_size(info["width"], info["height"], info["levels"], z)
+        if not (0 <= x < math.ceil(w / self.tile_size) and 0 <= y < math.ceil(h / self.tile_size)):
+            raise IndexError(f"tile {x}_{y} out of range at level {z}")
+        with self._level_lock(digest, z):
+            if not self._level_done(digest, z):
+                img = decode_image(Path(src).read_bytes(), Path(src).name, size=(w, h))
+                self._write_level(digest, z, img)
+        return path
+
+    def build(self, digest: str, src: str) -> int:
+        """Render every missing level from a single decode; returns the number of levels rendered."""
+        info = self.info(digest, src)
+        levels = info["levels"]
+        if all(self._level_done(digest, z) for z in range(levels)):
+            return 0
+        img = decode_image(Path(src).read_bytes(), Path(src).name)
+        rendered = 0
+        for z in range(levels - 1, -1, -1):
+            if z != levels - 1:
+                img = img.reduce(2)
+            with self._level_lock(digest, z):
+                if not self._level_done(digest, z):
+                    self._write_level(digest, z, img)
+                    rendered += 1
+        return rendered
+
+    def _level_done(self, digest: str, z: int) -> bool:
+        return (self.root / digest / str(z) / ".done").is_file()
+
+    def _touch(self, digest: str, z: int) -> None:
+        try:
+            os.utime(self.root / digest / str(z) / ".done")
+        except OSError:
+            pass
+
+    def _write_level(self, digest: str, z: int, img) -> None:
+        start = time.perf_counter()
+        t = self.tile_size
+        w, h = img.size
+        count = 0
+        size = 0
+        for y in range(math.ceil(h / t)):
+            for x in range(math.ceil(w / t)):
+                buf = io.BytesIO()
+                img.crop((x * t, y * t, min(w, (x + 1) * t), min(h, (y + 1) * t))).save(buf, format="WEBP", quality=self.quality)
+                self._write(self.tile_path(digest, z, x, y), buf.getvalue())
+                count += 1
+                size += buf.tell()
+        self._write(self.root / digest / str(z) / ".done", b"")
+        metrics.incr("tiles.levels_rendered")
+        metrics.incr("tiles.tiles_written", count)
+        metrics.incr("tiles.seconds", time.perf_counter() - start)
+        self._account(digest, z, size)
+
+    def _account(self, digest: str, z: int, size: int) -> None:
+        with self._budget_lock:
+            if self._total is None:
+                self._total = sum(size for _mtime, size, _d, _z in self._levels())
+            else:
+                self._total += size
+            if self._total > self.max_bytes:
+                self._evict(keep=(digest, z))
+
+    def _levels(self) -> list:
+        """``(mtime, bytes, digest, z)`` for every finished level."""
+        entries = []
+        if not self.root.exists():
+            return entries
+        for marker in self.root.glob("*/*/.done"):
+            try:
+                mtime = marker.stat().st_mtime
+                size = sum(p.stat().st_size for p in marker.parent.iterdir() if p.is_file())
+                z = int(marker.parent.name)
+            except (OSError, ValueError):
+                continue
+            entries.append((mtime, size, marker.parent.parent.name, z))
+        return entries
+
+    def _evict(self, keep: Tuple[str, int]) -> None:
+        entries = sorted(self._levels())
+        total = sum(size for _mtime, size, _d, _z in entries)
+        evicted = 0
+        for _mtime, size, digest, z in entries:
+            if total <= self.max_bytes:
+                break
+            if (digest, z) == keep:
+                continue
+            level_dir = self.root / digest / str(z)
+            try:
+                # 先删 .done，其它线程看到的要么是完整的层，要么是需要重新渲染的层
+                (level_dir / ".done").unlink()
+            except OSError:
+                continue
+            shutil.rmtree(level_dir, ignore_errors=True)
+            total -= size
+            evicted += 1
+            digest_dir = self.root / digest
+            try:
+                if not any(p.is_dir() for p in digest_dir.iterdir()):
+                    shutil.rmtree(digest_dir, ignore_errors=True)
+            except OSError:
+                pass
+        self._total = total
+        if evicted:
+            metrics.incr("tiles.levels_evicted", evicted)
+            logger.info("tile cache: evicted %d levels, %d bytes left", evicted, total)
+
+    def stats(self) -> dict:
+        with self._budget_lock:
+            if self._total is None:
+                self._total = sum(size for _mtime, size, _d, _z in self._levels())
+            total = self._total
+        return {
+            "size_bytes": total,
+            "max_bytes": self.max_bytes,
+            "levels_rendered": int(metrics.get("tiles.levels_rendered")),
+            "levels_evicted": int(metrics.get("tiles.levels_evicted")),
+        }
+
+    @staticmethod
+    def _write(path: Path, data: bytes) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".tmp-{uuid4().hex}")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
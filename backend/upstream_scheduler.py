@@ -0,0 +1,309 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from backend.metrics import metrics
+
+logger = logging.getLogger("reimagine")
+
+# lower value is served first within a lane
+PRIORITIES = {"interactive": 0, "batch": 1}
+
+DEFAULT_LIMITS: Dict[str, dict] = {
+    "gemini": {"concurrency": {"analysis": 8, "generation": 4}},
+    "dashscope": {"concurrency": {"analysis": 8, "generation": 4}},
+}
+DEFAULT_CONCURRENCY = 8
+# tokens debited from a tpm bucket per call when the caller gives no estimate
+DEFAULT_CALL_TOKENS = {"analysis": 2000, "generation": 1500}
+# how often a blocked acquire_sync looks at its cancel event
+CANCEL_POLL_SECONDS = 0.1
+
+
+class SlotCancelled(RuntimeError):
+    """``acquire_sync`` gave up waiting because its ``cancel`` event was set."""
+
+
+class TokenBucket:
+    """Refills ``per_minute`` units per minute up to ``burst`` (default: one minute's worth)."""
+
+    def __init__(self, per_minute: float, burst: Optional[float] = None) -> None:
+        self.rate = float(per_minute) / 60.0
+        self.capacity = float(burst if burst is not None else per_minute)
+        self.level = self.capacity
+        self.stamp = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, n: float, now: float) -> float:
+        """Seconds until ``n`` units are available (0 if they are now)."""
+        self._refill(now)
+        n = min(float(n), self.capacity)
+        if self.level >= n:
+            return 0.0
+        return (n - self.level) / self.rate if self.rate > 0 else float("inf")
+
+    def take(self, n: float, now: float) -> None:
+        self._refill(now)
+        self.level -= min(float(n), self.capacity)
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "tokens", "wake", "enqueued", "granted", "cancelled")
+
+    def __init__(self, priority: int, seq: int, tokens: float, wake: Callable[[], None]) -> None:
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.wake = wake
+        self.enqueued = time.monotonic()
+        self.granted: Optional[float] = None
+        self.cancelled = False
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _Lane:
+    def __init__(self, key: str, name: str, concurrency: int, buckets: Dict[str, TokenBucket]) -> None:
+        self.key = key
+        self.name = name
+        self.concurrency = max(1, int(concurrency))
+        self.buckets = buckets  # shared by every lane of the same provider/model
+        self.active = 0
+        self.heap: List[_Waiter] = []
+        self.timer: Optional[threading.Timer] = None
+
+
+class Ticket:
+    """A granted upstream slot; ``release()`` (or leaving the ``with`` block) frees it."""
+
+    def __init__(self, scheduler: "UpstreamScheduler", lane: _Lane, queue_seconds: float) -> None:
+        self._scheduler = scheduler
+        self._lane = lane
+        self.queue_seconds = queue_seconds
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._scheduler._release(self._lane)
+
+    def __enter__(self) -> "Ticket":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+    async def __aenter__(self) -> "Ticket":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.release()
+
+
+class UpstreamScheduler:
+    """Admission control for calls to model providers.
+
+    Limits are configured per provider (``"gemini"``) or per provider/model
+    (``"gemini/gemini-3-pro-image-preview"``, which takes precedence)::
+
+        {"concurrency": {"analysis": 8, "generation": 2},
+         "rpm": 60, "tpm": 400000, "tokens": {"generation": 1500}}
+
+    Each (limit key, lane) has its own concurrency cap, so slow image
+    generation never occupies the slots of cheap analysis calls; ``rpm`` and
+    ``tpm`` are token buckets shared by all lanes of the key (``tokens`` is
+    the per-call estimate debited from ``tpm``). Within a lane waiters are
+    served by priority (``interactive`` before ``batch``), then FIFO.
+
+    ``acquire`` (async) and ``acquire_sync`` (threads) return a ``Ticket``
+    carrying ``queue_seconds``; a waiter that is cancelled (task
+    cancellation, or ``acquire_sync``'s ``cancel`` event / ``timeout``)
+    leaves the queue without taking a slot. Records ``upstream.<key>.<lane>.calls``,
+    ``.queue_seconds`` and ``.throttled`` (times the lane waited on a bucket).
+    """
+
+    def __init__(self, limits: Optional[Dict[str, dict]] = None) -> None:
+        self.limits: Dict[str, dict] = {k: dict(v) for k, v in DEFAULT_LIMITS.items()}
+        for key, cfg in (limits or {}).items():
+            self.limits[key] = dict(cfg)
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._lanes: Dict[Tuple[str, str], _Lane] = {}
+        self._buckets: Dict[str, Dict[str, TokenBucket]] = {}
+
+    @classmethod
+    def from_env(cls, raw: Optional[str]) -> "UpstreamScheduler":
+        limits = None
+        if raw and raw.strip():
+            try:
+                limits = json.loads(raw)
+            except ValueError as exc:
+                logger.warning("invalid UPSTREAM_LIMITS ignored: %s", exc)
+        return cls(limits if isinstance(limits, dict) else None)
+
+    def _limit_key(self, provider: str, model: Optional[str]) -> str:
+        if model and f"{provider}/{model}" in self.limits:
+            return f"{provider}/{model}"
+        return provider
+
+    def _lane(self, key: str, lane: str) -> _Lane:
+        found = self._lanes.get((key, lane))
+        if found is not None:
+            return found
+        cfg = self.limits.get(key) or {}
+        buckets = self._buckets.get(key)
+        if buckets is None:
+            buckets = {}
+            for name in ("rpm", "tpm"):
+                if cfg.get(name):
+                    buckets[name] = TokenBucket(float(cfg[name]))
+            self._buckets[key] = buckets
+        concurrency = (cfg.get("concurrency") or {}).get(lane, DEFAULT_CONCURRENCY)
+        found = self._lanes[(key, lane)] = _Lane(key, lane, concurrency, buckets)
+        return found
+
+    def _enqueue(self, provider: str, lane: str, model: Optional[str], tokens: Optional[float], priority: str, wake: Callable[[], None]) -> Tuple[_Lane, _Waiter]:
+        key = self._limit_key(provider, model)
+        if tokens is None:
+            tokens = ((self.limits.get(key) or {}).get("tokens") or {}).get(lane, DEFAULT_CALL_TOKENS.get(lane, 1000))
+        with self._lock:
+            ln = self._lane(key, lane)
+            waiter = _Waiter(PRIORITIES.get(priority, 0), next(self._seq), float(tokens), wake)
+            heapq.heappush(ln.heap, waiter)
+            granted = self._dispatch_locked(ln)
+        for w in granted:
+            w.wake()
+        return ln, waiter
+
+    def _dispatch_locked(self, ln: _Lane) -> List[_Waiter]:
+        granted: List[_Waiter] = []
+        now = time.monotonic()
+        while ln.heap and ln.active < ln.concurrency:
+            w = ln.heap[0]
+            if w.cancelled:
+                heapq.heappop(ln.heap)
+                continue
+            wait = 0.0
+            if "rpm" in ln.buckets:
+                wait = max(wait, ln.buckets["rpm"].delay(1, now))
+            if "tpm" in ln.buckets:
+                wait = max(wait, ln.buckets["tpm"].delay(w.tokens, now))
+            if wait > 0:
+                self._arm_timer_locked(ln, wait)
+                break
+            heapq.heappop(ln.heap)
+            if "rpm" in ln.buckets:
+                ln.buckets["rpm"].take(1, now)
+            if "tpm" in ln.buckets:
+                ln.buckets["tpm"].take(w.tokens, now)
+            ln.active += 1
+            w.granted = now
+            granted.append(w)
+        return granted
+
+    def _arm_timer_locked(self, ln: _Lane, wait: float) -> None:
+        if ln.timer is not None:
+            return
+        metrics.incr(f"upstream.{ln.key}.{ln.name}.throttled")
+
+        def fire() -> None:
+            with self._lock:
+                ln.timer = None
+                granted = self._dispatch_locked(ln)
+            for w in granted:
+                w.wake()
+
+        ln.timer = threading.Timer(min(wait, 60.0), fire)
+        ln.timer.daemon = True
+        ln.timer.start()
+
+    def _release(self, ln: _Lane) -> None:
+        with self._lock:
+            ln.active -= 1
+            granted = self._dispatch_locked(ln)
+        for w in granted:
+            w.wake()
+
+    def _cancel(self, ln: _Lane, waiter: _Waiter) -> None:
+        with self._lock:
+            if waiter.granted is None:
+                waiter.cancelled = True
+                return
+        self._release(ln)
+
+    def _ticket(self, ln: _Lane, waiter: _Waiter) -> Ticket:
+        queued = max(0.0, (waiter.granted or waiter.enqueued) - waiter.enqueued)
+        metrics.incr(f"upstream.{ln.key}.{ln.name}.calls")
+        metrics.incr(f"upstream.{ln.key}.{ln.name}.queue_seconds", queued)
+        return Ticket(self, ln, queued)
+
+    async def acquire(self, provider: str, lane: str, model: Optional[str] = None, tokens: Optional[float] = None, priority: str = "interactive") -> Ticket:
+        loop = asyncio.get_running_loop()
+        fut: asyncio.Future = loop.create_future()
+
+        def _set() -> None:
+            if not fut.done():
+                fut.set_result(None)
+
+        ln, waiter = self._enqueue(provider, lane, model, tokens, priority, lambda: loop.call_soon_threadsafe(_set))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            self._cancel(ln, waiter)
+            raise
+        return self._ticket(ln, waiter)
+
+    def acquire_sync(
+        self,
+        provider: str,
+        lane: str,
+        model: Optional[str] = None,
+        tokens: Optional[float] = None,
+        priority: str = "interactive",
+        cancel: Optional[threading.Event] = None,
+        timeout: Optional[float] = None,
+    ) -> Ticket:
+        """Blocking ``acquire``; raises ``SlotCancelled`` once ``cancel`` is set and ``TimeoutError`` after ``timeout`` seconds."""
+        event = threading.Event()
+        ln, waiter = self._enqueue(provider, lane, model, tokens, priority, event.set)
+        deadline = None if timeout is None else time.monotonic() + max(0.0, timeout)
+        while True:
+            step = CANCEL_POLL_SECONDS if cancel is not None else None
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                step = left if step is None else min(step, left)
+            if event.wait(None if step is None else max(0.0, step)):
+                return self._ticket(ln, waiter)
+            if cancel is not None and cancel.is_set():
+                self._cancel(ln, waiter)
+                raise SlotCancelled(f"{ln.key}.{ln.name}: cancelled while queued")
+            if deadline is not None and time.monotonic() >= deadline:
+                self._cancel(ln, waiter)
+                raise TimeoutError(f"{ln.key}.{ln.name}: no slot within {timeout:.1f}s")
+
+    def stats(self) -> dict:
+        out: dict = {}
+        with self._lock:
+            for (key, lane), ln in self._lanes.items():
+                waiting = [w for w in ln.heap if not w.cancelled]
+                entry = {
+                    "concurrency": ln.concurrency,
+                    "active": ln.active,
+                    "queued": {name: sum(1 for w in waiting if w.priority == p) for name, p in PRIORITIES.items()},
+                }
+                for name, bucket in ln.buckets.items():
+                    bucket._refill(time.monotonic())
+                    entry[f"{name}_available"] = round(bucket.level, 1)
+                out[f"{key}.{lane}"] = entry
+        return out
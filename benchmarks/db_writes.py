@@ -0,0 +1,115 @@
+"""Concurrent insert throughput: connect-per-call (old _get_conn) vs backend.db.Database.
+
+    python benchmarks/db_writes.py --threads 16 --writes 200
+
+Each "write" mirrors _insert_record + _insert_record_image: two INSERTs and a
+refcount UPDATE. The legacy path opens a connection per helper call and
+commits each one (rollback journal, default pragmas), like the code before the
+batched writer.
+"""
+from __future__ import annotations
+
+import argparse
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from backend.db import Database  # noqa: E402
+
+SCHEMA = [
+    "CREATE TABLE records (id INTEGER PRIMARY KEY AUTOINCREMENT, prompt TEXT, image_path TEXT, created_at TEXT)",
+    "CREATE TABLE record_images (id INTEGER PRIMARY KEY AUTOINCREMENT, record_id INTEGER, kind TEXT, image_path TEXT, created_at TEXT)",
+    "CREATE TABLE blobs (digest TEXT PRIMARY KEY, refcount INTEGER NOT NULL DEFAULT 0)",
+    "INSERT INTO blobs (digest, refcount) VALUES ('d', 0)",
+]
+
+
+def _write_one(conn: sqlite3.Connection, i: int) -> int:
+    cur = conn.execute("INSERT INTO records (prompt, image_path, created_at) VALUES (?, ?, datetime('now'))", (f"p{i}", "x.png"))
+    rid = cur.lastrowid
+    conn.execute("INSERT INTO record_images (record_id, kind, image_path, created_at) VALUES (?, 'input', 'x.png', datetime('now'))", (rid,))
+    conn.execute("UPDATE blobs SET refcount = refcount + 2 WHERE digest = 'd'")
+    return rid
+
+
+def _run_threads(threads: int, writes: int, fn) -> tuple[float, int]:
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker(t: int) -> None:
+        for i in range(writes):
+            try:
+                fn(t * writes + i)
+            except sqlite3.OperationalError:
+                with lock:
+                    errors[0] += 1
+
+    ts = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    t0 = time.perf_counter()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    return time.perf_counter() - t0, errors[0]
+
+
+def bench_legacy(path: Path, threads: int, writes: int) -> tuple[float, int]:
+    with sqlite3.connect(path) as conn:
+        for sql in SCHEMA:
+            conn.execute(sql)
+
+    def one(i: int) -> None:
+        conn = sqlite3.connect(path)
+        try:
+            cur = conn.execute("INSERT INTO records (prompt, image_path, created_at) VALUES (?, ?, datetime('now'))", (f"p{i}", "x.png"))
+            conn.execute("UPDATE blobs SET refcount = refcount + 1 WHERE digest = 'd'")
+            conn.commit()
+            rid = cur.lastrowid
+            conn.execute("SELECT * FROM records WHERE id = ?", (rid,)).fetchone()
+        finally:
+            conn.close()
+        conn = sqlite3.connect(path)
+        try:
+            cur = conn.execute("INSERT INTO record_images (record_id, kind, image_path, created_at) VALUES (?, 'input', 'x.png', datetime('now'))", (rid,))
+            conn.execute("UPDATE blobs SET refcount = refcount + 1 WHERE digest = 'd'")
+            conn.commit()
+            conn.execute("SELECT * FROM record_images WHERE id = ?", (cur.lastrowid,)).fetchone()
+        finally:
+            conn.close()
+
+    return _run_threads(threads, writes, one)
+
+
+def bench_batched(path: Path, threads: int, writes: int) -> tuple[float, int]:
+    db = Database(path)
+
+    def schema(conn: sqlite3.Connection) -> None:
+        for sql in SCHEMA:
+            conn.execute(sql)
+
+    db.write(schema)
+    try:
+        return _run_threads(threads, writes, lambda i: db.write(_write_one, i))
+    finally:
+        db.close()
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--threads", type=int, default=16)
+    ap.add_argument("--writes", type=int, default=200, help="writes per thread")
+    args = ap.parse_args()
+    total = args.threads * args.writes
+    with tempfile.TemporaryDirectory() as d:
+        for name, fn in (("legacy connect-per-call", bench_legacy), ("WAL + batched writer", bench_batched)):
+            elapsed, errors = fn(Path(d) / f"{name.split()[0]}.db", args.threads, args.writes)
+            print(f"{name:>24}: {total / elapsed:9.0f} writes/s  ({elapsed:.2f}s, {errors} lock errors)")
+
+
+if __name__ == "__main__":
+    main()
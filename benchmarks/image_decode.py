@@ -0,0 +1,71 @@
+"""Decode latency: the old HEIC -> RAW -> PIL try-chain vs the magic-byte dispatcher.
+
+    python benchmarks/image_decode.py --size 2048 --repeat 20
+
+The legacy chain is reproduced verbatim from the old _load_image_from_bytes.
+When pillow_heif / rawpy are not installed their import failure is cheap, so
+the gap shown here is a lower bound of what a full install pays per request.
+"""
+from __future__ import annotations
+
+import argparse
+import io
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from PIL import Image  # noqa: E402
+
+from backend.image_decode import decode_image  # noqa: E402
+
+
+def legacy_decode(data: bytes):
+    try:
+        import pillow_heif as _pheif
+
+        heif = _pheif.read_heif(data)
+        return Image.frombytes(heif.mode, heif.size, heif.data)
+    except Exception:
+        pass
+    try:
+        import rawpy as _rawpy
+
+        with _rawpy.imread(io.BytesIO(data)) as raw:
+            rgb = raw.postprocess(use_camera_wb=True, no_auto_bright=True, output_bps=8, gamma=(1, 1))
+        return Image.fromarray(rgb)
+    except Exception:
+        pass
+    return Image.open(io.BytesIO(data)).convert("RGB")
+
+
+def sample(fmt: str, size: int) -> bytes:
+    img = Image.radial_gradient("L").resize((size, size)).convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, format=fmt)
+    return buf.getvalue()
+
+
+def timeit(fn, data: bytes, name: str, repeat: int) -> float:
+    fn(data, name) if fn is decode_image else fn(data)
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn(data, name) if fn is decode_image else fn(data)
+    return (time.perf_counter() - t0) / repeat * 1000
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--size", type=int, default=2048)
+    ap.add_argument("--repeat", type=int, default=20)
+    args = ap.parse_args()
+    for fmt, name in (("JPEG", "a.jpg"), ("PNG", "a.png"), ("WEBP", "a.webp")):
+        data = sample(fmt, args.size)
+        old = timeit(legacy_decode, data, name, args.repeat)
+        new = timeit(decode_image, data, name, args.repeat)
+        print(f"{fmt:>5} {len(data) / 1024:8.0f} KiB  legacy {old:8.2f} ms  dispatch {new:8.2f} ms  ({old / new:4.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
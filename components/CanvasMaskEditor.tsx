@@ -16,6 +16,7 @@ import {
   MagnifyingGlassMinusIcon,
   HandRaisedIcon
 } from '@heroicons/react/24/outline';
+import { maskToRle } from '../services/gemini';
 
 interface CanvasMaskEditorProps {
   imageSrc: string;
@@ -397,24 +398,11 @@ export const CanvasMaskEditor: React.FC<CanvasMaskEditorProps> = ({
   };
 
   const generateMaskBlob = () => {
-    if (!canvasRef.current) return;
-    const maskCanvas = document.createElement('canvas');
-    maskCanvas.width = canvasRef.current.width;
-    maskCanvas.height = canvasRef.current.height;
-    const maskCtx = maskCanvas.getContext('2d');
-    
-    if (maskCtx) {
-      maskCtx.fillStyle = '#000000';
-      maskCtx.fillRect(0, 0, maskCanvas.width, maskCanvas.height);
-      maskCtx.drawImage(canvasRef.current, 0, 0);
-      maskCtx.globalCompositeOperation = 'source-in';
-      maskCtx.fillStyle = '#FFFFFF';
-      maskCtx.fillRect(0, 0, maskCanvas.width, maskCanvas.height);
-    }
-
-    maskCanvas.toBlob((blob) => {
-      if (blob) onMaskGenerated(blob);
-    }, 'image/png');
+    if (!canvasRef.current || !context) return;
+    // 任何已绘制（alpha > 0）的像素都属于遮罩；以 RLE JSON 代替整张 PNG 上传
+    const { width, height } = canvasRef.current;
+    const pixels = context.getImageData(0, 0, width, height).data;
+    onMaskGenerated(maskToRle(pixels, width, height));
   };
 
   // --- Zoom/Pan ---
@@ -1,6 +1,7 @@
 import React, { useState, useRef, useEffect } from 'react';
 import { motion, useMotionValue, useTransform } from 'framer-motion';
 import { ChevronDoubleRightIcon } from '@heroicons/react/24/outline';
+import { staticVariantUrl } from '../services/gemini';
  
 
 interface ImageComparatorProps {
@@ -79,6 +80,21 @@ export const ImageComparator: React.FC<ImageComparatorProps> = ({
     setIsLoaded(loadingCount >= (originalImage && modifiedImage ? 2 : 1));
   }, [loadingCount, originalImage, modifiedImage]);
 
+  // /static 图片按容器宽度请求缩小版本；只升不降，放大查看细节后切换到原图
+  const [variantWidth, setVariantWidth] = useState(0);
+  const [zoomed, setZoomed] = useState(false);
+  useEffect(() => {
+    setVariantWidth((w) => Math.max(w, width));
+  }, [width]);
+  useEffect(() => {
+    if (scale > 1) setZoomed(true);
+  }, [scale]);
+  const displaySrc = (url: string) => {
+    if (zoomed) return url;
+    if (variantWidth > 0) return staticVariantUrl(url, variantWidth) || url;
+    return url.includes('/static/') ? undefined : url;
+  };
+
   const handleWheel: React.WheelEventHandler<HTMLDivElement> = (e) => {
     const rect = containerRef.current?.getBoundingClientRect();
     const cx = rect ? e.clientX - rect.left : 0;
@@ -183,7 +199,7 @@ export const ImageComparator: React.FC<ImageComparatorProps> = ({
       {/* Bottom Image (Modified) */}
       {modifiedImage && (
         <img
-          src={modifiedImage}
+          src={displaySrc(modifiedImage)}
           className="absolute inset-0 w-full h-full object-contain pointer-events-none"
           alt="Modified"
           onLoad={() => setLoadingCount((c) => c + 1)}
@@ -206,7 +222,7 @@ export const ImageComparator: React.FC<ImageComparatorProps> = ({
       >
         {originalImage && (
           <img
-            src={originalImage}
+            src={displaySrc(originalImage)}
             className="absolute inset-0 w-full h-full object-contain pointer-events-none"
             alt="Original"
             onLoad={() => setLoadingCount((c) => c + 1)}
@@ -1,25 +1,29 @@
 import os
 import json
 import base64
-import tempfile
-import requests
 import time
 import logging
 import io
 import sqlite3
 import secrets
+import hashlib
 from datetime import datetime
 from pathlib import Path
 from uuid import uuid4
 from typing import List, Optional
 
-from fastapi import Depends, FastAPI, File, Form, HTTPException, Request, UploadFile
-from starlette.responses import StreamingResponse
+from fastapi import Depends, FastAPI, HTTPException, Request, UploadFile
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import asyncio
 import threading
 import mimetypes
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 def _load_local_env():
     paths = [Path('.local.env'), Path('.env.local')]
     for p in paths:
@@ -128,7 +132,28 @@ def _get_cors_allow_origins() -> list[str]:
     return ["*"] # Allow all origins by default for better compatibility
 
 
-app = FastAPI()
+_startup_hooks: list = []
+_shutdown_hooks: list = []
+
+
+@asynccontextmanager
+async def _lifespan(_app: FastAPI):
+    for hook in _startup_hooks:
+        try:
+            hook()
+        except Exception as exc:
+            logger.warning("startup hook %s failed: %s", getattr(hook, "__name__", hook), exc)
+    try:
+        yield
+    finally:
+        for hook in reversed(_shutdown_hooks):
+            try:
+                hook()
+            except Exception as exc:
+                logger.warning("shutdown hook %s failed: %s", getattr(hook, "__name__", hook), exc)
+
+
+app = FastAPI(lifespan=_lifespan)
 _cors_kwargs = dict(
     allow_origins=_get_cors_allow_origins(),
     allow_methods=["*"],
@@ -142,7 +167,9 @@ app.add_middleware(CORSMiddleware, **_cors_kwargs)
 DATA_DIR = Path(os.getenv("DATA_DIR", "./data")).resolve()
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 IMAGES_DIR = DATA_DIR / "images"
+BLOBS_DIR = DATA_DIR / "blobs"
 LOGS_DIR = DATA_DIR / "logs"
+CACHE_DIR = DATA_DIR / "cache"
 IMAGES_DIR.mkdir(parents=True, exist_ok=True)
 LOGS_DIR.mkdir(parents=True, exist_ok=True)
 DB_PATH = DATA_DIR / "app.db"
@@ -168,8 +195,257 @@ logging.basicConfig(
 )
 logger = logging.getLogger("reimagine")
 
-from starlette.staticfiles import StaticFiles
-app.mount("/static", StaticFiles(directory=str(IMAGES_DIR)), name="static")
+from backend.http_pool import UpstreamHTTPPool
+from backend.resilience import CircuitOpen, DeadlineExceeded, Resilience, remaining_budget, request_deadline
+from backend.stream_json import ITEMS_KEY as STREAM_ITEMS_KEY, AnalysisStreamParser
+
+# 上游接口熔断（连续失败后打开，冷却后半开探测）与按观测延迟分位数推导的超时
+_resilience = Resilience(
+    failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5") or 5),
+    cooldown=float(os.getenv("CIRCUIT_COOLDOWN_SECONDS", "30") or 30),
+    min_timeout=float(os.getenv("UPSTREAM_MIN_TIMEOUT", "5") or 5),
+    multiplier=float(os.getenv("UPSTREAM_TIMEOUT_MULTIPLIER", "2") or 2),
+)
+
+# 进程级共享的上游连接池（Gemini / DashScope），keep-alive + 可选 HTTP/2
+_http_pool = UpstreamHTTPPool(resilience=_resilience)
+
+
+def _upstream_prewarm_urls() -> list[str]:
+    urls: list[str] = []
+    if os.getenv("VISION_API_KEY") or os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY"):
+        urls.append(os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta"))
+        if os.getenv("IMAGE_EDIT_ENDPOINT"):
+            urls.append(os.getenv("IMAGE_EDIT_ENDPOINT", ""))
+    if os.getenv("DASHSCOPE_API_KEY"):
+        urls.append(os.getenv("DASHSCOPE_COMPAT_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1"))
+    return urls
+
+
+def _start_upstream_pool() -> None:
+    if not _env_truthy(os.getenv("UPSTREAM_PREWARM", "1")):
+        return
+    connections = max(1, int(os.getenv("UPSTREAM_PREWARM_CONNECTIONS", "2") or 2))
+    _http_pool.prewarm(_upstream_prewarm_urls(), connections=connections)
+
+
+_http_pool.pin(_upstream_prewarm_urls())
+_startup_hooks.append(_start_upstream_pool)
+_shutdown_hooks.append(_http_pool.close)
+
+from backend.blob_store import IMMUTABLE_CACHE_CONTROL, BlobStaticFiles, BlobStore, normalize_ext
+from backend.db import Database
+from backend.derivative_cache import DerivativeCache, derivative_key
+from backend.cpu_pool import CPUPool
+from backend.image_decode import UnsupportedImage, decode_image, sniff_format
+from backend.image_ops import InvalidMaskSpec, UnsupportedOutputFormat, can_encode, composite_mask_crop, prepare_mask_crop, render_convert, render_mask, render_mask_spec, render_model_input, render_preview, render_variant
+from backend.migrations import migrate
+from backend.tiles import TilePyramid
+
+# 图片按内容哈希存储（DATA_DIR/blobs/ab/cd/<sha256>.<ext>），相同内容只写一次
+_blob_store = BlobStore(BLOBS_DIR)
+# /static 同时服务 blob 与旧版 IMAGES_DIR 下的文件
+# STATIC_ACCEL_REDIRECT=/_data 时由 nginx 按 X-Accel-Redirect 直接发送文件（internal location 指向 DATA_DIR）
+_static_accel_prefix = (os.getenv("STATIC_ACCEL_REDIRECT") or "").strip()
+_static_files = BlobStaticFiles(
+    store=_blob_store,
+    directory=str(IMAGES_DIR),
+    accel_redirect=(_static_accel_prefix, DATA_DIR) if _static_accel_prefix else None,
+)
+app.mount("/static", _static_files, name="static")
+
+from backend.analysis_cache import AnalysisCache, analysis_cache_key
+from backend.metrics import metrics
+from backend.singleflight import FanoutRegistry, FlightCancelled, SingleFlight, StreamCost, flight_key
+from backend.bounded_executor import BoundedExecutor, Reservation, Saturated
+from backend.upstream_scheduler import PRIORITIES, SlotCancelled, UpstreamScheduler
+from backend.provider_router import ProviderRouter
+
+QWEN_ANALYZE_MODEL = "qwen3-vl-flash"
+QWEN_STREAM_MODEL = "qwen3-vl-plus"
+
+# 相同图片 + 相同提示词 + 相同模型的分析结果缓存（SQLite，TTL + 容量淘汰）
+_analysis_cache = AnalysisCache(
+    CACHE_DIR / "analysis.db",
+    ttl_seconds=float(os.getenv("ANALYSIS_CACHE_TTL_SECONDS", str(7 * 24 * 3600)) or 7 * 24 * 3600),
+    max_bytes=int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", str(64 * 1024 * 1024)) or 64 * 1024 * 1024),
+)
+metrics.register("analysis_cache", _analysis_cache.stats)
+metrics.register("upstream_pool", _http_pool.stats)
+metrics.register("singleflight", lambda: {"inflight_calls": _singleflight.inflight(), "inflight_streams": _sse_flights.inflight()})
+
+# 解码 / 缩放 / 编码等 CPU 密集的图片处理不在事件循环里执行：默认走线程池（Pillow 编解码时释放 GIL），
+# RAW / HEIF 解码走进程池
+_cpu_pool = CPUPool(
+    threads=int(os.getenv("CPU_POOL_THREADS", "0") or 0) or None,
+    processes=int(os.getenv("CPU_POOL_PROCESSES", str(min(4, os.cpu_count() or 1))) or 0),
+)
+metrics.register("cpu_pool", _cpu_pool.stats)
+_shutdown_hooks.append(_cpu_pool.close)
+_PROCESS_POOL_FORMATS = {"raw", "heif", "avif"}
+
+
+async def _run_image_job(fn, data: bytes, filename: str, *args, **kwargs):
+    """Run a ``backend.image_ops`` job ``fn(data, filename, ...)`` on the CPU pool, mapping decode errors to HTTP errors."""
+    heavy = sniff_format(data, filename) in _PROCESS_POOL_FORMATS
+    try:
+        return await _cpu_pool.run(fn, data, filename, *args, process=heavy, **kwargs)
+    except ImportError:
+        raise HTTPException(status_code=500, detail="Pillow not available on server")
+    except UnsupportedImage:
+        raise HTTPException(status_code=400, detail="Unsupported image payload")
+    except UnsupportedOutputFormat:
+        raise HTTPException(status_code=400, detail="Unsupported output format")
+    except InvalidMaskSpec as exc:
+        raise HTTPException(status_code=400, detail=f"Invalid mask_spec: {exc}")
+    except OSError:
+        # Pillow 报告截断 / 无法识别的图片时抛 OSError
+        raise HTTPException(status_code=400, detail="Unsupported image payload")
+
+
+# /preview、/convert 的结果按 (源图哈希, 操作, 规范化参数) 缓存到磁盘；命中时直接返回文件，不再解码
+_derivative_cache = DerivativeCache(
+    CACHE_DIR / "derivatives",
+    max_bytes=int(os.getenv("DERIVATIVE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)) or 512 * 1024 * 1024),
+)
+metrics.register("derivative_cache", _derivative_cache.stats)
+OUTPUT_FORMAT_EXTS = {"jpeg": ".jpg", "png": ".png", "webp": ".webp", "avif": ".avif", "tiff": ".tiff"}
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+async def _cached_derivative(request: Request, payload, filename: str, op: str, params: dict, ext: str, fn, *args, digest: Optional[str] = None, headers: Optional[dict] = None, **kwargs):
+    """Serve ``fn(payload, filename, *args, **kwargs)`` through the derivative cache.
+
+    ``params`` must capture everything that affects the output. The cache key
+    is the ETag: a matching ``If-None-Match`` gets a 304, a cached file is sent
+    as-is, and only a miss runs the image job. ``payload`` may be a ``Path``
+    (read only on a miss; ``digest`` is then required).
+    """
+    if digest is None:
+        digest = await _cpu_pool.run(BlobStore.digest, payload)
+    key = derivative_key(digest, op, params)
+    headers = {"Cache-Control": "no-cache", **(headers or {}), "ETag": f'"{key}"'}
+    if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    path = _derivative_cache.get(key, ext)
+    if path is not None:
+        return FileResponse(path, media_type=mimetypes.guess_type(path.name)[0], headers=headers)
+    if isinstance(payload, Path):
+        payload = await _cpu_pool.run(payload.read_bytes)
+    data, mime = await _run_image_job(fn, payload, filename, *args, **kwargs)
+    _derivative_cache.put(key, ext, data)
+    return Response(content=data, media_type=mime, headers=headers)
+
+
+# /static/{name}?w=&h=&fmt= ：按需生成缩小 / 转码后的副本（未指定 fmt 时按 Accept 选择 AVIF / WebP / JPEG）
+STATIC_VARIANT_MAX_SIDE = int(os.getenv("STATIC_VARIANT_MAX_SIDE", "4096") or 4096)
+STATIC_VARIANT_FORMATS = ("avif", "webp", "jpeg", "png")
+STATIC_VARIANT_QUALITY = {"avif": 55, "webp": 80, "jpeg": 82}
+# /static 变体不需要鉴权：w / h 向上取整到固定档位，避免任意尺寸把派生缓存撑满
+STATIC_VARIANT_BUCKETS = (64, 128, 256, 384, 512, 768, 1024, 1280, 1600, 2048, 2560, 3200, 4096)
+
+
+def _variant_dim(value: Optional[str]) -> Optional[int]:
+    if not value:
+        return None
+    try:
+        n = int(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="w / h must be integers")
+    if n < 1 or n > STATIC_VARIANT_MAX_SIDE:
+        raise HTTPException(status_code=400, detail=f"w / h must be between 1 and {STATIC_VARIANT_MAX_SIDE}")
+    return next((b for b in STATIC_VARIANT_BUCKETS if b >= n), STATIC_VARIANT_MAX_SIDE)
+
+
+# 只协商当前 Pillow 能编码的格式（旧版 Pillow 没有 AVIF 编码器）
+_NEGOTIABLE_VARIANT_FORMATS = tuple(fmt for fmt in ("avif", "webp") if can_encode(fmt))
+
+
+def _negotiate_variant_format(accept: Optional[str]) -> str:
+    accept = (accept or "").lower()
+    for fmt in _NEGOTIABLE_VARIANT_FORMATS:
+        if f"image/{fmt}" in accept:
+            return fmt
+    return "jpeg"
+
+
+async def _static_variant(full_path: str, stat_result: os.stat_result, scope) -> Response:
+    request = Request(scope)
+    w = _variant_dim(request.query_params.get("w"))
+    h = _variant_dim(request.query_params.get("h"))
+    fmt = (request.query_params.get("fmt") or "").lower()
+    fmt = {"jpg": "jpeg"}.get(fmt, fmt)
+    headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL}
+    if not fmt:
+        fmt = _negotiate_variant_format(request.headers.get("accept"))
+        headers["Vary"] = "Accept"
+    elif fmt not in STATIC_VARIANT_FORMATS:
+        raise HTTPException(status_code=400, detail="fmt must be one of " + ", ".join(STATIC_VARIANT_FORMATS))
+    src = Path(full_path)
+    digest = _blob_store.parse_name(src.name) or f"{src}:{stat_result.st_mtime_ns}:{stat_result.st_size}"
+    return await _cached_derivative(
+        request,
+        src,
+        src.name,
+        "variant",
+        {"w": w, "h": h, "fmt": fmt},
+        OUTPUT_FORMAT_EXTS[fmt],
+        render_variant,
+        w,
+        h,
+        fmt,
+        STATIC_VARIANT_QUALITY.get(fmt),
+        digest=digest,
+        headers=headers,
+    )
+
+
+_static_files.variants = _static_variant
+
+
+# 最终输出图的深度缩放瓦片（/tiles/{image}/{z}/{x}_{y}.webp）：入库时后台整体生成，请求时缺哪层补哪层
+_tiles = TilePyramid(
+    CACHE_DIR / "tiles",
+    tile_size=int(os.getenv("TILE_SIZE", "256") or 256),
+    max_bytes=int(os.getenv("TILE_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)) or 1024 * 1024 * 1024),
+)
+metrics.register("tiles", _tiles.stats)
+
+
+def _schedule_tiles(image_path: str) -> None:
+    digest = _blob_store.owns(image_path)
+    if digest and not _env_truthy(os.getenv("TILES_DISABLED", "0")):
+        _cpu_pool.submit(_tiles.build, digest, str(image_path))
+
+
+def _resolve_tile_source(image: str) -> tuple[str, Path]:
+    digest = _blob_store.parse_name(image) or (image if len(image) == 64 else None)
+    src = _blob_store.find(digest) if digest else None
+    if src is None:
+        raise HTTPException(status_code=404, detail="image not found")
+    return digest, src
+
+
+async def _tile_info(image: str) -> dict:
+    digest, src = _resolve_tile_source(image)
+    return await _cpu_pool.run(_tiles.info, digest, str(src))
+
+
+async def _tile_file(image: str, z: int, x: int, y: int) -> Path:
+    digest, src = _resolve_tile_source(image)
+    try:
+        return await _cpu_pool.run(_tiles.tile, digest, str(src), z, x, y)
+    except IndexError:
+        raise HTTPException(status_code=404, detail="tile out of range")
 
 
 class RecordModel(BaseModel):
@@ -195,9 +471,21 @@ class RecordDetailModel(RecordModel):
     images: List[RecordImageModel] = []
 
 
+class RecordListItemModel(BaseModel):
+    id: int
+    created_at: str
+    prompt: Optional[str] = None
+    image_path: Optional[str] = None
+    original_name: Optional[str] = None
+    thinking: Optional[str] = None
+    logs: Optional[str] = None
+    raw_response: Optional[str] = None
+
+
 class RecordListResponse(BaseModel):
     total: int
-    items: List[RecordModel]
+    items: List[RecordListItemModel]
+    next_cursor: Optional[str] = None
 
 
 class SmartQuestionModel(BaseModel):
@@ -257,74 +545,24 @@ class SmartSessionGenerateRequest(BaseModel):
     aspect_ratio: Optional[str] = None
 
 
+# WAL + 每线程只读连接 + 单写线程批量提交，避免多个 SSE worker 并发写入时的 database is locked
+_db = Database(
+    DB_PATH,
+    max_batch=int(os.getenv("DB_WRITE_MAX_BATCH", "128") or 128),
+    batch_wait=float(os.getenv("DB_WRITE_BATCH_WAIT_MS", "0") or 0) / 1000,
+)
+_shutdown_hooks.append(_db.close)
+
+
 def _get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Per-thread read connection; all writes go through ``_db.write``."""
+    return _db.reader()
 
 
 def _init_db() -> None:
-    with _get_conn() as conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS records (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                prompt TEXT NOT NULL,
-                thinking TEXT,
-                image_path TEXT NOT NULL,
-                logs TEXT,
-                original_name TEXT,
-                raw_response TEXT,
-                created_at TEXT NOT NULL
-            )
-            """
-        )
-        # Backfill new columns if table already existed
-        cols = {row["name"] for row in conn.execute("PRAGMA table_info(records)")}
-        if "original_name" not in cols:
-            conn.execute("ALTER TABLE records ADD COLUMN original_name TEXT")
-        if "raw_response" not in cols:
-            conn.execute("ALTER TABLE records ADD COLUMN raw_response TEXT")
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS record_images (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                record_id INTEGER NOT NULL,
-                kind TEXT NOT NULL,
-                image_path TEXT NOT NULL,
-                created_at TEXT NOT NULL
-            )
-            """
-        )
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS smart_sessions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                image_path TEXT NOT NULL,
-                original_name TEXT,
-                spec_json TEXT NOT NULL,
-                facts_json TEXT,
-                template_selected TEXT,
-                template_candidates_json TEXT,
-                status TEXT NOT NULL,
-                record_id INTEGER,
-                created_at TEXT NOT NULL,
-                updated_at TEXT NOT NULL
-            )
-            """
-        )
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS smart_session_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id INTEGER NOT NULL,
-                role TEXT NOT NULL,
-                content TEXT NOT NULL,
-                created_at TEXT NOT NULL
-            )
-            """
-        )
-        conn.commit()
+    before, after = _db.write(migrate)
+    if before != after:
+        logger.info("数据库结构已升级 v%d -> v%d", before, after)
 
 
 def _row_to_record(row: sqlite3.Row) -> RecordModel:
@@ -351,19 +589,31 @@ def _row_to_image(row: sqlite3.Row) -> RecordImageModel:
 
 
 def _save_image_bytes(filename: str, data: bytes) -> str:
-    p = Path(filename or "image.png")
-    ext = p.suffix or ".png"
-    prefix = p.stem
-    dest_name = f"{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{prefix}_{uuid4().hex[:4]}{ext}"
-    dest_path = IMAGES_DIR / dest_name
-    with open(dest_path, "wb") as f:
-        f.write(data)
-    logger.info("Saved image to %s (%d bytes)", dest_path, len(data))
+    digest, dest_path, created = _blob_store.put(data, normalize_ext(filename))
+    try:
+        _db.execute(
+            "INSERT OR IGNORE INTO blobs (digest, ext, size_bytes, refcount, created_at) VALUES (?, ?, ?, 0, ?)",
+            (digest, dest_path.suffix, len(data), datetime.utcnow().isoformat()),
+        )
+    except Exception as exc:
+        logger.warning("登记 blob 失败 %s: %s", digest, exc)
+    if created:
+        logger.info("Saved image to %s (%d bytes)", dest_path, len(data))
+    else:
+        logger.info("Reused stored image %s (%d bytes)", dest_path, len(data))
     return str(dest_path)
 
+
+def _blob_ref(conn: sqlite3.Connection, image_path: Optional[str]) -> None:
+    # 只做引用计数统计：生成结果的 URL 在入库前就已返回给客户端，blob 不会被自动删除
+    digest = _blob_store.owns(image_path) if image_path else None
+    if digest:
+        conn.execute("UPDATE blobs SET refcount = refcount + 1 WHERE digest = ?", (digest,))
+
+
 def _download_and_save_image(url: str) -> Optional[str]:
     try:
-        r = requests.get(url, timeout=60)
+        r = _http_pool.get(url, endpoint="download", timeout=60)
         if r.status_code != 200:
             logger.warning("下载输出失败 status=%s url=%s", r.status_code, url)
             return None
@@ -396,110 +646,121 @@ def _file_metadata(path: str) -> dict:
     except Exception:
         return {"path": path, "exists": False}
 
-def _load_image_from_bytes(data: bytes, filename: str):
+def _load_image_from_bytes(data: bytes, filename: str, max_side: Optional[int] = None, size: Optional[tuple] = None, preview: bool = False):
+    # 按文件头识别格式后直接调用对应解码器，不再对每个 JPEG/PNG 先尝试 HEIC / RAW
+    # 传入 max_side / size 时按目标尺寸缩小解码（JPEG DCT 缩放、RAW half-size），而不是先全尺寸解码再缩放
+    # preview=True 时 RAW 优先使用相机内嵌的 JPEG 预览图
     try:
-        from PIL import Image as _Image
-    except Exception:
+        return decode_image(data, filename, max_side=max_side, size=size, preview=preview)
+    except ImportError:
         raise HTTPException(status_code=500, detail="Pillow not available on server")
-    # Try HEIC regardless of extension
-    try:
-        import pillow_heif as _pheif
-        heif = _pheif.read_heif(data)
-        return _Image.frombytes(heif.mode, heif.size, heif.data)
-    except Exception:
-        pass
-    # Try RAW regardless of extension
-    try:
-        import rawpy as _rawpy
-        import numpy as _np
-        with _rawpy.imread(io.BytesIO(data)) as raw:
-            rgb = raw.postprocess(use_camera_wb=True, no_auto_bright=True, output_bps=8, gamma=(1, 1))
-        return _Image.fromarray(rgb)
-    except Exception:
-        pass
-    # Fallback to common image types
-    try:
-        return _Image.open(io.BytesIO(data)).convert('RGB')
-    except Exception:
+    except UnsupportedImage:
         raise HTTPException(status_code=400, detail="Unsupported image payload")
 
-def _pil_to_bytes(img, fmt: str, quality: int | None = None, compression: int | None = None, extra_info: dict | None = None):
-    buf = io.BytesIO()
-    f = (fmt or 'jpeg').lower()
-    if f == 'jpeg':
-        q = int(quality or 90)
-        try:
-            img.save(buf, format='JPEG', quality=q, subsampling=0)
-        except Exception:
-            img.save(buf, format='JPEG', quality=q)
-        mime = 'image/jpeg'
-    elif f == 'png':
-        c = int(compression or 6)
-        try:
-            from PIL.PngImagePlugin import PngInfo
-            pi = PngInfo()
-            if extra_info:
-                for k, v in extra_info.items():
-                    try:
-                        pi.add_text(str(k), str(v))
-                    except Exception:
-                        pass
-                if extra_info.get('DateTime'):
-                    try:
-                        pi.add_text('CreationTime', str(extra_info['DateTime']))
-                    except Exception:
-                        pass
-            img.save(buf, format='PNG', compress_level=c, pnginfo=pi)
-        except Exception:
-            img.save(buf, format='PNG', compress_level=c)
-        mime = 'image/png'
-    elif f == 'webp':
-        q = int(quality or 85)
-        img.save(buf, format='WEBP', quality=q)
-        mime = 'image/webp'
-    elif f == 'tiff':
-        try:
-            from PIL.TiffImagePlugin import ImageFileDirectory_v2
-            ifd = ImageFileDirectory_v2()
-            if extra_info:
-                desc = str(extra_info.get('Description') or '')
-                cr = str(extra_info.get('Copyright') or '')
-                artist = str(extra_info.get('Artist') or '')
-                software = str(extra_info.get('Software') or '')
-                dt = str(extra_info.get('DateTime') or '')
-                if desc:
-                    ifd[270] = desc
-                if cr:
-                    ifd[33432] = cr
-                if artist:
-                    ifd[315] = artist
-                if software:
-                    ifd[305] = software
-                if dt:
-                    ifd[306] = dt
-            img.save(buf, format='TIFF', tiffinfo=ifd)
-        except Exception:
-            img.save(buf, format='TIFF')
-        mime = 'image/tiff'
-    else:
-        raise HTTPException(status_code=400, detail="Unsupported output format")
-    return buf.getvalue(), mime
+MODEL_INPUT_MAX_SIDE = 2048
+_RAW_HEIC_EXTS = {".heic", ".heif", ".dng", ".raw", ".arw", ".cr2", ".nef", ".raf", ".orf", ".rw2"}
+
+
+def _resolve_image_handle(ref: str) -> Path:
+    """Resolve an ``image_id`` (``<sha256><ext>``) or a ``/static/...`` URL to a stored file.
+
+    Legacy outputs that still live in the flat IMAGES_DIR are imported into the
+    blob store on first reference so later lookups hit the content-addressed path.
+    """
+    s = (ref or "").strip()
+    if not s:
+        raise HTTPException(status_code=400, detail="empty image_id")
+    if "/static/" in s:
+        s = s.split("/static/", 1)[1]
+    s = s.split("?", 1)[0].split("#", 1)[0]
+    if not s or "/" in s or "\\" in s or s in {".", ".."}:
+        raise HTTPException(status_code=400, detail="invalid image_id")
+    p = _blob_store.resolve(s)
+    if p is not None:
+        return p
+    legacy = IMAGES_DIR / s
+    if legacy.is_file():
+        return Path(_save_image_bytes(legacy.name, legacy.read_bytes()))
+    raise HTTPException(status_code=404, detail=f"image {s} not found")
+
+
+def _read_image_handle(ref: str) -> tuple[Path, bytes]:
+    """``_resolve_image_handle`` plus the file's bytes; blocking, call via ``run_in_threadpool``."""
+    p = _resolve_image_handle(ref)
+    return p, p.read_bytes()
+
+
+async def _read_image_input(image: Optional[UploadFile], image_id: Optional[str]) -> tuple[str, str, Optional[bytes]]:
+    """Return ``(stored_path, filename, payload)`` for an upload or an ``image_id`` handle.
+
+    For handles ``payload`` is ``None``; callers that need the bytes read them
+    from ``stored_path`` only when a cached derivative cannot be used.
+    """
+    if isinstance(image_id, str) and image_id.strip():
+        p = await run_in_threadpool(_resolve_image_handle, image_id)
+        return str(p), p.name, None
+    if image is None:
+        raise HTTPException(status_code=400, detail="image or image_id is required")
+    payload = await image.read()
+    if not payload:
+        raise HTTPException(status_code=400, detail="No image payload")
+    stored = await run_in_threadpool(_save_image_bytes, image.filename or "image.png", payload)
+    return stored, image.filename or "image.png", payload
+
+
+def _model_input_format(filename: str) -> tuple[str, str]:
+    ext = (Path(filename or "").suffix or "").lower()
+    if ext in [".jpg", ".jpeg"] or ext in _RAW_HEIC_EXTS:
+        return "jpeg", "image/jpeg"
+    return "png", "image/png"
+
+
+async def _model_input_for(stored_path: str, filename: str, payload: Optional[bytes] = None, max_side: int = MODEL_INPUT_MAX_SIDE) -> tuple[bytes, str, str, tuple[int, int]]:
+    """Normalized model-input bytes (resized to ``max_side``) for a stored image.
+
+    Results are cached on disk against the blob digest, so chained edits that
+    reference the same ``image_id`` skip the decode/resize/encode round trip.
+    Returns ``(bytes, fmt, mime, (width, height))``.
+    """
+    fmt, mime = _model_input_format(filename)
+    digest = _blob_store.owns(stored_path)
+    cache_path = None
+    if digest:
+        cache_path = CACHE_DIR / "model_input" / digest[:2] / f"{digest}_{int(max_side)}.{'jpg' if fmt == 'jpeg' else 'png'}"
+        cached = await run_in_threadpool(_read_model_input_cache, cache_path)
+        if cached is not None:
+            return cached[0], fmt, mime, cached[1]
+    if payload is None:
+        payload = await run_in_threadpool(Path(stored_path).read_bytes)
+    data, size = await _run_image_job(render_model_input, payload, filename or "image.bin", fmt, int(max_side))
+    if cache_path is not None:
+        await run_in_threadpool(_write_model_input_cache, cache_path, data)
+    return data, fmt, mime, size
+
+
+def _read_model_input_cache(cache_path: Path) -> Optional[tuple[bytes, tuple[int, int]]]:
+    from PIL import Image as _Image
 
-def _resize_image_max(img, max_side: int):
     try:
-        w, h = img.size
-        m = int(max_side)
-        if w <= m and h <= m:
-            return img
-        if w >= h:
-            nw = m
-            nh = int(h * m / w)
-        else:
-            nh = m
-            nw = int(w * m / h)
-        return img.resize((nw, nh))
-    except Exception:
-        return img
+        data = cache_path.read_bytes()
+        with _Image.open(io.BytesIO(data)) as probe:
+            return data, probe.size
+    except FileNotFoundError:
+        return None
+    except Exception as exc:
+        logger.warning("model input cache unreadable %s: %s", cache_path, exc)
+        return None
+
+
+def _write_model_input_cache(cache_path: Path, data: bytes) -> None:
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(f".tmp-{uuid4().hex}")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, cache_path)
+    except Exception as exc:
+        logger.warning("model input cache write failed %s: %s", cache_path, exc)
+
 
 def _write_json_log(operation: str, input_path: str | None, output_urls: list[str] | None, params: dict | None, steps: list | None, summary: str | None, events: list[dict] | None, local_output_paths: Optional[list[str]] = None, record_id: Optional[int] = None) -> str:
     payload = {
@@ -526,9 +787,7 @@ def _write_json_log(operation: str, input_path: str | None, output_urls: list[st
 
 def _update_record_logs(record_id: int, logs_path: str) -> None:
     try:
-        with _get_conn() as conn:
-            conn.execute("UPDATE records SET logs = ? WHERE id = ?", (logs_path, record_id))
-            conn.commit()
+        _db.execute("UPDATE records SET logs = ? WHERE id = ?", (logs_path, record_id))
         logger.info("记录 %s 日志路径更新: %s", record_id, logs_path)
     except Exception as exc:
         logger.warning("更新记录日志失败: %s", exc)
@@ -543,7 +802,8 @@ def _insert_record(
     raw_response: Optional[str] = None,
 ) -> RecordModel:
     created_at = datetime.utcnow().isoformat()
-    with _get_conn() as conn:
+
+    def _write(conn: sqlite3.Connection) -> int:
         cur = conn.execute(
             """
             INSERT INTO records (prompt, thinking, image_path, logs, original_name, raw_response, created_at)
@@ -551,19 +811,28 @@ def _insert_record(
             """,
             (prompt, thinking, image_path, logs, original_name, raw_response, created_at),
         )
-        conn.commit()
-        new_id = cur.lastrowid
-        row = conn.execute(
-            "SELECT id, prompt, thinking, image_path, logs, original_name, raw_response, created_at FROM records WHERE id = ?",
-            (new_id,),
-        ).fetchone()
+        _blob_ref(conn, image_path)
+        return int(cur.lastrowid)
+
+    new_id = _db.write(_write)
+    _bump_records_total()
     logger.info("Created record %s", new_id)
-    return _row_to_record(row)
+    return RecordModel(
+        id=new_id,
+        prompt=prompt,
+        thinking=thinking,
+        image_path=image_path,
+        logs=logs,
+        original_name=original_name,
+        raw_response=raw_response,
+        created_at=created_at,
+    )
 
 
 def _insert_record_image(record_id: int, kind: str, image_path: str) -> RecordImageModel:
     created_at = datetime.utcnow().isoformat()
-    with _get_conn() as conn:
+
+    def _write(conn: sqlite3.Connection) -> int:
         cur = conn.execute(
             """
             INSERT INTO record_images (record_id, kind, image_path, created_at)
@@ -571,14 +840,14 @@ def _insert_record_image(record_id: int, kind: str, image_path: str) -> RecordIm
             """,
             (record_id, kind, image_path, created_at),
         )
-        conn.commit()
-        new_id = cur.lastrowid
-        row = conn.execute(
-            "SELECT id, record_id, kind, image_path, created_at FROM record_images WHERE id = ?",
-            (new_id,),
-        ).fetchone()
+        _blob_ref(conn, image_path)
+        return int(cur.lastrowid)
+
+    new_id = _db.write(_write)
     logger.info("Saved record image %s (record=%s kind=%s)", new_id, record_id, kind)
-    return _row_to_image(row)
+    if kind == "final":
+        _schedule_tiles(image_path)
+    return RecordImageModel(id=new_id, record_id=record_id, kind=kind, image_path=image_path, created_at=created_at)
 
 
 def _get_record(record_id: int) -> Optional[RecordModel]:
@@ -604,21 +873,79 @@ def _list_record_images(record_id: int) -> List[RecordImageModel]:
     return [_row_to_image(r) for r in rows]
 
 
-def _list_records(limit: int = 50, offset: int = 0) -> RecordListResponse:
-    with _get_conn() as conn:
+RECORD_LIST_FIELDS = ("prompt", "image_path", "original_name", "thinking", "logs", "raw_response")
+# 列表默认只返回轻量字段；thinking / logs / raw_response 常为数十 KB 的模型 JSON，需显式 fields= 请求
+RECORD_LIST_DEFAULT_FIELDS = ("prompt", "image_path", "original_name")
+_RECORDS_TOTAL_TTL = float(os.getenv("RECORDS_TOTAL_TTL_SECONDS", "30") or 30)
+_records_total_cache: dict = {"value": None, "at": 0.0}
+_records_total_lock = threading.Lock()
+
+
+def _parse_record_fields(fields: Optional[str]) -> tuple:
+    if not fields or not fields.strip():
+        return RECORD_LIST_DEFAULT_FIELDS
+    wanted = [f.strip() for f in fields.split(",") if f.strip()]
+    if "all" in wanted:
+        return RECORD_LIST_FIELDS
+    unknown = [f for f in wanted if f not in RECORD_LIST_FIELDS and f not in ("id", "created_at")]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"unknown fields: {', '.join(unknown)}")
+    return tuple(f for f in RECORD_LIST_FIELDS if f in wanted)
+
+
+def _parse_record_cursor(after: Optional[str]) -> Optional[tuple[str, int]]:
+    if not after:
+        return None
+    try:
+        created_at, rid = after.rsplit(",", 1)
+        return created_at, int(rid)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid cursor, expected after=<created_at>,<id>")
+
+
+def _records_total(conn: sqlite3.Connection) -> int:
+    """COUNT(*) cached for a few seconds; _insert_record keeps the cached value current."""
+    now = time.monotonic()
+    with _records_total_lock:
+        cached = _records_total_cache["value"]
+        if cached is not None and now - _records_total_cache["at"] < _RECORDS_TOTAL_TTL:
+            return cached
+    total = int(conn.execute("SELECT COUNT(1) FROM records").fetchone()[0])
+    with _records_total_lock:
+        _records_total_cache.update(value=total, at=now)
+    return total
+
+
+def _bump_records_total(delta: int = 1) -> None:
+    with _records_total_lock:
+        if _records_total_cache["value"] is not None:
+            _records_total_cache["value"] += delta
+
+
+def _list_records(limit: int = 50, offset: int = 0, after: Optional[str] = None, fields: Optional[str] = None) -> RecordListResponse:
+    """Newest-first page of records.
+
+    ``after=<created_at>,<id>`` (the previous page's ``next_cursor``) seeks via
+    the (created_at, id) index instead of scanning past ``offset`` rows.
+    """
+    cols = _parse_record_fields(fields)
+    cursor = _parse_record_cursor(after)
+    select = ", ".join(("id", "created_at") + cols)
+    conn = _get_conn()
+    if cursor is not None:
         rows = conn.execute(
-            """
-            SELECT id, prompt, thinking, image_path, logs, original_name, raw_response, created_at
-            FROM records
-            ORDER BY created_at DESC
-            LIMIT ? OFFSET ?
-            """,
+            f"SELECT {select} FROM records WHERE (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?",
+            (cursor[0], cursor[1], limit),
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            f"SELECT {select} FROM records ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?",
             (limit, offset),
         ).fetchall()
-        total_row = conn.execute("SELECT COUNT(1) as c FROM records").fetchone()
-        total = total_row["c"] if total_row else 0
-    items = [_row_to_record(r) for r in rows]
-    return RecordListResponse(total=total, items=items)
+    total = _records_total(conn)
+    items = [RecordListItemModel(**dict(r)) for r in rows]
+    next_cursor = f"{rows[-1]['created_at']},{rows[-1]['id']}" if len(rows) == limit else None
+    return RecordListResponse(total=total, items=items, next_cursor=next_cursor)
 
 
 def _now_iso() -> str:
@@ -641,7 +968,8 @@ def _json_loads(s: Optional[str], default: object):
 def _insert_smart_session(image_path: str, original_name: Optional[str], spec: dict, facts: Optional[dict], status: str, record_id: Optional[int] = None) -> int:
     created_at = _now_iso()
     updated_at = created_at
-    with _get_conn() as conn:
+
+    def _write(conn: sqlite3.Connection) -> int:
         cur = conn.execute(
             """
             INSERT INTO smart_sessions (image_path, original_name, spec_json, facts_json, template_selected, template_candidates_json, status, record_id, created_at, updated_at)
@@ -660,9 +988,11 @@ def _insert_smart_session(image_path: str, original_name: Optional[str], spec: d
                 updated_at,
             ),
         )
-        conn.commit()
+        _blob_ref(conn, image_path)
         return int(cur.lastrowid)
 
+    return _db.write(_write)
+
 
 def _update_smart_session(session_id: int, spec: Optional[dict] = None, facts: Optional[dict] = None, template_selected: Optional[str] = None, template_candidates: Optional[list] = None, status: Optional[str] = None, record_id: Optional[int] = None) -> None:
     fields = []
@@ -688,9 +1018,7 @@ def _update_smart_session(session_id: int, spec: Optional[dict] = None, facts: O
     fields.append("updated_at = ?")
     vals.append(_now_iso())
     vals.append(session_id)
-    with _get_conn() as conn:
-        conn.execute(f"UPDATE smart_sessions SET {', '.join(fields)} WHERE id = ?", tuple(vals))
-        conn.commit()
+    _db.execute(f"UPDATE smart_sessions SET {', '.join(fields)} WHERE id = ?", tuple(vals))
 
 
 def _get_smart_session(session_id: int) -> Optional[dict]:
@@ -722,15 +1050,13 @@ def _get_smart_session(session_id: int) -> Optional[dict]:
 
 def _add_smart_session_message(session_id: int, role: str, content: str) -> None:
     created_at = _now_iso()
-    with _get_conn() as conn:
-        conn.execute(
-            """
-            INSERT INTO smart_session_messages (session_id, role, content, created_at)
-            VALUES (?, ?, ?, ?)
-            """,
-            (session_id, role, content, created_at),
-        )
-        conn.commit()
+    _db.execute(
+        """
+        INSERT INTO smart_session_messages (session_id, role, content, created_at)
+        VALUES (?, ?, ?, ?)
+        """,
+        (session_id, role, content, created_at),
+    )
 
 
 def _list_smart_session_messages(session_id: int, limit: int = 50) -> List[dict]:
@@ -954,44 +1280,41 @@ def _sse_event(obj: dict):
     return f"data:{json.dumps(obj, ensure_ascii=False)}\n\n"
 
 def _extract_professional_items(buffer: str, sent_count: int):
-    items = []
-    idx = buffer.find("\"professional_analysis\"")
-    if idx == -1:
-        return items
-    arr_start = buffer.find("[", idx)
-    if arr_start == -1:
-        return items
-    i = arr_start + 1
-    brace = 0
-    cur = []
-    count = 0
-    while i < len(buffer):
-        ch = buffer[i]
-        cur.append(ch)
-        if ch == "{":
-            brace += 1
-        elif ch == "}":
-            brace -= 1
-            if brace == 0:
-                seg = "{" + "".join(cur).split("{",1)[1]
-                try:
-                    obj = json.loads(seg)
-                    count += 1
-                    if count > sent_count:
-                        items.append(obj)
-                except Exception:
-                    pass
-                cur = []
-                j = i + 1
-                while j < len(buffer) and buffer[j] in [",", " ", "\n", "\r", "\t"]:
-                    j += 1
-                i = j - 1
-        elif ch == "]":
-            break
-        i += 1
-    return items
+    # 兼容旧接口：一次性解析完整 buffer；流式场景请直接使用 AnalysisStreamParser
+    parser = AnalysisStreamParser()
+    items = [v for k, v in parser.feed(buffer) if k == STREAM_ITEMS_KEY]
+    return items[sent_count:]
+
+def _image_digest(image_path: str) -> str:
+    digest = _blob_store.owns(image_path)
+    if digest:
+        return digest
+    h = hashlib.sha256()
+    with open(image_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _analysis_cache_key(image_path: str, user_prompt: str, model: str, use_cache: bool = True) -> Optional[str]:
+    """Cache key for an analysis call, or ``None`` when caching is bypassed/disabled."""
+    if not use_cache or _env_truthy(os.getenv("ANALYSIS_CACHE_DISABLED")):
+        return None
+    try:
+        return analysis_cache_key(_image_digest(image_path), get_enhanced_prompt(user_prompt), model)
+    except Exception as exc:
+        logger.info("analysis cache key unavailable: %s", exc)
+        return None
+
 
-def analyze_image_with_qwen3_vl_plus(image_path: str, user_prompt: str = "", verbose: bool = True, stream_output: bool = True, enable_thinking: bool = False):
+def analyze_image_with_qwen3_vl_plus(image_path: str, user_prompt: str = "", verbose: bool = True, stream_output: bool = True, enable_thinking: bool = False, use_cache: bool = True):
+    model = QWEN_ANALYZE_MODEL
+    cache_key = _analysis_cache_key(image_path, user_prompt, model, use_cache)
+    if cache_key:
+        cached = _analysis_cache.get(cache_key)
+        if cached is not None:
+            logger.info("analysis cache hit model=%s image=%s", model, Path(image_path).name)
+            return cached
     prompt_text = get_enhanced_prompt(user_prompt)
     with open(image_path, 'rb') as image_file:
         base64_image = base64.b64encode(image_file.read()).decode('utf-8')
@@ -1023,7 +1346,7 @@ def analyze_image_with_qwen3_vl_plus(image_path: str, user_prompt: str = "", ver
     url = base_url.rstrip("/") + "/chat/completions"
     headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
     body = {
-        "model": "qwen3-vl-flash",
+        "model": model,
         "messages": messages,
         "temperature": 0.1,
         "top_p": 0.1,
@@ -1035,36 +1358,45 @@ def analyze_image_with_qwen3_vl_plus(image_path: str, user_prompt: str = "", ver
         },
     }
     print("HTTP兼容模式调用")
-    r = requests.post(url, json=body, headers=headers, timeout=180, stream=bool(stream_output))
-    print(f"HTTP状态码: {r.status_code}")
-    if r.status_code != 200:
-        try:
-            print(f"响应: {r.text[:300]}")
-        except Exception:
-            pass
-        return None
     if stream_output:
         text = ""
-        for line in r.iter_lines():
-            if not line:
-                continue
-            try:
-                s = line.decode("utf-8").strip()
-                if not s:
+        with _http_pool.stream("POST", url, endpoint="dashscope.chat_stream", json=body, headers=headers, timeout=180) as r:
+            print(f"HTTP状态码: {r.status_code}")
+            if r.status_code != 200:
+                try:
+                    r.read()
+                    print(f"响应: {r.text[:300]}")
+                except Exception:
+                    pass
+                return None
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                try:
+                    s = line.strip()
+                    if not s:
+                        continue
+                    if s.startswith("data:"):
+                        s = s[5:].strip()
+                    data = json.loads(s)
+                    chs = data.get("choices") or []
+                    if chs:
+                        delta = chs[0].get("delta") or {}
+                        if delta.get("content"):
+                            c = delta.get("content")
+                            print(c, end='', flush=True)
+                            text += c
+                except Exception:
                     continue
-                if s.startswith("data:"):
-                    s = s[5:].strip()
-                data = json.loads(s)
-                chs = data.get("choices") or []
-                if chs:
-                    delta = chs[0].get("delta") or {}
-                    if delta.get("content"):
-                        c = delta.get("content")
-                        print(c, end='', flush=True)
-                        text += c
-            except Exception:
-                continue
     else:
+        r = _http_pool.post(url, endpoint="dashscope.chat", json=body, headers=headers, timeout=180)
+        print(f"HTTP状态码: {r.status_code}")
+        if r.status_code != 200:
+            try:
+                print(f"响应: {r.text[:300]}")
+            except Exception:
+                pass
+            return None
         data = r.json()
         try:
             text = (data.get("choices") or [{}])[0].get("message", {}).get("content", "")
@@ -1081,7 +1413,10 @@ def analyze_image_with_qwen3_vl_plus(image_path: str, user_prompt: str = "", ver
         cleaned = cleaned[7:]
     if cleaned.endswith("```"):
         cleaned = cleaned[:-3]
-    return json.loads(cleaned.strip())
+    result = json.loads(cleaned.strip())
+    if cache_key:
+        _analysis_cache.put(cache_key, model, result)
+    return result
 
 def _encode_image_to_data_url(file_path: str) -> str:
     mime_type, _ = mimetypes.guess_type(file_path)
@@ -1148,7 +1483,11 @@ def _extract_image_facts_from_ui(ui: Optional[dict]) -> dict:
     }
 
 
-def _analyze_image_facts_best_effort(image_path: str, user_prompt: str = "") -> dict:
+async def _analyze_image_facts_best_effort(image_path: str, user_prompt: str = "", use_cache: bool = True) -> dict:
+    """Image size facts plus model analysis, routed between DashScope and Gemini by ``_provider_router``.
+
+    Each attempt waits for its scheduler slot on the event loop and only then takes an upstream-pool thread.
+    """
     facts: dict = {}
     try:
         from PIL import Image as _Image
@@ -1164,9 +1503,25 @@ def _analyze_image_facts_best_effort(image_path: str, user_prompt: str = "") ->
         )
     except Exception:
         pass
+    backends = []
+    if os.getenv("DASHSCOPE_API_KEY"):
+        backends.append(("dashscope", QWEN_ANALYZE_MODEL))
+    if _get_gemini_api_key():
+        backends.append(("gemini", os.getenv("GEMINI_ANALYZE_MODEL", "gemini-2.0-flash")))
+
+    async def _analyze(provider: str, model: str):
+        if provider == "gemini":
+            fn, kwargs = analyze_image_with_gemini, {"model": model}
+        else:
+            fn, kwargs = analyze_image_with_qwen3_vl_plus, {"stream_output": False, "enable_thinking": False}
+        result = await _run_upstream(fn, image_path, upstream=(provider, "analysis", model), user_prompt=user_prompt or "", use_cache=use_cache, **kwargs)
+        if not isinstance(result, dict):
+            raise RuntimeError(f"{provider}/{model} returned no analysis")
+        return result
+
     try:
-        if os.getenv("DASHSCOPE_API_KEY"):
-            result = analyze_image_with_qwen3_vl_plus(image_path, user_prompt=user_prompt or "", stream_output=False, enable_thinking=False)
+        if backends:
+            result = await _provider_router.arun("image_analysis", backends, _analyze)
             if isinstance(result, dict):
                 ui = result.get("ui_analysis")
                 ui_facts = _extract_image_facts_from_ui(ui if isinstance(ui, dict) else None)
@@ -1417,6 +1772,271 @@ def _compile_prompt(spec: dict, facts: Optional[dict], template_selected: str) -
     return prompt, image_config
 
 
+# 上游模型调用（requests / SDK）均为阻塞 I/O，统一放到有界线程池执行，避免阻塞事件循环
+_UPSTREAM_MAX_WORKERS = max(1, int(os.getenv("UPSTREAM_MAX_WORKERS", "64") or 64))
+_upstream_executor: Optional[ThreadPoolExecutor] = None
+_upstream_executor_lock = threading.Lock()
+
+
+def _upstream_pool() -> ThreadPoolExecutor:
+    # 与 BoundedExecutor 一致：关闭后再有任务时重新创建（TestClient 重入 / reload 会再走一遍 lifespan）
+    global _upstream_executor
+    with _upstream_executor_lock:
+        if _upstream_executor is None:
+            _upstream_executor = ThreadPoolExecutor(max_workers=_UPSTREAM_MAX_WORKERS, thread_name_prefix="upstream")
+        return _upstream_executor
+
+
+# 按 提供方(/模型) × 通道（analysis 轻量分析 / generation 生图）限制并发，rpm / tpm 令牌桶限速；交互请求优先于批量请求
+_upstream_scheduler = UpstreamScheduler.from_env(os.getenv("UPSTREAM_LIMITS"))
+metrics.register("upstream_scheduler", _upstream_scheduler.stats)
+_request_priority: contextvars.ContextVar[str] = contextvars.ContextVar("request_priority", default="interactive")
+_upstream_wait: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar("upstream_wait", default=None)
+
+
+class _UpstreamTimingMiddleware:
+    """Reads ``X-Request-Priority: interactive|batch`` and ``X-Request-Timeout: <seconds>``
+    (the caller's deadline, applied to upstream calls) and reports the request's
+    upstream queue wait as ``Server-Timing: upstream-queue;dur=<ms>``."""
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope.get("headers") or [])
+        priority = headers.get(b"x-request-priority", b"").decode("latin-1").strip().lower()
+        prio_token = _request_priority.set(priority if priority in PRIORITIES else "interactive")
+        waits: list = []
+        wait_token = _upstream_wait.set(waits)
+        deadline = None
+        try:
+            budget = float(headers.get(b"x-request-timeout", b"") or 0)
+        except ValueError:
+            budget = 0.0
+        if budget > 0:
+            deadline = time.monotonic() + budget
+        deadline_token = request_deadline.set(deadline)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and waits:
+                message = dict(message)
+                message["headers"] = list(message.get("headers") or []) + [
+                    (b"server-timing", f"upstream-queue;dur={sum(waits) * 1000:.1f}".encode("latin-1"))
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_priority.reset(prio_token)
+            _upstream_wait.reset(wait_token)
+            request_deadline.reset(deadline_token)
+
+
+app.add_middleware(_UpstreamTimingMiddleware)
+metrics.register("circuit", _resilience.stats)
+
+
+@app.exception_handler(CircuitOpen)
+async def _circuit_open_handler(_request: Request, exc: CircuitOpen):
+    return JSONResponse(status_code=503, content={"detail": f"Upstream unavailable: {exc.endpoint}"}, headers={"Retry-After": str(exc.retry_after)})
+
+
+@app.exception_handler(DeadlineExceeded)
+async def _deadline_exceeded_handler(_request: Request, exc: DeadlineExceeded):
+    return JSONResponse(status_code=504, content={"detail": f"Request deadline exceeded: {exc}"})
+
+
+def _note_upstream_wait(ticket) -> None:
+    waits = _upstream_wait.get()
+    if waits is not None:
+        waits.append(ticket.queue_seconds)
+    if ticket.queue_seconds >= 1.0:
+        logger.info("上游排队等待 %.2fs priority=%s", ticket.queue_seconds, _request_priority.get())
+
+
+async def _upstream_slot(provider: str, lane: str, model: Optional[str] = None):
+    acquire = _upstream_scheduler.acquire(provider, lane, model=model, priority=_request_priority.get())
+    left = remaining_budget()
+    if left is None:
+        ticket = await acquire
+    else:
+        # 排队不能超过请求剩余的时间预算
+        try:
+            ticket = await asyncio.wait_for(acquire, max(0.0, left))
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded(f"{provider}.{lane}: request budget spent waiting for an upstream slot")
+    _note_upstream_wait(ticket)
+    return ticket
+
+
+def _upstream_slot_sync(provider: str, lane: str, model: Optional[str] = None, cancel: Optional[threading.Event] = None):
+    """Blocking ``_upstream_slot`` for producer threads (SSE workers); use as ``with``.
+
+    Stops waiting with ``SlotCancelled`` once ``cancel`` is set (e.g. ``flight.cancelled``).
+    """
+    left = remaining_budget()
+    try:
+        ticket = _upstream_scheduler.acquire_sync(
+            provider, lane, model=model, priority=_request_priority.get(), cancel=cancel, timeout=None if left is None else max(0.0, left)
+        )
+    except TimeoutError:
+        raise DeadlineExceeded(f"{provider}.{lane}: request budget spent waiting for an upstream slot")
+    _note_upstream_wait(ticket)
+    return ticket
+
+
+async def _run_upstream(fn, *args, upstream: Optional[tuple] = None, **kwargs):
+    """Run a blocking upstream call on the bounded upstream pool and await its result.
+
+    ``upstream=(provider, lane[, model])`` first waits for a slot from ``_upstream_scheduler``;
+    the slot is held until the call itself finishes, even if the awaiting task is cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    if upstream is None:
+        return await loop.run_in_executor(_upstream_pool(), functools.partial(ctx.run, fn, *args, **kwargs))
+    ticket = await _upstream_slot(*upstream)
+    try:
+        fut = _upstream_pool().submit(ctx.run, fn, *args, **kwargs)
+    except BaseException:
+        ticket.release()
+        raise
+    # 调用方被取消时线程里的上游请求仍在进行，配额要等它真正结束再归还
+    fut.add_done_callback(lambda _f: ticket.release())
+    return await asyncio.wrap_future(fut)
+
+
+# 相同（操作, 图片哈希, 参数）的并发请求合并为一次上游调用；SSE 则将同一事件流广播给所有等待者
+_singleflight = SingleFlight()
+_sse_flights = FanoutRegistry()
+# 所有 SSE 客户端断开后取消上游流，并按已完成流的平均耗时 / token 估算节省量
+_stream_cost = StreamCost()
+
+
+# 每个 (任务, 提供方) 实际调用的熔断端点
+_PROVIDER_ENDPOINTS = {
+    ("image_edit", "gemini"): "gemini.image.{model}",
+    ("image_edit", "dashscope"): "dashscope.image.{model}",
+    ("image_analysis", "gemini"): "gemini.generate.{model}",
+    ("image_analysis", "dashscope"): "dashscope.chat",
+}
+
+
+def _provider_healthy(task: str, provider: str, model: str) -> bool:
+    endpoint = _PROVIDER_ENDPOINTS.get((task, provider))
+    return endpoint is None or not _resilience.is_open(endpoint.format(model=model))
+
+
+def _call_guarded_sdk(endpoint: str, fn, *args, **kwargs):
+    """Run a provider SDK call under the ``endpoint`` breaker; non-200 ``status_code`` of 429 / 5xx counts as a failure."""
+    _resilience.guard(endpoint, float("inf"))  # SDK 自带超时，这里只用熔断
+    start = time.perf_counter()
+    try:
+        resp = fn(*args, **kwargs)
+    except Exception:
+        _resilience.failure(endpoint)
+        raise
+    except BaseException:
+        _resilience.abandon(endpoint)
+        raise
+    status = getattr(resp, "status_code", 200)
+    if isinstance(status, int) and (status == 429 or status >= 500):
+        _resilience.failure(endpoint)
+    else:
+        _resilience.success(endpoint, time.perf_counter() - start)
+    return resp
+
+
+def _failover_retryable(exc: BaseException) -> bool:
+    # 客户端错误（安全拦截、参数问题）与请求截止时间耗尽不切换提供方
+    if isinstance(exc, DeadlineExceeded):
+        return False
+    if isinstance(exc, HTTPException):
+        return exc.status_code >= 500 or exc.status_code == 429
+    return True
+
+
+# 图片编辑 / 分析在 Gemini 与 DashScope 间按滚动延迟与错误率选择后端，失败时自动切换到下一个
+_provider_router = ProviderRouter(
+    policy=(os.getenv("PROVIDER_ROUTING_POLICY", "fastest") or "fastest").strip().lower(),
+    min_samples=int(os.getenv("PROVIDER_ROUTING_MIN_SAMPLES", "5") or 5),
+    max_error_rate=float(os.getenv("PROVIDER_ROUTING_MAX_ERROR_RATE", "0.5") or 0.5),
+    healthy=_provider_healthy,
+    retryable=_failover_retryable,
+)
+metrics.register("provider_router", _provider_router.stats)
+
+
+async def _run_upstream_coalesced(key: str, fn, *args, upstream: Optional[tuple] = None, **kwargs):
+    """``_run_upstream`` that shares one in-flight call (and scheduler slot) among identical concurrent requests."""
+    return await _singleflight.do(key, lambda: _run_upstream(fn, *args, upstream=upstream, **kwargs))
+
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
+
+
+async def _sse_stream(flight, request: Optional[Request] = None):
+    async for evt in flight.subscribe():
+        yield _sse_event(evt)
+        # 客户端已断开：结束订阅，最后一个订阅者离开时 flight.cancelled 被置位
+        if request is not None and await request.is_disconnected():
+            break
+
+
+# SSE 流式任务（逐块读取上游并推送事件）在有界线程池中执行；满载时立即返回 429 + Retry-After，而不是无限开线程
+_stream_workers = BoundedExecutor(
+    "sse",
+    workers=max(1, int(os.getenv("SSE_MAX_WORKERS", "16") or 16)),
+    max_queue=max(0, int(os.getenv("SSE_MAX_QUEUE", "32") or 0)),
+)
+metrics.register("sse_workers", _stream_workers.stats)
+_shutdown_hooks.append(_stream_workers.shutdown)
+
+
+def _stream_saturated(retry_after: int) -> HTTPException:
+    logger.warning("SSE 工作线程已满，拒绝请求 retry_after=%ss", retry_after)
+    return HTTPException(status_code=429, detail="Too many concurrent streams", headers={"Retry-After": str(retry_after)})
+
+
+def _check_stream_capacity() -> None:
+    """Cheap 429 before a stream endpoint stores the upload; the slot itself is taken by ``_reserve_stream_worker``."""
+    if _stream_workers.saturated():
+        raise _stream_saturated(_stream_workers.retry_after())
+
+
+def _reserve_stream_worker(flight=None) -> Reservation:
+    """Admit an SSE producer onto ``_stream_workers`` before any record is written; raises 429 (closing ``flight``) when saturated."""
+    try:
+        return _stream_workers.reserve()
+    except Saturated as exc:
+        if flight is not None:
+            flight.close()
+        raise _stream_saturated(exc.retry_after)
+
+
+def _start_stream_worker(worker, slot: Reservation) -> None:
+    # 复制 contextvars，使工作线程继承请求优先级与排队计时
+    slot.submit(contextvars.copy_context().run, worker)
+
+
+def _shutdown_upstream_executor() -> None:
+    global _upstream_executor
+    with _upstream_executor_lock:
+        pool, _upstream_executor = _upstream_executor, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+_shutdown_hooks.append(_shutdown_upstream_executor)
+
+
 def _get_gemini_api_key() -> Optional[str]:
     return os.getenv("VISION_API_KEY") or os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
 
@@ -1432,7 +2052,7 @@ def _gemini_generate_content(model: str, contents: object, generation_config: Op
         payload["generationConfig"] = generation_config
     if tools:
         payload["tools"] = tools
-    resp = requests.post(url, json=payload, timeout=timeout)
+    resp = _http_pool.post(url, endpoint=f"gemini.generate.{model}", json=payload, timeout=timeout)
     if resp.status_code != 200:
         raise HTTPException(status_code=resp.status_code, detail=f"Gemini error: {resp.text}")
     return resp.json()
@@ -1454,6 +2074,37 @@ def _extract_text_from_gemini(result: dict) -> str:
         return ""
 
 
+def analyze_image_with_gemini(image_path: str, user_prompt: str = "", model: Optional[str] = None, use_cache: bool = True):
+    """Same analysis JSON as ``analyze_image_with_qwen3_vl_plus``, produced by a Gemini model."""
+    model = model or os.getenv("GEMINI_ANALYZE_MODEL", "gemini-2.0-flash")
+    cache_key = _analysis_cache_key(image_path, user_prompt, model, use_cache)
+    if cache_key:
+        cached = _analysis_cache.get(cache_key)
+        if cached is not None:
+            logger.info("analysis cache hit model=%s image=%s", model, Path(image_path).name)
+            return cached
+    with open(image_path, "rb") as f:
+        b64 = base64.b64encode(f.read()).decode("utf-8")
+    contents = [
+        {
+            "parts": [
+                {"inline_data": {"mime_type": _infer_mime_from_filename(image_path), "data": b64}},
+                {"text": get_enhanced_prompt(user_prompt)},
+            ]
+        }
+    ]
+    result = _gemini_generate_content(model, contents, generation_config={"temperature": 0.1, "responseMimeType": "application/json"})
+    cleaned = _extract_text_from_gemini(result)
+    if cleaned.startswith("```json"):
+        cleaned = cleaned[7:]
+    if cleaned.endswith("```"):
+        cleaned = cleaned[:-3]
+    data = json.loads(cleaned.strip())
+    if cache_key and isinstance(data, dict) and data:
+        _analysis_cache.put(cache_key, model, data)
+    return data
+
+
 def _llm_clarify_next(spec: dict, facts: Optional[dict], messages: List[dict], template_candidates: list) -> tuple[dict, list, Optional[str]]:
     model = os.getenv("SMART_LLM_MODEL", "gemini-2.0-flash")
     prompt_obj = {
@@ -1569,7 +2220,7 @@ def _gemini_image_edit_native(model: str, prompt_text: str, image_bytes: bytes,
         if resolution:
             image_config["imageSize"] = resolution
         payload_json["generationConfig"]["imageConfig"] = image_config
-    resp = requests.post(url, json=payload_json, timeout=timeout)
+    resp = _http_pool.post(url, endpoint=f"gemini.image.{model}", json=payload_json, timeout=timeout)
     if resp.status_code != 200:
         raise HTTPException(status_code=resp.status_code, detail=f"Gemini image error: {resp.text}")
     result = resp.json()
@@ -1604,482 +2255,6 @@ def _gemini_image_edit_native(model: str, prompt_text: str, image_bytes: bytes,
     return urls, local_paths, result
 
 
-async def magic_edit(
-    image: UploadFile = File(...),
-    mask: Optional[UploadFile] = File(None),
-    prompt: str = Form(""),
-    n: int = Form(1),
-    size: str = Form(""),
-    watermark: bool = Form(False),
-    negative_prompt: str = Form(""),
-    prompt_extend: bool = Form(True),
-    aspect_ratio: Optional[str] = Form(None),  # 新增：比例参数
-    resolution: Optional[str] = Form(None),    # 新增：分辨率参数
-    step: Optional[int] = Form(None),          # 新增：步骤编号
-):
-    # 优先使用 VISION_API_KEY (Google Gemini OpenAI 兼容模式)
-    vision_api_key = os.getenv("VISION_API_KEY")
-    image_edit_endpoint = os.getenv("IMAGE_EDIT_ENDPOINT")
-    model = os.getenv("IMAGE_EDIT_MODEL", "gemini-3-pro-image-preview")
-
-    if not vision_api_key:
-        # 退回到 DashScope
-        if MultiModalConversation is None:
-            raise HTTPException(status_code=500, detail="dashscope SDK not available on server")
-        api_key = os.getenv("DASHSCOPE_API_KEY")
-        if not api_key:
-            raise HTTPException(status_code=500, detail="Neither VISION_API_KEY nor DASHSCOPE_API_KEY configured")
-    else:
-        api_key = vision_api_key
-
-    payload = await image.read()
-    logger.info("magic_edit received bytes=%d", len(payload or b""))
-    if not payload:
-        raise HTTPException(status_code=400, detail="No image payload")
-    original_local_path = _save_image_bytes(image.filename or "image.png", payload)
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=Path(image.filename or "image").suffix or ".png")
-    tmp.write(payload)
-    tmp.flush(); tmp.close()
-
-    try:
-        try:
-            img = _load_image_from_bytes(payload, image.filename or "image.bin")
-        except Exception:
-            from PIL import Image as _Image
-            img = _Image.open(tmp.name)
-        img = _resize_image_max(img, 2048)
-        
-        # 准备缩放后的图片字节流和对应的 MIME 类型
-        ext = (Path(image.filename or "").suffix or "").lower()
-        raw_heic_exts = {'.heic', '.heif', '.dng', '.raw', '.arw', '.cr2', '.nef', '.raf', '.orf', '.rw2'}
-        if ext in ['.jpg', '.jpeg'] or ext in raw_heic_exts:
-            input_fmt = 'jpeg'
-            input_mime = 'image/jpeg'
-        else:
-            input_fmt = 'png'
-            input_mime = 'image/png'
-        
-        # 使用处理后的图片（缩放后），避免原始图片过大或格式不兼容
-        process_bin, _ = _pil_to_bytes(img, input_fmt, quality=90 if input_fmt=='jpeg' else None)
-        img_data = base64.b64encode(process_bin).decode("utf-8")
-
-        mask_data = None
-        if mask:
-            mask_bin = await mask.read()
-            if mask_bin:
-                try:
-                    mask_img = _load_image_from_bytes(mask_bin, "mask.png")
-                    mask_img = mask_img.resize(img.size) # 确保 Mask 与原图尺寸一致
-                    mask_proc, _ = _pil_to_bytes(mask_img, "png")
-                    mask_data = base64.b64encode(mask_proc).decode("utf-8")
-                except Exception as e:
-                    logger.warning("Failed to process mask: %s", e)
-
-        urls = []
-        local_paths = []
-
-        # 如果是 OpenAI/Google 模式
-        if vision_api_key:
-            logger.info("使用 Google Gemini (Native/REST) 接口进行图片编辑: %s", model)
-            
-            base_url = image_edit_endpoint.replace("/openai/", "") if image_edit_endpoint else "https://generativelanguage.googleapis.com/v1beta"
-            native_url = f"{base_url.rstrip('/')}/models/{model}:generateContent?key={vision_api_key}"
-            
-            # 组合基础提示词和用户指令
-            final_prompt = f"[Standard Quality Requirements]\n{GEMINI_BASE_PROMPT}\n\n[User Specific Edit Instruction]\n{prompt}"
-            if mask_data:
-                final_prompt += "\n\nNote: A mask image is provided. The second image is the mask where white areas indicate where the edits should be applied. Please perform inpainting/editing in the white areas of the mask while keeping other parts unchanged."
-            
-            print("\n" + "="*50)
-            print("FINAL PROMPT SENT TO GEMINI (MAGIC_EDIT):")
-            print(final_prompt)
-            print("="*50 + "\n")
-            logger.info("FINAL PROMPT SENT TO GEMINI (MAGIC_EDIT): \n%s", final_prompt)
-
-            # 构造请求体
-            parts = [
-                {"text": final_prompt},
-                {
-                    "inline_data": {
-                        "mime_type": input_mime,
-                        "data": img_data
-                    }
-                }
-            ]
-            if mask_data:
-                parts.append({
-                    "inline_data": {
-                        "mime_type": "image/png",
-                        "data": mask_data
-                    }
-                })
-
-            payload_json = {
-                "contents": [{
-                    "parts": parts
-                }],
-                "generationConfig": {
-                    "responseModalities": ["TEXT", "IMAGE"]
-                }
-            }
-
-            # 如果传入了比例或分辨率，加入到配置中
-            if aspect_ratio or resolution:
-                image_config = {}
-                if aspect_ratio:
-                    image_config["aspectRatio"] = aspect_ratio
-                if resolution:
-                    image_config["imageSize"] = resolution
-                payload_json["generationConfig"]["imageConfig"] = image_config
-            
-            logger.info("发送请求到 Google Native API: %s (MIME: %s, Ratio: %s, Res: %s)", 
-                        native_url, input_mime, aspect_ratio, resolution)
-            resp_google = requests.post(native_url, json=payload_json, timeout=90) # 增加超时时间
-            
-            if resp_google.status_code == 200:
-                result = resp_google.json()
-                logger.info("Google API 响应成功，正在解析内容...")
-                # 解析返回的 parts 提取图片
-                try:
-                    candidates = result.get("candidates", [])
-                    if not candidates:
-                        logger.warning("Gemini 未返回任何候选结果。完整响应: %s", result)
-                    
-                    for cand in candidates:
-                        finish_reason = cand.get("finishReason")
-                        if finish_reason and finish_reason != "STOP":
-                            logger.warning("Gemini 任务未正常停止，原因: %s", finish_reason)
-                            
-                        parts = cand.get("content", {}).get("parts", [])
-                        if not parts:
-                            logger.warning("Gemini 候选结果中没有 parts。候选内容: %s", cand)
-                            
-                        for part in parts:
-                            img_part = part.get("inline_data") or part.get("inlineData")
-                            if img_part:
-                                b64_out = img_part.get("data")
-                                if not b64_out:
-                                    continue
-                                # 将 base64 转存为本地文件
-                                out_bytes = base64.b64decode(b64_out)
-                                
-                                # 获取正确的后缀
-                                mime_type = img_part.get('mime_type') or img_part.get('mimeType') or 'image/png'
-                                ext = ".png"
-                                if mime_type and ("jpeg" in mime_type or "jpg" in mime_type):
-                                    ext = ".jpg"
-                                
-                                # 文件名包含步骤信息
-                                step_str = f"_step{step}" if step is not None else ""
-                                out_filename = f"gen{step_str}{ext}"
-                                out_path = _save_image_bytes(out_filename, out_bytes)
-                                local_paths.append(out_path)
-                                
-                                # 转换为可以直接访问的 URL
-                                # Always use relative paths for static files to work with Vite proxy
-                                urls.append(f"/static/{Path(out_path).name}")
-                                logger.info("成功提取并保存生成图像: %s", out_path)
-                            elif "file_data" in part or "fileData" in part:
-                                logger.info("Gemini 返回了 file_data: %s", part.get("file_data") or part.get("fileData"))
-                            elif "text" in part:
-                                text_msg = part["text"]
-                                logger.info("Gemini 返回文本消息: %s", text_msg)
-                                # 如果没有图像但有文本，且文本看起来像错误信息，记录下来
-                except Exception as e:
-                    logger.error("解析 Gemini 返回数据失败: %s. 完整响应: %s", str(e), result)
-                
-                size_used = size
-            else:
-                logger.error("Google API 返回错误: %d %s", resp_google.status_code, resp_google.text)
-                raise HTTPException(status_code=resp_google.status_code, detail=f"Google API error: {resp_google.text}")
-
-            # 如果没有生成图片，尝试给出更具体的错误
-            if not urls:
-                error_msg = "Google Gemini 未能生成图像。请检查提示词是否合规或模型是否支持此操作。"
-                # 检查是否有安全过滤
-                if 'result' in locals() and result.get("promptFeedback", {}).get("blockReason"):
-                    error_msg = f"提示词被安全过滤拦截: {result['promptFeedback']['blockReason']}"
-                elif 'result' in locals() and result.get("candidates") and result["candidates"][0].get("finishReason") == "SAFETY":
-                    error_msg = "响应因安全策略被拦截。"
-                
-                logger.error(error_msg)
-                raise HTTPException(status_code=400, detail=error_msg)
-        else:
-            # 原有的 DashScope 逻辑
-            fmt = input_fmt
-            mime = input_mime
-            b64 = img_data # 复用已经缩放好的数据
-            data_url = f"data:{mime};base64,{b64}"
-            contents: list[dict] = [{"image": data_url}]
-            logger.info("magic_edit prompt len=%d", len(prompt or ""))
-            print("magic_edit 提示词:", prompt)
-            if prompt:
-                contents.append({"text": prompt})
-            messages = [{"role": "user", "content": contents}]
-
-            model = os.getenv("IMAGE_EDIT_MODEL", "qwen-image-edit-plus")
-            kwargs = dict(
-                api_key=api_key,
-                model=model,
-                messages=messages,
-                stream=False,
-                n=n,
-                watermark=watermark,
-                negative_prompt=negative_prompt or " ",
-                prompt_extend=prompt_extend,
-            )
-            size_used = _normalize_size_param(size, n)
-            if size_used:
-                kwargs["size"] = size_used
-
-            resp = MultiModalConversation.call(**kwargs)
-            if getattr(resp, "status_code", None) == 200:
-                try:
-                    for c in resp.output.choices[0].message.content:
-                        if isinstance(c, dict) and c.get("image"):
-                            urls.append(c["image"]) 
-                except Exception:
-                    pass
-            else:
-                logger.error("magic_edit 非200 status=%s code=%s message=%s", getattr(resp, "status_code", None), getattr(resp, "code", None), getattr(resp, "message", None))
-                raise HTTPException(status_code=getattr(resp, "status_code", 500), detail=getattr(resp, "message", "image edit failed"))
-
-        if urls:
-            try:
-                # 只有非 Google 模式才需要重新下载 (因为 Google 模式下 local_paths 已经填好了)
-                if not vision_api_key:
-                    for u in urls:
-                        p = _download_and_save_image(u)
-                        if p:
-                            local_paths.append(p)
-                
-                params = {
-                    "model": model,
-                    "n": n,
-                    "size": size_used or size,
-                    "watermark": watermark,
-                    "negative_prompt": negative_prompt,
-                    "prompt_extend": prompt_extend,
-                    "endpoint": image_edit_endpoint or os.getenv("IMAGE_EDIT_ENDPOINT", "https://dashscope.aliyuncs.com/api/v1"),
-                }
-                steps = [{"text": prompt}] if prompt else []
-                events = [
-                    {"level": "INFO", "message": "magic_edit 完成", "outputs": len(urls)},
-                    {"level": "DEBUG", "message": "请求参数", "value": params},
-                ]
-                log_path = _write_json_log("magic_edit", original_local_path, urls, params, steps, prompt, events, local_output_paths=local_paths)
-                rec = _insert_record(
-                    prompt=prompt or "",
-                    thinking=None,
-                    image_path=original_local_path,
-                    logs=log_path,
-                    original_name=image.filename,
-                    raw_response=_safe_json_dump({"urls": urls}),
-                )
-                try:
-                    _insert_record_image(record_id=rec.id, kind="input", image_path=original_local_path)
-                except Exception:
-                    pass
-                try:
-                    if local_paths:
-                        if len(local_paths) == 1:
-                            _insert_record_image(record_id=rec.id, kind="final", image_path=local_paths[0])
-                        else:
-                            for p in local_paths[:-1]:
-                                _insert_record_image(record_id=rec.id, kind="intermediate", image_path=p)
-                            _insert_record_image(record_id=rec.id, kind="final", image_path=local_paths[-1])
-                except Exception as exc:
-                    logger.warning("保存输出图片记录失败: %s", exc)
-            except Exception as exc:
-                logger.warning("magic_edit 写日志失败: %s", exc)
-            try:
-                served_urls: list[str] = []
-                if local_paths:
-                    # Always use relative paths for static files to work with Vite proxy
-                    served_urls = [f"/static/{Path(p).name}" for p in local_paths]
-                else:
-                    served_urls = urls
-                return {"urls": served_urls}
-            except Exception:
-                return {"urls": urls}
-        
-        raise HTTPException(status_code=502, detail="Model returned no image URLs")
-
-    finally:
-        try:
-            os.unlink(tmp.name)
-        except Exception:
-            pass
-
-async def analyze_stream(image: UploadFile = File(...), prompt: str = Form("")):
-    payload = await image.read()
-    logger.info("SSE 收到分析请求 bytes=%d", len(payload))
-    
-    # 保存原图到永久存储
-    saved_image_path = _save_image_bytes(image.filename or "image.png", payload)
-    
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-    tmp.write(payload)
-    tmp.flush()
-    tmp.close()
-    logger.info("SSE 临时文件=%s", tmp.name)
-
-    base_url = os.getenv("DASHSCOPE_COMPAT_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
-    api_key = os.getenv("DASHSCOPE_API_KEY")
-    logger.info("SSE 配置 模型=qwen3-vl-plus接口=%s", base_url)
-
-    async def gen():
-        queue: asyncio.Queue = asyncio.Queue()
-        loop = asyncio.get_running_loop()
-        buffer = ""
-        sent = 0
-        sent_ids: set = set()
-
-        def push(evt: dict):
-            try:
-                asyncio.run_coroutine_threadsafe(queue.put(evt), loop)
-            except Exception as exc:
-                logger.warning("SSE push 失败: %s", exc)
-
-        def worker():
-            fallback_result = None
-            try:
-                from openai import OpenAI
-                client = OpenAI(api_key=api_key, base_url=base_url)
-                with open(tmp.name, "rb") as f:
-                    b64 = base64.b64encode(f.read()).decode("utf-8")
-                data_url = f"data:image/jpeg;base64,{b64}"
-                messages = [{"role":"user","content":[{"type":"image_url","image_url":{"url":data_url}},{"type":"text","text":get_enhanced_prompt(prompt)}]}]
-                resp = client.chat.completions.create(model="qwen3-vl-plus", messages=messages, stream=True, temperature=0.1, top_p=0.1, extra_body={"enable_thinking": False, "thinking_budget": 81920})
-                logger.info("SSE 连接建立，开始流式分析")
-                for chunk in resp:
-                    try:
-                        delta = chunk.choices[0].delta
-                        if delta and getattr(delta, "content", None):
-                            c = delta.content
-                            if c:
-                                if os.getenv("SSE_LOG_CHUNK", "0") == "1":
-                                    logger.info("SSE chunk 长度=%d", len(c))
-                                if os.getenv("SSE_LOG_TEXT", "0") == "1":
-                                    logger.info("%s", c)
-                            nonlocal buffer, sent
-                            buffer += c
-                            new_items = _extract_professional_items(buffer, sent)
-                            for it in new_items:
-                                logger.info("SSE 提取项 序号=%d 类别=%s 类型=%s", sent+1, it.get('category'), it.get('type'))
-                                sent += 1
-                                ui = {"professional_analysis": [it]}
-                                plans = _parse_ui_to_plan_items(ui)
-                                for p in plans:
-                                    pid = p.get("id")
-                                    if pid and pid in sent_ids:
-                                        continue
-                                    if pid:
-                                        sent_ids.add(pid)
-                                    push({"type": "item", "item": p})
-                    except Exception:
-                        continue
-            except Exception as e:
-                logger.warning("SSE 流式调用失败: %s", e)
-                # 回退到非流式分析，确保总结与遗漏项可用
-                try:
-                    fallback_result = analyze_image_with_qwen3_vl_plus(tmp.name, user_prompt=prompt, stream_output=False, enable_thinking=True)
-                    logger.info("SSE 回退分析完成")
-                except Exception as e2:
-                    logger.warning("SSE 回退调用失败: %s", e2)
-            # finalize
-            try:
-                cleaned = buffer.strip()
-                if cleaned.startswith("```json"):
-                    cleaned = cleaned[7:]
-                if cleaned.endswith("```"):
-                    cleaned = cleaned[:-3]
-                data = json.loads(cleaned) if cleaned else {}
-                # 若流式数据不可用，使用回退结果
-                if not isinstance(data, dict) or (isinstance(data, dict) and not data):
-                    if isinstance(fallback_result, dict):
-                        data = fallback_result
-                # 推送未发送过的计划项（包括滤镜推荐等）
-                ui = data.get("ui_analysis") if isinstance(data, dict) else None
-                if isinstance(ui, dict):
-                    final_plans = _parse_ui_to_plan_items(ui)
-                    for p in final_plans:
-                        pid = p.get("id")
-                        if pid and pid in sent_ids:
-                            continue
-                        if pid:
-                            sent_ids.add(pid)
-                        push({"type": "item", "item": p})
-                # 提取总结（包含嵌套 ui_analysis.summary_ui 兜底）
-                summary = ""
-                if isinstance(data, dict):
-                    summary = data.get("summary_ui") or data.get("summary") or ""
-                if not summary and isinstance(ui, dict):
-                    summary = ui.get("summary_ui") or ""
-                # 若仍为空，尝试从回退结果提取
-                if not summary and isinstance(fallback_result, dict):
-                    fu = fallback_result.get("ui_analysis") if isinstance(fallback_result, dict) else None
-                    summary = fallback_result.get("summary_ui") or fallback_result.get("summary") or ((fu or {}).get("summary_ui") or "")
-                summary = sanitize_summary_ui(summary or "")
-                logger.info("SSE 最终总结长度=%d", len(summary or ""))
-                
-                # 保存分析记录到数据库
-                record_id = None
-                try:
-                    thinking_text = _extract_thinking(data if isinstance(data, dict) else None)
-                    raw_json = _safe_json_dump(data) if isinstance(data, (dict, list)) else None
-                    rec = _insert_record(
-                        prompt=prompt or "",
-                        thinking=thinking_text,
-                        image_path=saved_image_path,
-                        logs=raw_json,
-                        original_name=image.filename,
-                        raw_response=raw_json,
-                    )
-                    record_id = rec.id
-                    try:
-                        _insert_record_image(record_id=rec.id, kind="input", image_path=saved_image_path)
-                    except Exception:
-                        pass
-                    logger.info("SSE 已保存分析记录 record_id=%d", record_id)
-                except Exception as exc:
-                    logger.warning("SSE 保存记录失败: %s", exc)
-                
-                try:
-                    params = {
-                        "model": "qwen3-vl-plus",
-                        "base_url": os.getenv("DASHSCOPE_COMPAT_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1"),
-                        "stream": True,
-                    }
-                    steps = final_plans if isinstance(ui, dict) else []
-                    events = [
-                        {"level": "INFO", "message": "SSE 分析完成"},
-                        {"level": "DEBUG", "message": "已发送条目总数", "value": len(sent_ids)},
-                    ]
-                    _write_json_log("analyze_stream", tmp.name, [], params, steps, summary, events, local_output_paths=[], record_id=record_id)
-                except Exception as exc:
-                    logger.warning("SSE 写日志失败: %s", exc)
-                push({"type": "final", "summary": summary})
-            except Exception as e:
-                logger.warning("SSE 最终解析失败: %s", e)
-                push({"type": "final", "summary": ""})
-            finally:
-                push({"type": "__end__"})
-
-        threading.Thread(target=worker, daemon=True).start()
-
-        while True:
-            evt = await queue.get()
-            if isinstance(evt, dict) and evt.get("type") == "__end__":
-                break
-            yield _sse_event(evt)
-
-    headers = {
-        "Cache-Control": "no-cache",
-        "Connection": "keep-alive",
-        "X-Accel-Buffering": "no",
-    }
-    return StreamingResponse(gen(), media_type="text/event-stream", headers=headers)
 def _normalize_size_param(size: str, n: int) -> Optional[str]:
     try:
         if n != 1:
@@ -2104,6 +2279,7 @@ def _normalize_size_param(size: str, n: int) -> Optional[str]:
 from backend.routers import analyze as analyze_router
 from backend.routers import edit as edit_router
 from backend.routers import media as media_router
+from backend.routers import metrics as metrics_router
 from backend.routers import records as records_router
 from backend.routers import smart as smart_router
 
@@ -2112,6 +2288,7 @@ app.include_router(media_router.router)
 app.include_router(analyze_router.router)
 app.include_router(smart_router.router)
 app.include_router(edit_router.router)
+app.include_router(metrics_router.router)
 
 if __name__ == "__main__":
     import uvicorn
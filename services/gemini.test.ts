@@ -1,6 +1,6 @@
 import { describe, expect, it, vi } from 'vitest';
 
-import { getApiBaseUrl, getAuthHeaders, urlToBlob } from './gemini';
+import { getApiBaseUrl, getAuthHeaders, maskToRle, staticVariantUrl, urlToBlob } from './gemini';
 
 describe('services/gemini', () => {
   it('getApiBaseUrl prefers VITE_API_BASE_URL', () => {
@@ -32,4 +32,18 @@ describe('services/gemini', () => {
     const opts = fetchMock.mock.calls[0]?.[1];
     expect(((opts?.headers as any) || {}).Authorization).toBe('Bearer t');
   });
+
+  it('staticVariantUrl picks a width bucket for /static images only', () => {
+    expect(staticVariantUrl('/api/static/abc.png', 500)).toMatch(/\/api\/static\/abc\.png\?w=(640|960|1280|1920)$/);
+    expect(staticVariantUrl('blob:http://x/1', 500)).toBe('blob:http://x/1');
+    expect(staticVariantUrl('/static/abc.png?w=10', 500)).toBe('/static/abc.png?w=10');
+    expect(staticVariantUrl('/static/abc.png', 100000)).toBe('/static/abc.png');
+    expect(staticVariantUrl(null, 500)).toBeNull();
+  });
+
+  it('maskToRle encodes alternating runs starting with unmasked', async () => {
+    const blob = maskToRle([255, 0, 0, 255, 255, 0], 3, 2, 1, 0);
+    expect(blob.type).toBe('application/json');
+    expect(JSON.parse(await blob.text())).toEqual({ size: [3, 2], rle: [0, 1, 2, 2, 1] });
+  });
 });
@@ -82,6 +82,38 @@ export const urlToBlob = async (url: string): Promise<Blob> => {
   return await res.blob();
 };
 
+// 服务端 /static 支持 ?w= 按需缩放（按 Accept 返回 AVIF / WebP / JPEG）；宽度取固定档位以提高缓存命中
+const VARIANT_WIDTHS = [320, 640, 960, 1280, 1920, 2560];
+
+export const staticVariantUrl = (url: string | null, displayWidth: number): string | null => {
+  if (!url || !url.includes('/static/') || /[?&](w|h|fmt)=/.test(url)) return url;
+  const dpr = typeof window !== 'undefined' ? window.devicePixelRatio || 1 : 1;
+  const needed = Math.ceil(displayWidth * dpr);
+  if (!(needed > 0)) return url;
+  const w = VARIANT_WIDTHS.find((v) => v >= needed);
+  if (!w) return url;
+  return `${url}${url.includes('?') ? '&' : '?'}w=${w}`;
+};
+
+// 遮罩以行优先游程编码（未选/选中交替，从未选开始）作为 JSON 上传，服务端直接按模型输入尺寸栅格化，免去整张 PNG
+export const maskToRle = (alpha: ArrayLike<number>, width: number, height: number, stride = 4, offset = 3): Blob => {
+  const counts: number[] = [];
+  let on = false;
+  let run = 0;
+  const total = width * height;
+  for (let i = 0; i < total; i++) {
+    const v = alpha[i * stride + offset] > 0;
+    if (v !== on) {
+      counts.push(run);
+      on = v;
+      run = 0;
+    }
+    run++;
+  }
+  counts.push(run);
+  return new Blob([JSON.stringify({ size: [width, height], rle: counts })], { type: 'application/json' });
+};
+
 // --- Smart Workflow Service ---
 export interface SmartQuestion {
   id: string;
@@ -312,7 +344,8 @@ export const editImage = async (
 
     if (maskBlob) {
       console.log('Uploading mask blob size:', (maskBlob as any)?.size ?? 'unknown');
-      fd.append('mask', maskBlob, 'mask.png');
+      if (maskBlob.type === 'application/json') fd.append('mask_spec', await maskBlob.text());
+      else fd.append('mask', maskBlob, 'mask.png');
     }
 
     const typeWeight = (t?: string) => {
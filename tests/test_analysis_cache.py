@@ -0,0 +1,60 @@
+import time
+
+from backend.analysis_cache import AnalysisCache, analysis_cache_key
+
+
+def test_key_depends_on_image_prompt_and_model():
+    base = analysis_cache_key("a" * 64, "prompt", "m1")
+    assert base == analysis_cache_key("a" * 64, "prompt", "m1")
+    assert base != analysis_cache_key("b" * 64, "prompt", "m1")
+    assert base != analysis_cache_key("a" * 64, "prompt2", "m1")
+    assert base != analysis_cache_key("a" * 64, "prompt", "m2")
+
+
+def test_ttl_expiry(tmp_path, monkeypatch):
+    cache = AnalysisCache(tmp_path / "c" / "analysis.db", ttl_seconds=10)
+    cache.put("k", "m", {"v": 1})
+    assert cache.get("k") == {"v": 1}
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 11)
+    assert cache.get("k") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_size_eviction_drops_least_recently_used(tmp_path):
+    cache = AnalysisCache(tmp_path / "analysis.db", max_bytes=120)
+    cache.put("old", "m", {"v": "x" * 40})
+    time.sleep(0.01)
+    cache.put("hot", "m", {"v": "y" * 40})
+    time.sleep(0.01)
+    assert cache.get("hot") is not None
+    cache.put("new", "m", {"v": "z" * 40})
+    assert cache.get("old") is None
+    assert cache.get("hot") is not None
+    assert cache.get("new") is not None
+
+
+def test_every_connection_is_closed(tmp_path, monkeypatch):
+    import sqlite3
+
+    opened = []
+    connect = sqlite3.connect
+
+    def tracking_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(sqlite3, "connect", tracking_connect)
+    cache = AnalysisCache(tmp_path / "cache.db")
+    cache.put("k", "m", {"a": 1})
+    assert cache.get("k") == {"a": 1}
+    assert cache.get("missing") is None
+    assert cache.stats()["entries"] == 1
+    assert len(opened) == 4
+    for conn in opened:
+        try:
+            conn.execute("SELECT 1")
+        except sqlite3.ProgrammingError:
+            continue
+        raise AssertionError("connection left open")
@@ -1,6 +1,7 @@
 import sys
 from io import BytesIO
 from pathlib import Path
+from types import SimpleNamespace
 
 import pytest
 from fastapi.testclient import TestClient
@@ -25,6 +26,11 @@ def _png_file_bytes() -> bytes:
     return buf.getvalue()
 
 
+def _dashscope_image_resp():
+    message = SimpleNamespace(content=[{"image": "http://example.invalid/img.png"}])
+    return SimpleNamespace(status_code=200, output=SimpleNamespace(choices=[SimpleNamespace(message=message)]))
+
+
 def test_openapi_smoke(client: TestClient):
     resp = client.get("/openapi.json")
     assert resp.status_code == 200
@@ -186,8 +192,11 @@ def test_magic_edit_returns_urls_via_stubbed_model(client: TestClient, monkeypat
 def test_smart_flow_start_answer_generate(client: TestClient, monkeypatch):
     import server
 
+    async def no_facts(*_a, **_k):
+        return {}
+
     monkeypatch.setattr(server, "_get_gemini_api_key", lambda: None)
-    monkeypatch.setattr(server, "_analyze_image_facts_best_effort", lambda *_a, **_k: {})
+    monkeypatch.setattr(server, "_analyze_image_facts_best_effort", no_facts)
     monkeypatch.setattr(server, "_default_spec", lambda *_a, **_k: {})
     monkeypatch.setattr(server, "_route_templates", lambda *_a, **_k: ("photo_retouch", [{"template": "photo_retouch"}]))
     monkeypatch.setattr(server, "_is_ready_to_render", lambda *_a, **_k: True)
@@ -217,3 +226,901 @@ def test_smart_flow_start_answer_generate(client: TestClient, monkeypatch):
     assert gen_data["session_id"] == session_id
     assert isinstance(gen_data.get("urls"), list)
     assert len(gen_data["urls"]) >= 1
+
+
+def test_event_loop_stays_responsive_during_slow_upstream(client: TestClient, monkeypatch):
+    import asyncio
+    import time
+
+    import httpx
+    import server
+
+    class _SlowMMC:
+        @staticmethod
+        def call(**_kwargs):
+            time.sleep(1.0)
+            return _dashscope_image_resp()
+
+    def fake_download_and_save_image(_url: str):
+        p = Path(server.IMAGES_DIR) / "slow_out.png"
+        p.write_bytes(_png_file_bytes())
+        return str(p)
+
+    monkeypatch.setenv("DASHSCOPE_API_KEY", "x")
+    monkeypatch.delenv("VISION_API_KEY", raising=False)
+    monkeypatch.setattr(server, "MultiModalConversation", _SlowMMC)
+    monkeypatch.setattr(server, "_download_and_save_image", fake_download_and_save_image)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            png = _png_file_bytes()
+            edit_task = asyncio.create_task(
+                ac.post("/magic_edit", files={"image": ("t.png", png, "image/png")}, data={"prompt": "x"})
+            )
+            await asyncio.sleep(0.2)
+            t0 = time.perf_counter()
+            probe = await ac.get("/openapi.json")
+            probe_elapsed = time.perf_counter() - t0
+            assert not edit_task.done()
+            edit_resp = await edit_task
+            return probe, probe_elapsed, edit_resp
+
+    probe, probe_elapsed, edit_resp = asyncio.run(scenario())
+    assert probe.status_code == 200
+    assert probe_elapsed < 0.5
+    assert edit_resp.status_code == 200
+
+
+def _fake_stream_client(text: str, chunk_size: int = 5):
+    class _Delta:
+        def __init__(self, content):
+            self.content = content
+
+    class _Chunk:
+        def __init__(self, content):
+            self.choices = [type("Ch", (), {"delta": _Delta(content)})()]
+
+    class _Completions:
+        def create(self, **_kwargs):
+            return iter([_Chunk(text[i : i + chunk_size]) for i in range(0, len(text), chunk_size)])
+
+    class _Client:
+        chat = type("Chat", (), {"completions": _Completions()})()
+
+    return _Client()
+
+
+def test_analyze_stream_emits_items_and_sections_incrementally(client: TestClient, monkeypatch):
+    import json as _json
+
+    import server
+
+    doc = {
+        "ui_analysis": {
+            "photo_basic_info": {"photo_type": "风景"},
+            "professional_analysis": [
+                {"id": "p1", "problem": "暗", "solution": "提亮", "category": "光线色彩", "type": "adjustment"},
+                {"id": "p2", "problem": "噪点", "solution": "降噪", "category": "细节", "type": "adjustment"},
+            ],
+            "summary_ui": "done",
+        }
+    }
+    fake = _fake_stream_client(_json.dumps(doc, ensure_ascii=False))
+    monkeypatch.setattr(server._http_pool, "openai_client", lambda *_a, **_k: fake)
+
+    png = _png_file_bytes()
+    resp = client.post("/analyze_stream", files={"image": ("t.png", png, "image/png")}, data={"prompt": "x"})
+    assert resp.status_code == 200
+    events = [_json.loads(line[5:]) for line in resp.text.split("\n\n") if line.startswith("data:")]
+    types = [e["type"] for e in events]
+    assert [e["item"]["id"] for e in events if e["type"] == "item"] == ["p1", "p2"]
+    assert {"type": "section", "key": "photo_basic_info", "value": {"photo_type": "风景"}} in events
+    assert types.index("section") < types.index("item")
+    assert events[-1] == {"type": "final", "summary": "done"}
+
+
+def test_uploads_are_deduplicated_in_blob_store(client: TestClient):
+    import server
+
+    png = _png_file_bytes()
+    first = client.post("/records", files={"image": ("a.png", png, "image/png")}, data={"prompt": "x"}).json()
+    second = client.post("/records", files={"image": ("b.PNG", png, "image/png")}, data={"prompt": "y"}).json()
+    assert first["image_path"] == second["image_path"]
+    stored = Path(first["image_path"])
+    assert stored.parent.parent.parent == server.BLOBS_DIR
+    assert len([p for p in server.BLOBS_DIR.rglob("*") if p.is_file()]) == 1
+
+    with server._get_conn() as conn:
+        row = conn.execute("SELECT refcount FROM blobs WHERE digest = ?", (stored.stem,)).fetchone()
+    assert row["refcount"] == 4  # records + record_images, twice
+
+    resp = client.get(f"/static/{stored.name}")
+    assert resp.status_code == 200
+    assert resp.content == png
+
+
+def test_app_survives_a_second_lifespan(client: TestClient, monkeypatch):
+    import server
+
+    monkeypatch.setattr(server, "analyze_image_with_qwen3_vl_plus", lambda *_a, **_k: {"items": [], "summary": "ok"})
+    png = _png_file_bytes()
+    for _ in range(2):
+        with TestClient(server.app) as c:
+            assert c.post("/records", files={"image": ("a.png", png, "image/png")}, data={"prompt": "x"}).status_code == 200
+            assert c.post("/analyze", files={"image": ("a.png", png, "image/png")}, data={"no_cache": "true"}).status_code == 200
+
+
+def test_record_writes_run_off_the_event_loop(client: TestClient, monkeypatch):
+    import asyncio
+
+    import server
+
+    on_loop = []
+    real_write = server._db.write
+
+    def write(fn, *args, **kwargs):
+        try:
+            asyncio.get_running_loop()
+            on_loop.append(True)
+        except RuntimeError:
+            on_loop.append(False)
+        return real_write(fn, *args, **kwargs)
+
+    monkeypatch.setattr(server._db, "write", write)
+    resp = client.post("/records", files={"image": ("a.png", _png_file_bytes(), "image/png")}, data={"prompt": "x"})
+    assert resp.status_code == 200
+    # legacy outputs are imported into the blob store on first reference
+    (server.IMAGES_DIR / "legacy.png").write_bytes(_png_file_bytes())
+    assert client.post("/convert", data={"image_id": "legacy.png", "format": "png"}).status_code == 200
+    assert len(on_loop) > 2 and not any(on_loop)
+
+
+def test_magic_edit_accepts_image_id_and_reuses_model_input(client: TestClient, monkeypatch):
+    import server
+
+    sent: list = []
+
+    class _FakeMMC:
+        @staticmethod
+        def call(**kwargs):
+            sent.append(kwargs["messages"][0]["content"][0]["image"])
+            return _dashscope_image_resp()
+
+    monkeypatch.setenv("DASHSCOPE_API_KEY", "x")
+    monkeypatch.delenv("VISION_API_KEY", raising=False)
+    monkeypatch.setattr(server, "MultiModalConversation", _FakeMMC)
+    monkeypatch.setattr(server, "_download_and_save_image", lambda _u: server._save_image_bytes("out.png", _png_file_bytes()))
+
+    up = client.post("/images", files={"image": ("t.png", _png_file_bytes(), "image/png")})
+    assert up.status_code == 200
+    handle = up.json()
+    assert handle["url"] == f"/static/{handle['image_id']}"
+    assert (handle["width"], handle["height"]) == (32, 32)
+
+    for _ in range(2):
+        resp = client.post("/magic_edit", data={"image_id": handle["image_id"], "prompt": "x"})
+        assert resp.status_code == 200
+    assert sent[0] == sent[1]
+    assert len(list((server.CACHE_DIR / "model_input").rglob("*.png"))) == 1
+
+    out_name = resp.json()["urls"][0].rsplit("/static/", 1)[1]
+    chained = client.post("/images", data={"ref": f"/static/{out_name}"})
+    assert chained.json()["image_id"] == out_name
+    assert client.post("/magic_edit", data={"image_id": "0" * 64 + ".png"}).status_code == 404
+    assert client.post("/magic_edit", data={"prompt": "x"}).status_code == 400
+
+
+def test_analyze_stream_replays_cached_analysis(client: TestClient, monkeypatch):
+    import json as _json
+
+    import server
+
+    doc = {
+        "ui_analysis": {
+            "professional_analysis": [
+                {"id": "p1", "problem": "暗", "solution": "提亮", "category": "光线色彩", "type": "adjustment"},
+            ],
+            "summary_ui": "cached-summary",
+        }
+    }
+    calls: list = []
+    fake = _fake_stream_client(_json.dumps(doc, ensure_ascii=False))
+    monkeypatch.setattr(server._http_pool, "openai_client", lambda *_a, **_k: calls.append(1) or fake)
+    hits_before = server.metrics.get("analysis_cache.hit")
+
+    def run(**data):
+        resp = client.post("/analyze_stream", files={"image": ("t.png", _png_file_bytes(), "image/png")}, data={"prompt": "x", **data})
+        assert resp.status_code == 200
+        return [_json.loads(line[5:]) for line in resp.text.split("\n\n") if line.startswith("data:")]
+
+    live = run()
+    replayed = run()
+    assert len(calls) == 1
+    assert [e for e in replayed if e["type"] == "item"] == [e for e in live if e["type"] == "item"]
+    assert replayed[-1] == {"type": "final", "summary": "cached-summary", "cached": True}
+    assert server.metrics.get("analysis_cache.hit") == hits_before + 1
+
+    run(no_cache="true")
+    assert len(calls) == 2
+    assert client.get("/metrics").json()["analysis_cache"]["entries"] == 1
+
+
+def test_concurrent_duplicate_requests_share_one_upstream_call(client: TestClient, monkeypatch):
+    import asyncio
+    import json as _json
+    import time
+
+    import httpx
+    import server
+
+    mmc_calls: list = []
+
+    class _SlowMMC:
+        @staticmethod
+        def call(**_kwargs):
+            mmc_calls.append(1)
+            time.sleep(0.5)
+            return _dashscope_image_resp()
+
+    doc = {"ui_analysis": {"professional_analysis": [{"id": "p1", "problem": "暗", "solution": "提亮"}], "summary_ui": "s"}}
+    text = _json.dumps(doc, ensure_ascii=False)
+    stream_calls: list = []
+
+    class _SlowCompletions:
+        def create(self, **_kwargs):
+            stream_calls.append(1)
+            for i in range(0, len(text), 8):
+                time.sleep(0.02)
+                yield type("C", (), {"choices": [type("Ch", (), {"delta": type("D", (), {"content": text[i : i + 8]})()})()]})()
+
+    fake = type("Client", (), {"chat": type("Chat", (), {"completions": _SlowCompletions()})()})()
+    monkeypatch.setenv("DASHSCOPE_API_KEY", "x")
+    monkeypatch.delenv("VISION_API_KEY", raising=False)
+    monkeypatch.setattr(server, "MultiModalConversation", _SlowMMC)
+    monkeypatch.setattr(server, "_download_and_save_image", lambda _u: server._save_image_bytes("o.png", _png_file_bytes()))
+    monkeypatch.setattr(server._http_pool, "openai_client", lambda *_a, **_k: fake)
+    coalesced_before = server.metrics.get("singleflight.coalesced")
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            png = _png_file_bytes()
+            edits = [ac.post("/magic_edit", files={"image": ("t.png", png, "image/png")}, data={"prompt": "x"}) for _ in range(3)]
+            streams = [
+                ac.post("/analyze_stream", files={"image": ("t.png", png, "image/png")}, data={"prompt": "y", "no_cache": "1"})
+                for _ in range(2)
+            ]
+            return await asyncio.gather(*edits, *streams)
+
+    *edit_resps, s1, s2 = asyncio.run(scenario())
+    assert [r.status_code for r in edit_resps] == [200, 200, 200]
+    assert len(mmc_calls) == 1
+    assert len(stream_calls) == 1
+    assert s1.text == s2.text and s1.text.endswith('data:{"type": "final", "summary": "s"}\n\n')
+    assert server.metrics.get("singleflight.coalesced") - coalesced_before >= 3
+
+
+def test_records_keyset_pagination_and_projection(client: TestClient):
+    png = _png_file_bytes()
+    for i in range(5):
+        client.post("/records", files={"image": ("a.png", png, "image/png")}, data={"prompt": f"p{i}", "raw_response": "x" * 1000})
+
+    first = client.get("/records", params={"limit": 2}).json()
+    assert first["total"] == 5
+    assert [it["prompt"] for it in first["items"]] == ["p4", "p3"]
+    assert set(first["items"][0]) == {"id", "created_at", "prompt", "image_path", "original_name"}
+
+    seen = [it["prompt"] for it in first["items"]]
+    cursor = first["next_cursor"]
+    while cursor:
+        page = client.get("/records", params={"limit": 2, "after": cursor}).json()
+        seen += [it["prompt"] for it in page["items"]]
+        cursor = page["next_cursor"]
+    assert seen == ["p4", "p3", "p2", "p1", "p0"]
+
+    full = client.get("/records", params={"limit": 1, "fields": "prompt,raw_response"}).json()
+    assert set(full["items"][0]) == {"id", "created_at", "prompt", "raw_response"}
+    assert client.get("/records", params={"fields": "nope"}).status_code == 400
+    assert client.get("/records", params={"after": "garbage"}).status_code == 400
+
+
+def test_convert_serves_cached_derivative_with_etag(client: TestClient, monkeypatch):
+    import server
+
+    png = _png_file_bytes()
+    form = {"format": "webp", "quality": "70", "resize_w": "16", "resize_h": "16"}
+    first = client.post("/convert", files={"image": ("t.png", png, "image/png")}, data=form)
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+
+    async def no_decode(*args, **kwargs):
+        raise AssertionError("cache hit must not run the image job")
+
+    monkeypatch.setattr(server, "_run_image_job", no_decode)
+    second = client.post("/convert", files={"image": ("t.png", png, "image/png")}, data=form)
+    assert second.status_code == 200
+    assert second.headers["etag"] == etag
+    assert second.headers["content-type"] == "image/webp"
+    assert second.content == first.content
+
+    not_modified = client.post("/convert", files={"image": ("t.png", png, "image/png")}, data=form, headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+
+    other = client.post("/convert", files={"image": ("t.png", png, "image/png")}, data={**form, "format": "bmp"})
+    assert other.status_code == 400
+
+
+def test_static_blobs_are_immutable_with_range_and_accel_redirect(client: TestClient, monkeypatch, tmp_path):
+    import server
+    from backend.blob_store import BlobStaticFiles
+
+    png = _png_file_bytes()
+    digest, path, _ = server._blob_store.put(png, ".png")
+    url = f"/static/{path.name}"
+
+    resp = client.get(url)
+    assert resp.status_code == 200
+    assert resp.headers["etag"] == f'"{digest}"'
+    assert "immutable" in resp.headers["cache-control"]
+
+    assert client.get(url, headers={"If-None-Match": f'"{digest}"'}).status_code == 304
+
+    part = client.get(url, headers={"Range": "bytes=0-7"})
+    assert part.status_code == 206
+    assert part.content == png[:8]
+
+    accel = BlobStaticFiles(store=server._blob_store, directory=str(server.IMAGES_DIR), accel_redirect=("/_data/", server.DATA_DIR))
+    mount = next(r for r in server.app.routes if getattr(r, "name", None) == "static")
+    monkeypatch.setattr(mount, "app", accel)
+    resp = client.get(url)
+    assert resp.status_code == 200
+    assert resp.content == b""
+    assert resp.headers["x-accel-redirect"] == "/_data/" + path.relative_to(server.DATA_DIR).as_posix()
+    assert resp.headers["content-type"] == "image/png"
+
+
+def test_static_variants_negotiate_format_and_are_cached(client: TestClient, monkeypatch):
+    import server
+
+    buf = BytesIO()
+    Image.new("RGB", (400, 200), (0, 200, 0)).save(buf, format="PNG")
+    _digest, path, _ = server._blob_store.put(buf.getvalue(), ".png")
+    url = f"/static/{path.name}"
+
+    resp = client.get(url, params={"w": "128"}, headers={"Accept": "image/webp,image/*"})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "image/webp"
+    assert "Accept" in resp.headers["vary"]
+    assert "immutable" in resp.headers["cache-control"]
+    assert Image.open(BytesIO(resp.content)).size == (128, 64)
+
+    async def no_decode(*args, **kwargs):
+        raise AssertionError("cached variant must not be regenerated")
+
+    monkeypatch.setattr(server, "_run_image_job", no_decode)
+    again = client.get(url, params={"w": "128"}, headers={"Accept": "image/webp"})
+    assert again.content == resp.content and again.headers["etag"] == resp.headers["etag"]
+    # arbitrary sizes snap up to the same bucket instead of filling the cache
+    bucketed = client.get(url, params={"w": "100"}, headers={"Accept": "image/webp"})
+    assert bucketed.headers["etag"] == resp.headers["etag"]
+    monkeypatch.undo()
+
+    jpeg = client.get(url, params={"h": "64", "fmt": "jpg"})
+    assert jpeg.headers["content-type"] == "image/jpeg" and "Accept" not in jpeg.headers.get("vary", "")
+    assert Image.open(BytesIO(jpeg.content)).size == (128, 64)
+
+    assert client.get(url, params={"w": "0"}).status_code == 400
+    assert client.get(url, params={"fmt": "gif"}).status_code == 400
+    assert client.get(url).content == buf.getvalue()
+
+
+def test_static_variants_size_formats_pillow_cannot_probe(client: TestClient, monkeypatch):
+    import server
+
+    buf = BytesIO()
+    Image.new("RGB", (400, 200), (0, 200, 0)).save(buf, format="TIFF")
+    _digest, path, _ = server._blob_store.put(buf.getvalue(), ".tiff")
+    resp = client.get(f"/static/{path.name}", params={"w": "128", "fmt": "png"})
+    assert resp.status_code == 200
+    assert Image.open(BytesIO(resp.content)).size == (128, 64)
+
+    _digest, broken, _ = server._blob_store.put(b"\x00\x00\x00\x18ftypheic" + b"\x00" * 64, ".heic")
+    assert client.get(f"/static/{broken.name}", params={"w": "128"}).status_code == 400
+
+
+def test_static_variants_skip_avif_without_an_encoder(client: TestClient, monkeypatch):
+    import server
+
+    buf = BytesIO()
+    Image.new("RGB", (40, 20), (0, 0, 200)).save(buf, format="PNG")
+    _digest, path, _ = server._blob_store.put(buf.getvalue(), ".png")
+    url = f"/static/{path.name}"
+
+    # Pillow builds without AVIF support
+    monkeypatch.delitem(Image.SAVE, "AVIF", raising=False)
+    monkeypatch.setattr(server, "_NEGOTIABLE_VARIANT_FORMATS", ("webp",))
+    resp = client.get(url, params={"w": "20"}, headers={"Accept": "image/avif,image/webp,image/*"})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "image/webp"
+    assert client.get(url, params={"w": "20", "fmt": "avif"}).status_code == 400
+
+
+def test_final_images_get_a_lazy_tile_pyramid(client: TestClient, monkeypatch):
+    import server
+
+    buf = BytesIO()
+    Image.new("RGB", (600, 300), (0, 0, 255)).save(buf, format="PNG")
+    _digest, path, _ = server._blob_store.put(buf.getvalue(), ".png")
+
+    scheduled = []
+    monkeypatch.setattr(server._cpu_pool, "submit", lambda fn, *args: scheduled.append((fn, args)))
+    rec = client.post("/records", files={"image": ("a.png", _png_file_bytes(), "image/png")}, data={"prompt": "x"}).json()
+    server._insert_record_image(record_id=rec["id"], kind="final", image_path=str(path))
+    assert scheduled == [(server._tiles.build, (path.stem, str(path)))]
+
+    info = client.get(f"/tiles/{path.name}/info.json").json()
+    assert info == {"width": 600, "height": 300, "tile_size": 256, "levels": 3, "format": "webp"}
+
+    top = client.get(f"/tiles/{path.name}/0/0_0.webp")
+    assert top.status_code == 200 and top.headers["content-type"] == "image/webp"
+    assert Image.open(BytesIO(top.content)).size == (150, 75)
+    edge = client.get(f"/tiles/{path.name}/2/2_1.webp")
+    assert Image.open(BytesIO(edge.content)).size == (88, 44)
+    assert client.get(f"/tiles/{path.name}/2/3_0.webp").status_code == 404
+    assert client.get(f"/tiles/{path.name}/3/0_0.webp").status_code == 404
+    assert client.get(f"/tiles/{'0' * 64}.png/0/0_0.webp").status_code == 404
+
+
+
+def test_magic_edit_crop_to_mask_sends_crop_and_composites(client: TestClient, monkeypatch):
+    import base64 as _b64
+
+    import server
+
+    original = Image.effect_noise((600, 400), 30).convert("RGB")
+    buf = BytesIO()
+    original.save(buf, format="PNG")
+    mask = Image.new("L", (600, 400), 0)
+    mask.paste(255, (300, 200, 340, 230))
+    mbuf = BytesIO()
+    mask.save(mbuf, format="PNG")
+
+    sent: list = []
+
+    class _Resp:
+        status_code = 200
+
+        def __init__(self, payload):
+            self._payload = payload
+
+        def json(self):
+            return self._payload
+
+    def fake_post(url, json=None, timeout=None, endpoint=None):
+        parts = json["contents"][0]["parts"]
+        sent.append([Image.open(BytesIO(_b64.b64decode(p["inline_data"]["data"]))).size for p in parts[1:]])
+        w, h = sent[-1][0]
+        out = BytesIO()
+        Image.new("RGB", (w, h), (0, 255, 0)).save(out, format="PNG")
+        data = _b64.b64encode(out.getvalue()).decode()
+        return _Resp({"candidates": [{"finishReason": "STOP", "content": {"parts": [{"inline_data": {"mime_type": "image/png", "data": data}}]}}]})
+
+    monkeypatch.setenv("VISION_API_KEY", "k")
+    monkeypatch.setattr(server._http_pool, "post", fake_post)
+    resp = client.post(
+        "/magic_edit",
+        files={"image": ("t.png", buf.getvalue(), "image/png"), "mask": ("m.png", mbuf.getvalue(), "image/png")},
+        data={"prompt": "x", "crop_to_mask": "true", "mask_padding": "8"},
+    )
+    assert resp.status_code == 200, resp.text
+    assert sent == [[(256, 256), (256, 256)]]
+
+    name = resp.json()["urls"][0].rsplit("/static/", 1)[1]
+    result = Image.open(server._blob_store.resolve(name)).convert("RGB")
+    assert result.size == (600, 400)
+    assert all(abs(a - b) <= 2 for a, b in zip(result.getpixel((320, 215)), (0, 255, 0)))
+    assert result.getpixel((10, 10)) == original.getpixel((10, 10))
+    assert result.getpixel((599, 399)) == original.getpixel((599, 399))
+
+
+def test_magic_edit_accepts_rle_mask_spec(client: TestClient, monkeypatch):
+    import base64 as _b64
+    import json as _json
+
+    import server
+
+    buf = BytesIO()
+    Image.new("RGB", (3000, 1500), (10, 20, 30)).save(buf, format="JPEG")
+    # 600x300 canvas with the right half masked, one run per row
+    spec = {"size": [600, 300], "rle": [300] + [300, 300] * 299 + [300]}
+    assert sum(spec["rle"]) == 600 * 300
+
+    sent: list = []
+
+    class _Resp:
+        status_code = 200
+
+        def json(self):
+            out = BytesIO()
+            Image.new("RGB", (8, 8), (0, 255, 0)).save(out, format="PNG")
+            data = _b64.b64encode(out.getvalue()).decode()
+            return {"candidates": [{"finishReason": "STOP", "content": {"parts": [{"inline_data": {"mime_type": "image/png", "data": data}}]}}]}
+
+    def fake_post(url, json=None, timeout=None, endpoint=None):
+        sent.append(json["contents"][0]["parts"][2]["inline_data"]["data"])
+        return _Resp()
+
+    keys: list = []
+    flight_key = server.flight_key
+
+    def recording_flight_key(op, *parts):
+        keys.append((op, parts))
+        return flight_key(op, *parts)
+
+    monkeypatch.setenv("VISION_API_KEY", "secret-key")
+    monkeypatch.setattr(server._http_pool, "post", fake_post)
+    monkeypatch.setattr(server, "flight_key", recording_flight_key)
+    resp = client.post(
+        "/magic_edit",
+        files={"image": ("t.jpg", buf.getvalue(), "image/jpeg")},
+        data={"prompt": "x", "mask_spec": _json.dumps(spec)},
+    )
+    assert resp.status_code == 200, resp.text
+    # coalescing key: digests and parameters only, no base64 payload or API key
+    material = _json.dumps([p for op, p in keys if op == "magic_edit"], default=str)
+    assert "secret-key" not in material and len(material) < 2000
+    mask = Image.open(BytesIO(_b64.b64decode(sent[0])))
+    assert mask.size == (2048, 1024)
+    assert mask.getbbox() == (1024, 0, 2048, 1024)
+
+    bad = client.post(
+        "/magic_edit",
+        files={"image": ("t.jpg", buf.getvalue(), "image/jpeg")},
+        data={"prompt": "x", "mask_spec": '{"size": [2, 2], "rle": [1]}'},
+    )
+    assert bad.status_code == 400
+
+
+def test_analyze_stream_returns_429_when_stream_workers_saturated(client: TestClient, monkeypatch):
+    import threading
+
+    import server
+    from backend.bounded_executor import BoundedExecutor
+
+    workers = BoundedExecutor("sse_test", workers=1, max_queue=0, default_retry_after=3)
+    gate = threading.Event()
+    workers.submit(gate.wait, 5)
+    monkeypatch.setattr(server, "_stream_workers", workers)
+    try:
+        resp = client.post("/analyze_stream", files={"image": ("t.png", _png_file_bytes(), "image/png")}, data={"prompt": "busy"})
+        assert resp.status_code == 429
+        assert resp.headers.get("retry-after") == "3"
+        # the rejected flight is closed, so it is not joined by the next identical request
+        assert server._sse_flights.inflight() == 0
+
+        smart = client.post("/smart/start_stream", files={"image": ("t.png", _png_file_bytes(), "image/png")}, data={"message": "busy"})
+        assert smart.status_code == 429
+        # rejected before anything was stored
+        assert client.get("/records").json()["total"] == 0
+        assert not [p for p in server.BLOBS_DIR.rglob("*") if p.is_file()]
+    finally:
+        gate.set()
+        workers.shutdown()
+
+
+def test_analyze_stream_stops_upstream_after_clients_disconnect(client: TestClient, monkeypatch):
+    import server
+    from backend.metrics import metrics
+
+    closed: list = []
+
+    class _Stream:
+        def __init__(self, chunks):
+            self._chunks = iter(chunks)
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            # simulate every SSE client going away after the first chunk
+            for flight in list(server._sse_flights._flights.values()):
+                flight.cancelled.set()
+            return next(self._chunks)
+
+        def close(self):
+            closed.append(True)
+
+    fake = _fake_stream_client('{"ui_analysis": {"summary_ui": "x"}}')
+    chunks = list(fake.chat.completions.create())
+    fake.chat.completions.create = lambda **_k: _Stream(chunks)
+    monkeypatch.setattr(server._http_pool, "openai_client", lambda *_a, **_k: fake)
+    fallback: list = []
+    monkeypatch.setattr(server, "analyze_image_with_qwen3_vl_plus", lambda *a, **k: fallback.append(a))
+    before = metrics.get("sse.analyze_stream.cancelled")
+    records_before = client.get("/records").json()
+
+    resp = client.post("/analyze_stream", files={"image": ("t.png", _png_file_bytes(), "image/png")}, data={"prompt": "gone", "no_cache": "1"})
+    assert resp.status_code == 200
+    assert '"type": "final"' not in resp.text
+    assert closed == [True] and fallback == []
+    assert metrics.get("sse.analyze_stream.cancelled") - before == 1
+    assert client.get("/records").json() == records_before
+
+
+def test_client_disconnect_while_queued_skips_the_upstream_stream(client: TestClient, monkeypatch):
+    import asyncio
+
+    import httpx
+
+    import server
+    from backend.upstream_scheduler import UpstreamScheduler
+
+    sched = UpstreamScheduler({"dashscope": {"concurrency": {"analysis": 1}}})
+    monkeypatch.setattr(server, "_upstream_scheduler", sched)
+    opened: list = []
+    fake = _fake_stream_client('{"ui_analysis": {"summary_ui": "x"}}')
+    fake.chat.completions.create = lambda **k: opened.append(k) or iter(())
+    monkeypatch.setattr(server._http_pool, "openai_client", lambda *_a, **_k: fake)
+    fallback: list = []
+    monkeypatch.setattr(server, "analyze_image_with_qwen3_vl_plus", lambda *a, **k: fallback.append(a))
+
+    req = httpx.Request("POST", "http://test/analyze_stream", files={"image": ("t.png", _png_file_bytes(), "image/png")}, data={"no_cache": "1"})
+    body = req.read()
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/analyze_stream",
+        "raw_path": b"/analyze_stream",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in req.headers.items()],
+        "client": ("127.0.0.1", 1234),
+        "server": ("test", 80),
+    }
+
+    async def scenario():
+        held = sched.acquire_sync("dashscope", "analysis")  # the worker queues behind this
+        started, gone = asyncio.Event(), asyncio.Event()
+        messages: list = []
+        delivered = False
+
+        async def receive():
+            nonlocal delivered
+            if not delivered:
+                delivered = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await gone.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            messages.append(message)
+            if message["type"] == "http.response.start":
+                started.set()
+
+        task = asyncio.create_task(server.app(scope, receive, send))
+        await asyncio.wait_for(started.wait(), 5)
+        assert messages[0]["status"] == 200
+        gone.set()
+        await asyncio.wait_for(task, 5)
+        flight = next(iter(server._sse_flights._flights.values()))
+        assert flight.cancelled.is_set()
+        held.release()
+        for _ in range(500):
+            if not server._sse_flights.inflight():
+                break
+            await asyncio.sleep(0.01)
+        assert not server._sse_flights.inflight()
+
+    asyncio.run(scenario())
+    assert opened == [] and fallback == []
+
+
+def test_upstream_queue_wait_reported_per_request(client: TestClient, monkeypatch):
+    import server
+    from backend.upstream_scheduler import UpstreamScheduler
+
+    seen: list = []
+
+    def fake_analyze(*_args, **_kwargs):
+        seen.append(server._request_priority.get())
+        return {"ui_analysis": {"professional_analysis": [], "summary_ui": "ok"}}
+
+    monkeypatch.setattr(server, "_upstream_scheduler", UpstreamScheduler())
+    monkeypatch.setattr(server, "analyze_image_with_qwen3_vl_plus", fake_analyze)
+    resp = client.post(
+        "/analyze",
+        files={"image": ("t.png", _png_file_bytes(), "image/png")},
+        data={"prompt": "prio", "no_cache": "1"},
+        headers={"X-Request-Priority": "batch"},
+    )
+    assert resp.status_code == 200
+    assert resp.headers["server-timing"].startswith("upstream-queue;dur=")
+    assert seen == ["batch"]
+    assert server._upstream_scheduler.stats()["dashscope.analysis"]["active"] == 0
+
+
+def test_cancelled_upstream_call_keeps_its_slot_until_it_finishes(client: TestClient, monkeypatch):
+    import asyncio
+    import threading
+
+    import server
+    from backend.upstream_scheduler import UpstreamScheduler
+
+    sched = UpstreamScheduler({"dashscope": {"concurrency": {"analysis": 1}}})
+    monkeypatch.setattr(server, "_upstream_scheduler", sched)
+    started, finish = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        finish.wait(5)
+
+    async def scenario():
+        task = asyncio.create_task(server._run_upstream(slow, upstream=("dashscope", "analysis")))
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        active_after_cancel = sched.stats()["dashscope.analysis"]["active"]
+        finish.set()
+        for _ in range(100):
+            if sched.stats()["dashscope.analysis"]["active"] == 0:
+                break
+            await asyncio.sleep(0.01)
+        return active_after_cancel
+
+    assert asyncio.run(scenario()) == 1
+    assert sched.stats()["dashscope.analysis"]["active"] == 0
+
+
+def test_request_deadline_bounds_upstream_queueing(client: TestClient, monkeypatch):
+    import server
+    from backend.upstream_scheduler import UpstreamScheduler
+
+    sched = UpstreamScheduler({"dashscope": {"concurrency": {"analysis": 1}}})
+    held = sched.acquire_sync("dashscope", "analysis")
+    monkeypatch.setattr(server, "_upstream_scheduler", sched)
+    monkeypatch.setattr(server, "analyze_image_with_qwen3_vl_plus", lambda *a, **k: {})
+    try:
+        resp = client.post(
+            "/analyze",
+            files={"image": ("t.png", _png_file_bytes(), "image/png")},
+            data={"prompt": "deadline", "no_cache": "1"},
+            headers={"X-Request-Timeout": "0.2"},
+        )
+    finally:
+        held.release()
+    assert resp.status_code == 504
+    assert sched.stats()["dashscope.analysis"]["queued"] == {"interactive": 0, "batch": 0}
+
+
+def test_open_circuit_returns_503_with_retry_after(client: TestClient, monkeypatch):
+    import server
+    from backend.resilience import Resilience
+
+    res = Resilience(failure_threshold=1, cooldown=30)
+    res.failure("gemini.generate.m")
+    monkeypatch.setattr(server._http_pool, "resilience", res)
+    monkeypatch.setenv("VISION_API_KEY", "k")
+    with pytest.raises(server.CircuitOpen):
+        server._gemini_generate_content("m", "hi")
+
+    @server.app.get("/_test_circuit")
+    def _boom():
+        server._gemini_generate_content("m", "hi")
+
+    try:
+        resp = client.get("/_test_circuit")
+    finally:
+        server.app.router.routes[:] = [r for r in server.app.router.routes if getattr(r, "path", None) != "/_test_circuit"]
+    assert resp.status_code == 503
+    assert 1 <= int(resp.headers["retry-after"]) <= 30
+
+
+def test_magic_edit_fails_over_from_gemini_to_dashscope(client: TestClient, monkeypatch):
+    import server
+    from backend.provider_router import ProviderRouter
+
+    class _Resp:
+        status_code = 503
+        text = "overloaded"
+
+    models: list = []
+
+    class _FakeMMC:
+        @staticmethod
+        def call(**kwargs):
+            models.append(kwargs["model"])
+            return _dashscope_image_resp()
+
+    def fake_download_and_save_image(_url: str):
+        p = Path(server.IMAGES_DIR) / "failover_out.png"
+        p.write_bytes(_png_file_bytes())
+        return str(p)
+
+    router = ProviderRouter(policy="primary", healthy=server._provider_healthy, retryable=server._failover_retryable)
+    monkeypatch.setattr(server, "_provider_router", router)
+    monkeypatch.setenv("VISION_API_KEY", "k")
+    monkeypatch.setenv("DASHSCOPE_API_KEY", "x")
+    monkeypatch.setenv("IMAGE_EDIT_MODEL", "g-img")
+    monkeypatch.delenv("DASHSCOPE_IMAGE_EDIT_MODEL", raising=False)
+    monkeypatch.setattr(server._http_pool, "post", lambda url, json=None, timeout=None, endpoint=None: _Resp())
+    monkeypatch.setattr(server, "MultiModalConversation", _FakeMMC)
+    monkeypatch.setattr(server, "_download_and_save_image", fake_download_and_save_image)
+
+    resp = client.post("/magic_edit", files={"image": ("t.png", _png_file_bytes(), "image/png")}, data={"prompt": "x"})
+    assert resp.status_code == 200, resp.text
+    assert "/static/" in resp.json()["urls"][0]
+    assert models == ["qwen-image-edit-plus"]
+    stats = router.stats()["image_edit"]
+    assert stats["gemini/g-img"]["error_rate"] == 1.0
+    assert stats["dashscope/qwen-image-edit-plus"]["successes"] == 1
+
+
+def test_provider_health_follows_the_endpoint_each_task_calls(client: TestClient, monkeypatch):
+    import server
+    from backend.resilience import Resilience
+
+    res = Resilience(failure_threshold=1, cooldown=30)
+    monkeypatch.setattr(server, "_resilience", res)
+    res.failure("gemini.generate.g")  # clarify / analysis calls failing
+    assert server._provider_healthy("image_edit", "gemini", "g")
+    assert not server._provider_healthy("image_analysis", "gemini", "g")
+
+    class _Busy:
+        status_code = 503
+
+    server._call_guarded_sdk("dashscope.image.q", lambda **_k: _Busy(), model="q")
+    assert not server._provider_healthy("image_edit", "dashscope", "q")
+    assert server._provider_healthy("image_analysis", "dashscope", "q")
+    with pytest.raises(server.CircuitOpen):
+        server._call_guarded_sdk("dashscope.image.q", lambda **_k: _Busy())
+
+
+def test_smart_start_stream_charges_clarify_to_the_gemini_lane(client: TestClient, monkeypatch):
+    import server
+
+    active = []
+
+    def fake_clarify(*_a, **_k):
+        lanes = server._upstream_scheduler.stats()
+        active.append(sum(v["active"] for k, v in lanes.items() if k.startswith("gemini") and k.endswith(".analysis")))
+        return {}, [], None
+
+    monkeypatch.setattr(server, "analyze_image_with_qwen3_vl_plus", lambda *_a, **_k: {"ui_analysis": {"summary_ui": "done"}})
+    monkeypatch.setitem(sys.modules, "openai", None)
+    monkeypatch.setattr(server, "_get_gemini_api_key", lambda: "k")
+    monkeypatch.setattr(server, "_llm_clarify_next", fake_clarify)
+    monkeypatch.setattr(server, "_route_templates", lambda *_a, **_k: ("photo_retouch", [{"template": "photo_retouch"}]))
+
+    resp = client.post("/smart/start_stream", files={"image": ("t.png", _png_file_bytes(), "image/png")}, data={"message": "x"})
+    assert resp.status_code == 200
+    assert '"type": "session"' in resp.text
+    assert active == [1]
+
+
+def test_smart_start_stream_cancelled_during_insert_frees_its_slot_and_flight(client: TestClient, monkeypatch):
+    import asyncio
+
+    import httpx
+    import server
+
+    def cancelled_insert(*_a, **_k):
+        raise asyncio.CancelledError()
+
+    monkeypatch.setattr(server, "_insert_record", cancelled_insert)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            with pytest.raises(BaseException):
+                await ac.post("/smart/start_stream", files={"image": ("t.png", _png_file_bytes(), "image/png")}, data={"message": "x"})
+        await asyncio.sleep(0.05)
+
+    asyncio.run(scenario())
+    assert server._stream_workers.stats()["running"] == 0
+    assert server._sse_flights.inflight() == 0
@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+
+from backend.bounded_executor import BoundedExecutor, Saturated
+from backend.metrics import metrics
+
+
+def test_rejects_when_workers_and_queue_are_full():
+    ex = BoundedExecutor("t_full", workers=1, max_queue=1, default_retry_after=7)
+    gate = threading.Event()
+    before = metrics.get("executor.t_full.rejected")
+    running = ex.submit(gate.wait, 5)
+    queued = ex.submit(lambda: "queued")
+    with pytest.raises(Saturated) as info:
+        ex.submit(lambda: None)
+    assert info.value.retry_after == 7
+    assert metrics.get("executor.t_full.rejected") - before == 1
+    assert ex.stats()["running"] == 1 and ex.stats()["queued"] == 1
+
+    gate.set()
+    assert running.result(timeout=5) is True
+    assert queued.result(timeout=5) == "queued"
+    assert ex.submit(lambda: 1).result(timeout=5) == 1
+    ex.shutdown()
+
+
+def test_failures_are_counted_and_free_the_slot():
+    ex = BoundedExecutor("t_err", workers=1)
+    before = metrics.get("executor.t_err.errors")
+
+    def boom():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        ex.submit(boom).result(timeout=5)
+    assert metrics.get("executor.t_err.errors") - before == 1
+    assert ex.submit(lambda: 2).result(timeout=5) == 2
+    assert ex.retry_after() >= 1
+    ex.shutdown()
+
+
+def test_reservation_holds_a_slot_until_submitted_or_released():
+    ex = BoundedExecutor("t_res", workers=1)
+    slot = ex.reserve()
+    assert ex.saturated()
+    with pytest.raises(Saturated):
+        ex.reserve()
+    slot.release()
+    slot.release()  # idempotent
+    assert not ex.saturated()
+
+    slot = ex.reserve()
+    assert slot.submit(lambda: 3).result(timeout=5) == 3
+    with pytest.raises(RuntimeError):
+        slot.submit(lambda: 4)
+    assert not ex.saturated()
+    ex.shutdown()
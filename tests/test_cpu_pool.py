@@ -0,0 +1,69 @@
+import asyncio
+import io
+
+import pytest
+from PIL import Image
+
+from backend.cpu_pool import CPUPool
+from backend.image_ops import render_preview
+from backend.metrics import metrics
+
+
+def _png(size=(64, 48)) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", size, (10, 20, 30)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _boom():
+    raise ValueError("boom")
+
+
+def test_thread_jobs_record_latency_and_queue_depth():
+    pool = CPUPool(threads=1, processes=0)
+    before = metrics.get("cpu_pool.render_preview.count")
+
+    async def main():
+        jobs = [asyncio.ensure_future(pool.run(render_preview, _png((400, 300)), "a.png", 100)) for _ in range(3)]
+        await asyncio.sleep(0)
+        snapshot = pool.stats()
+        return await asyncio.gather(*jobs), snapshot
+
+    try:
+        results, snapshot = asyncio.run(main())
+    finally:
+        pool.close()
+    assert snapshot["inflight"]["thread"] == 3 and snapshot["queued"]["thread"] == 2
+    for data, mime in results:
+        assert mime == "image/png"
+        assert Image.open(io.BytesIO(data)).size == (100, 75)
+    assert metrics.get("cpu_pool.render_preview.count") - before == 3
+    assert metrics.get("cpu_pool.render_preview.queue_seconds") > 0
+    assert pool.stats()["inflight"]["thread"] == 0
+
+
+def test_errors_propagate_and_are_counted():
+    pool = CPUPool(threads=1)
+    before = metrics.get("cpu_pool._boom.errors")
+    try:
+        with pytest.raises(ValueError):
+            asyncio.run(pool.run(_boom))
+    finally:
+        pool.close()
+    assert metrics.get("cpu_pool._boom.errors") - before == 1
+
+
+def test_process_jobs_round_trip_bytes():
+    pool = CPUPool(threads=1, processes=1)
+    before = metrics.get("decode.png.count")
+    errors_before = metrics.get("decode.unknown.errors")
+    try:
+        data, mime = asyncio.run(pool.run(render_preview, _png(), "a.png", 32, process=True))
+        with pytest.raises(Exception):
+            asyncio.run(pool.run(render_preview, b"not an image", "a.bin", 32, process=True))
+    finally:
+        pool.close()
+    assert Image.open(io.BytesIO(data)).size == (32, 24)
+    # decode counters recorded in the worker process reach the parent
+    assert metrics.get("decode.png.count") - before == 1
+    assert metrics.get("decode.unknown.errors") - errors_before == 1
@@ -0,0 +1,61 @@
+import sqlite3
+import threading
+
+import pytest
+
+from backend.db import Database
+
+
+@pytest.fixture()
+def db(tmp_path):
+    d = Database(tmp_path / "t.db")
+    d.write(lambda conn: conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY AUTOINCREMENT, v TEXT UNIQUE)"))
+    yield d
+    d.close()
+
+
+def test_wal_and_pragmas(db):
+    conn = db.reader()
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal"
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+
+
+def test_concurrent_writes_are_batched_and_visible(db):
+    def insert(conn, v):
+        return conn.execute("INSERT INTO t (v) VALUES (?)", (v,)).lastrowid
+
+    ids: list = []
+    lock = threading.Lock()
+
+    def worker(n):
+        for i in range(50):
+            rid = db.write(insert, f"{n}-{i}")
+            with lock:
+                ids.append(rid)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(ids)) == 400
+    assert db.reader().execute("SELECT COUNT(*) FROM t").fetchone()[0] == 400
+
+
+def test_failed_job_does_not_roll_back_its_batch(db):
+    db.execute("INSERT INTO t (v) VALUES ('dup')")
+    futs = [db.submit(lambda c: c.execute("INSERT INTO t (v) VALUES ('a')")), db.submit(lambda c: c.execute("INSERT INTO t (v) VALUES ('dup')"))]
+    futs.append(db.submit(lambda c: c.execute("INSERT INTO t (v) VALUES ('b')")))
+    futs[0].result()
+    futs[2].result()
+    with pytest.raises(sqlite3.IntegrityError):
+        futs[1].result()
+    rows = {r[0] for r in db.reader().execute("SELECT v FROM t")}
+    assert rows == {"dup", "a", "b"}
+
+
+def test_writes_after_close_start_a_new_writer(db):
+    db.execute("INSERT INTO t (v) VALUES (?)", ("a",))
+    db.close()
+    db.execute("INSERT INTO t (v) VALUES (?)", ("b",))
+    assert [r[0] for r in db.reader().execute("SELECT v FROM t ORDER BY id")] == ["a", "b"]
@@ -0,0 +1,35 @@
+import os
+
+from backend.derivative_cache import DerivativeCache, derivative_key
+
+
+def test_key_depends_on_normalized_params():
+    a = derivative_key("abc", "convert", {"format": "png", "quality": 90})
+    b = derivative_key("abc", "convert", {"quality": 90, "format": "png"})
+    assert a == b
+    assert a != derivative_key("abc", "convert", {"format": "png", "quality": 80})
+    assert a != derivative_key("abd", "convert", {"format": "png", "quality": 90})
+
+
+def test_lru_eviction_by_byte_budget(tmp_path):
+    cache = DerivativeCache(tmp_path, max_bytes=250)
+    keys = [derivative_key(str(i), "preview", {}) for i in range(3)]
+    for i, key in enumerate(keys[:2]):
+        path = cache.put(key, ".png", b"x" * 100)
+        os.utime(path, (1000 + i, 1000 + i))
+    assert cache.get(keys[0], ".png") is not None  # refreshes keys[0]
+    cache.put(keys[2], ".png", b"x" * 100)
+    assert cache.get(keys[1], ".png") is None
+    assert cache.get(keys[0], ".png") is not None
+    assert cache.get(keys[2], ".png") is not None
+    assert cache.stats()["size_bytes"] == 200
+
+
+def test_overwriting_a_key_does_not_inflate_the_total(tmp_path):
+    cache = DerivativeCache(tmp_path, max_bytes=1000)
+    key = derivative_key("a", "preview", {})
+    cache.put(key, ".png", b"x" * 100)
+    for _ in range(5):
+        cache.put(key, ".png", b"x" * 150)
+    assert cache.stats()["size_bytes"] == 150
+    assert cache._scan_total() == 150
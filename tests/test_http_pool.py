@@ -0,0 +1,52 @@
+import pytest
+
+from backend.http_pool import UpstreamHTTPPool
+
+
+def test_pool_reuses_one_client_per_origin(monkeypatch):
+    monkeypatch.setenv("UPSTREAM_POOL_MAX_ORIGINS", "2")
+    pool = UpstreamHTTPPool()
+    a = pool.client("https://generativelanguage.googleapis.com/v1beta/models/x:generateContent")
+    b = pool.client("https://generativelanguage.googleapis.com/v1beta/other")
+    c = pool.client("https://dashscope.aliyuncs.com/compatible-mode/v1")
+    assert a is b
+    assert a is not c
+    assert pool.stats()["origins"] == ["https://dashscope.aliyuncs.com", "https://generativelanguage.googleapis.com"]
+
+    pool.client("https://example.invalid/img.png")
+    assert a.is_closed
+    assert len(pool.stats()["origins"]) == 2
+
+    pool.close()
+    assert c.is_closed
+    assert pool.stats()["origins"] == []
+
+
+def test_pinned_origins_survive_and_busy_clients_drain_before_closing(monkeypatch):
+    monkeypatch.setenv("UPSTREAM_POOL_MAX_ORIGINS", "2")
+    pool = UpstreamHTTPPool()
+    pool.pin(["https://generativelanguage.googleapis.com/v1beta"])
+    provider = pool.client("https://generativelanguage.googleapis.com/v1beta/models/x")
+    a = pool.client("https://a.invalid/1.png")
+    b = pool.client("https://b.invalid/1.png")
+    with pool._checkout("https://b.invalid/2.png") as busy:
+        assert busy is b
+        pool.client("https://a.invalid/2.png")  # a is now the most recently used
+        pool.client("https://c.invalid/1.png")  # evicts b (LRU), which still has a request in flight
+        assert not b.is_closed
+        assert "https://b.invalid" not in pool.stats()["origins"]
+    assert b.is_closed
+    assert not a.is_closed
+    assert not provider.is_closed
+
+    for host in ("d", "e", "f"):
+        pool.client(f"https://{host}.invalid/x")
+    assert a.is_closed
+    assert not provider.is_closed
+    pool.close()
+
+
+def test_pool_rejects_non_http_urls():
+    pool = UpstreamHTTPPool()
+    with pytest.raises(ValueError):
+        pool.client("file:///etc/passwd")
@@ -0,0 +1,152 @@
+import io
+
+import pytest
+from PIL import Image
+
+from backend import image_decode
+from backend.image_decode import UnsupportedImage, decode_image, sniff_format
+
+
+def _encode(fmt: str) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (8, 8), (0, 128, 255)).save(buf, format=fmt)
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize(
+    "data,name,expected",
+    [
+        (b"\xff\xd8\xff\xe0" + b"\0" * 16, "x.bin", "jpeg"),
+        (b"\x89PNG\r\n\x1a\n" + b"\0" * 16, "", "png"),
+        (b"RIFF\0\0\0\0WEBPVP8 ", "", "webp"),
+        (b"\0\0\0\x18ftypheic\0\0\0\0mif1heic", "", "heif"),
+        (b"\0\0\0\x1cftypavif\0\0\0\0", "", "avif"),
+        (b"\0\0\0\x18ftypcrx \0\0\0\0", "", "raw"),
+        (b"II*\x00\x10\0\0\0CR\x02\0", "", "raw"),
+        (b"II*\x00\x08\0\0\0\0\0", "photo.NEF", "raw"),
+        (b"II*\x00\x08\0\0\0\0\0", "scan.tif", "tiff"),
+        (b"IIU\x00\x18\0\0\0", "", "raw"),
+        (b"FUJIFILMCCD-RAW 0201", "", "raw"),
+        (b"hello world", "", "unknown"),
+    ],
+)
+def test_sniff_format(data, name, expected):
+    assert sniff_format(data, name) == expected
+
+
+def test_jpeg_goes_straight_to_pil(monkeypatch):
+    tried = []
+    monkeypatch.setitem(image_decode.DECODERS, "heif", lambda d, box=None: tried.append("heif"))
+    monkeypatch.setitem(image_decode.DECODERS, "raw", lambda d, box=None: tried.append("raw"))
+    img = decode_image(_encode("JPEG"), "a.jpg")
+    assert img.size == (8, 8) and img.mode == "RGB"
+    assert tried == []
+
+
+def test_unknown_payload_raises():
+    with pytest.raises(UnsupportedImage):
+        decode_image(b"not an image at all", "x.bin")
+
+
+def _big_jpeg(size=(1600, 1200)) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", size, (200, 40, 40)).save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+
+def test_decode_at_target_uses_jpeg_draft(monkeypatch):
+    from PIL import JpegImagePlugin
+
+    drafted = []
+    orig = JpegImagePlugin.JpegImageFile.draft
+
+    def spy(self, mode, size):
+        res = orig(self, mode, size)
+        drafted.append(self.size)
+        return res
+
+    monkeypatch.setattr(JpegImagePlugin.JpegImageFile, "draft", spy)
+    img = decode_image(_big_jpeg(), "big.jpg", max_side=300)
+    assert img.size == (300, 225)
+    # DCT scaled to 1/4 (400x300), not decoded at 1600x1200
+    assert drafted == [(400, 300)]
+
+
+def test_decode_to_exact_size_and_no_upscale():
+    img = decode_image(_big_jpeg(), "big.jpg", size=(120, 80))
+    assert img.size == (120, 80)
+    small = decode_image(_encode("PNG"), "s.png", max_side=1024)
+    assert small.size == (8, 8)
+
+
+def test_resize_to_reduces_integer_factor_first(monkeypatch):
+    calls = []
+    orig = Image.Image.reduce
+    monkeypatch.setattr(Image.Image, "reduce", lambda self, f, *a, **k: calls.append(f) or orig(self, f, *a, **k))
+    img = image_decode.resize_to(Image.new("RGB", (1000, 500)), (300, 150))
+    assert img.size == (300, 150)
+    assert calls == [3]
+
+
+def test_raw_preview_prefers_embedded_thumbnail(monkeypatch):
+    calls = []
+
+    def thumb(data, box=None):
+        calls.append(("raw_thumb", box))
+        return Image.new("RGB", (1616, 1080))
+
+    def full(data, box=None):
+        calls.append(("raw", box))
+        return Image.new("RGB", (6000, 4000))
+
+    monkeypatch.setitem(image_decode.DECODERS, "raw_thumb", thumb)
+    monkeypatch.setitem(image_decode.DECODERS, "raw", full)
+    payload = b"II*\x00\x08\0\0\0\0\0"
+
+    img = decode_image(payload, "a.nef", max_side=1600, preview=True)
+    assert img.size == (1600, 1069)
+    assert calls == [("raw_thumb", (1600, 1600))]
+
+    calls.clear()
+    decode_image(payload, "a.nef", max_side=2048)
+    assert [c[0] for c in calls] == ["raw"]
+
+
+def test_raw_preview_falls_back_when_thumbnail_missing(monkeypatch):
+    def no_thumb(data, box=None):
+        raise UnsupportedImage("embedded thumbnail too small")
+
+    monkeypatch.setitem(image_decode.DECODERS, "raw_thumb", no_thumb)
+    monkeypatch.setitem(image_decode.DECODERS, "raw", lambda d, box=None: Image.new("RGB", (3000, 2000)))
+    img = decode_image(b"II*\x00\x08\0\0\0\0\0", "a.dng", max_side=1600, preview=True)
+    assert img.size == (1600, 1066)
+
+
+def test_raw_half_size_fits_against_the_sensor_size(monkeypatch):
+    import sys
+    import types
+
+    import numpy as np
+
+    halves = []
+
+    class _Raw:
+        sizes = types.SimpleNamespace(width=6000, height=4000)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def postprocess(self, half_size=False, **_kwargs):
+            halves.append(half_size)
+            return np.zeros((2000, 3000, 3), dtype=np.uint8) if half_size else np.zeros((4000, 6000, 3), dtype=np.uint8)
+
+    monkeypatch.setitem(sys.modules, "rawpy", types.SimpleNamespace(imread=lambda _f: _Raw()))
+    img = decode_image(b"II*\x00\x08\0\0\0\0\0", "a.nef", max_side=2048)
+    assert halves == [True]
+    assert img.size == (2048, 1365)
+    # an exact target larger than the half-size decode still demosaics in full
+    decode_image(b"II*\x00\x08\0\0\0\0\0", "a.nef", size=(3600, 2400))
+    assert halves == [True, False]
@@ -0,0 +1,108 @@
+import io
+import json
+
+import pytest
+from PIL import Image, ImageDraw
+
+from backend.image_ops import InvalidMaskSpec, composite_mask_crop, mask_bbox, pad_box, prepare_mask_crop, rasterize_mask_spec, render_mask_spec
+
+
+def _png(img) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _mask(size, box):
+    m = Image.new("L", size, 0)
+    ImageDraw.Draw(m).rectangle([box[0], box[1], box[2] - 1, box[3] - 1], fill=255)
+    return m
+
+
+def test_mask_bbox():
+    assert mask_bbox(_mask((100, 80), (10, 20, 30, 25))) == (10, 20, 30, 25)
+    assert mask_bbox(Image.new("L", (10, 10), 100)) is None
+
+
+def test_pad_box_clamps_and_enforces_min_side():
+    assert pad_box((10, 10, 20, 20), (100, 100), 5) == (5, 5, 25, 25)
+    assert pad_box((0, 0, 10, 10), (100, 100), 5, min_side=40) == (0, 0, 40, 40)
+    assert pad_box((90, 40, 100, 50), (100, 100), 0, min_side=30) == (70, 30, 100, 60)
+    assert pad_box((0, 0, 10, 10), (20, 20), 0, min_side=50) == (0, 0, 20, 20)
+
+
+def test_crop_and_composite_keep_untouched_pixels_exact():
+    original = Image.effect_noise((800, 600), 40).convert("RGB")
+    model_size = (400, 300)
+    model_input = _png(original.resize(model_size))
+    mask = _png(_mask(model_size, (100, 100, 150, 140)))
+
+    crop = prepare_mask_crop(model_input, "in.png", mask, padding=16, min_side=0)
+    assert crop is not None
+    crop_img, crop_mask, box = crop
+    assert box == (84, 84, 166, 156)
+    assert Image.open(io.BytesIO(crop_img)).size == (82, 72)
+
+    edit = _png(Image.new("RGB", (82, 72), (255, 0, 0)))
+    out, mime = composite_mask_crop(_png(original), "in.png", edit, crop_mask, box, model_size, feather=2)
+    assert mime == "image/png"
+    result = Image.open(io.BytesIO(out)).convert("RGB")
+    assert result.size == original.size
+    assert result.getpixel((250, 240)) == (255, 0, 0)
+    for xy in [(0, 0), (799, 599), (150, 150), (340, 320)]:
+        assert result.getpixel(xy) == original.getpixel(xy)
+
+
+def test_crop_skipped_for_empty_or_large_masks():
+    size = (200, 100)
+    img = _png(Image.new("RGB", size))
+    assert prepare_mask_crop(img, "a.png", _png(Image.new("L", size, 0))) is None
+    assert prepare_mask_crop(img, "a.png", _png(_mask(size, (0, 0, 190, 90)))) is None
+
+
+def _rle(mask):
+    counts, on, run = [], False, 0
+    for v in mask.tobytes():
+        if (v > 0) != on:
+            counts.append(run)
+            on, run = v > 0, 0
+        run += 1
+    return counts + [run]
+
+
+def test_rle_mask_rasterized_at_target_size():
+    src = _mask((400, 200), (100, 50, 300, 150))
+    out = rasterize_mask_spec({"size": [400, 200], "rle": _rle(src)}, (200, 100))
+    assert out.size == (200, 100)
+    assert out.getbbox() == (50, 25, 150, 75)
+    assert out.getpixel((100, 50)) == 255 and out.getpixel((10, 10)) == 0
+
+
+def test_strokes_scaled_and_unioned_with_rle():
+    spec = {
+        "size": [1000, 500],
+        "rle": _rle(_mask((1000, 500), (0, 0, 100, 100))),
+        "strokes": [{"points": [500, 250, 800, 250], "width": 40}],
+    }
+    out = Image.open(io.BytesIO(render_mask_spec(json.dumps(spec).encode(), "mask.json", (500, 250))))
+    assert out.size == (500, 250) and out.mode == "L"
+    assert out.getpixel((20, 20)) == 255
+    assert out.getpixel((325, 125)) == 255  # stroke midpoint, scaled by 0.5
+    assert out.getpixel((325, 140)) == 0  # outside the 20px scaled width
+    assert out.getpixel((200, 200)) == 0
+
+
+@pytest.mark.parametrize(
+    "spec",
+    [
+        b"not json",
+        b"[]",
+        b'{"rle": [1]}',
+        b'{"size": [2, 2], "rle": [1, 2]}',
+        b'{"size": [2, 2], "strokes": [{"width": 3}]}',
+        b'{"size": [50000, 50000], "rle": [2500000000]}',
+    ],
+)
+def test_invalid_mask_spec(spec):
+    with pytest.raises(InvalidMaskSpec):
+        render_mask_spec(spec, "mask.json", (4, 4))
@@ -0,0 +1,59 @@
+import sqlite3
+
+from backend.db import Database
+from backend.migrations import SCHEMA_VERSION, migrate
+
+
+def _legacy_db(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE records (id INTEGER PRIMARY KEY AUTOINCREMENT, prompt TEXT NOT NULL, thinking TEXT,
+            image_path TEXT NOT NULL, logs TEXT, created_at TEXT NOT NULL);
+        CREATE TABLE record_images (id INTEGER PRIMARY KEY AUTOINCREMENT, record_id INTEGER NOT NULL, kind TEXT NOT NULL,
+            image_path TEXT NOT NULL, created_at TEXT NOT NULL);
+        CREATE TABLE smart_sessions (id INTEGER PRIMARY KEY AUTOINCREMENT, image_path TEXT NOT NULL, original_name TEXT,
+            spec_json TEXT NOT NULL, facts_json TEXT, template_selected TEXT, template_candidates_json TEXT,
+            status TEXT NOT NULL, record_id INTEGER, created_at TEXT NOT NULL, updated_at TEXT NOT NULL);
+        CREATE TABLE smart_session_messages (id INTEGER PRIMARY KEY AUTOINCREMENT, session_id INTEGER NOT NULL,
+            role TEXT NOT NULL, content TEXT NOT NULL, created_at TEXT NOT NULL);
+        INSERT INTO records (id, prompt, image_path, created_at) VALUES (1, 'p', 'a.png', '2024-01-01');
+        INSERT INTO record_images (record_id, kind, image_path, created_at) VALUES (1, 'input', 'a.png', '2024-01-01');
+        INSERT INTO record_images (record_id, kind, image_path, created_at) VALUES (99, 'input', 'orphan.png', '2024-01-01');
+        INSERT INTO smart_sessions (id, image_path, spec_json, status, record_id, created_at, updated_at)
+            VALUES (1, 'a.png', '{}', 'ready', 42, '2024-01-01', '2024-01-01');
+        INSERT INTO smart_session_messages (session_id, role, content, created_at) VALUES (1, 'user', 'hi', '2024-01-01');
+        INSERT INTO smart_session_messages (session_id, role, content, created_at) VALUES (7, 'user', 'orphan', '2024-01-01');
+        """
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_migrates_legacy_database_once(tmp_path):
+    path = tmp_path / "app.db"
+    _legacy_db(path)
+    db = Database(path)
+    try:
+        assert db.write(migrate) == (0, SCHEMA_VERSION)
+        assert db.write(migrate) == (SCHEMA_VERSION, SCHEMA_VERSION)
+
+        conn = db.reader()
+        cols = {r[1] for r in conn.execute("PRAGMA table_info(records)")}
+        assert {"original_name", "raw_response"} <= cols
+        assert [r[0] for r in conn.execute("SELECT image_path FROM record_images")] == ["a.png"]
+        assert [r[0] for r in conn.execute("SELECT content FROM smart_session_messages")] == ["hi"]
+        # orphans are kept aside, not silently deleted
+        assert [r[0] for r in conn.execute("SELECT image_path FROM record_images_orphaned")] == ["orphan.png"]
+        assert [r[0] for r in conn.execute("SELECT content FROM smart_session_messages_orphaned")] == ["orphan"]
+        assert conn.execute("SELECT record_id FROM smart_sessions").fetchone()[0] is None
+
+        plan = " ".join(r[-1] for r in conn.execute("EXPLAIN QUERY PLAN SELECT id, record_id, kind, image_path, created_at FROM record_images WHERE record_id = 1 ORDER BY created_at"))
+        assert "COVERING INDEX idx_record_images_record" in plan
+        plan = " ".join(r[-1] for r in conn.execute("EXPLAIN QUERY PLAN SELECT * FROM records ORDER BY created_at DESC LIMIT 10"))
+        assert "idx_records_created_at" in plan and "TEMP B-TREE" not in plan
+
+        db.execute("DELETE FROM records WHERE id = 1")
+        assert conn.execute("SELECT COUNT(*) FROM record_images").fetchone()[0] == 0
+    finally:
+        db.close()
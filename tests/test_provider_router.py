@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from backend.metrics import metrics
+from backend.provider_router import ProviderRouter
+
+A = ("gemini", "g")
+B = ("dashscope", "q")
+
+
+def _feed(router, backend, seconds, n=5, ok=True):
+    for _ in range(n):
+        router.record("edit", backend[0], backend[1], seconds, ok)
+
+
+def test_unmeasured_backends_keep_configured_order():
+    router = ProviderRouter(min_samples=3)
+    assert router.rank("edit", [A, B]) == [A, B]
+    assert router.rank("edit", [B, A]) == [B, A]
+
+
+def test_fastest_prefers_lower_p50_and_tail_prefers_lower_p95():
+    fastest = ProviderRouter(policy="fastest", min_samples=3)
+    tail = ProviderRouter(policy="tail", min_samples=3)
+    for router in (fastest, tail):
+        # A: quick median but a slow tail; B: steady
+        _feed(router, A, 1.0, n=9)
+        _feed(router, A, 30.0, n=1)
+        _feed(router, B, 3.0, n=10)
+    assert fastest.rank("edit", [A, B]) == [A, B]
+    assert tail.rank("edit", [A, B]) == [B, A]
+
+    primary = ProviderRouter(policy="primary", min_samples=3)
+    _feed(primary, A, 9.0)
+    _feed(primary, B, 1.0)
+    assert primary.rank("edit", [A, B]) == [A, B]
+
+
+def test_failing_or_open_circuit_backends_go_last():
+    router = ProviderRouter(min_samples=3, max_error_rate=0.5)
+    _feed(router, A, 1.0, n=4, ok=False)
+    _feed(router, B, 5.0)
+    assert router.rank("edit", [A, B]) == [B, A]
+    assert router.stats()["edit"]["gemini/g"]["error_rate"] == 1.0
+
+    gated = ProviderRouter(healthy=lambda task, provider, _model: not (task == "edit" and provider == "gemini"))
+    assert gated.rank("edit", [A, B]) == [B, A]
+    assert gated.rank("analysis", [A, B]) == [A, B]
+
+
+def test_run_fails_over_and_records_outcomes():
+    router = ProviderRouter()
+    before = metrics.get("router.edit.failovers")
+    calls = []
+
+    def call(provider, model):
+        calls.append(provider)
+        if provider == "gemini":
+            raise RuntimeError("503")
+        return model
+
+    assert router.run("edit", [A, B], call) == "q"
+    assert calls == ["gemini", "dashscope"]
+    assert metrics.get("router.edit.failovers") == before + 1
+    stats = router.stats()["edit"]
+    assert stats["gemini/g"]["error_rate"] == 1.0
+    assert stats["dashscope/q"]["successes"] == 1
+
+
+def test_non_retryable_errors_are_raised_without_failover():
+    router = ProviderRouter(retryable=lambda exc: not isinstance(exc, ValueError))
+    calls = []
+
+    async def call(provider, _model):
+        calls.append(provider)
+        raise ValueError("blocked by safety filter")
+
+    with pytest.raises(ValueError):
+        asyncio.run(router.arun("edit", [A, B], call))
+    assert calls == ["gemini"]
+    # a rejected request says nothing about the backend's health
+    assert router.stats()["edit"]["gemini/g"]["error_rate"] == 0.0
+
+
+def test_last_error_is_raised_when_every_backend_fails():
+    router = ProviderRouter()
+
+    def call(provider, _model):
+        raise RuntimeError(provider)
+
+    with pytest.raises(RuntimeError, match="dashscope"):
+        router.run("edit", [A, B], call)
+    with pytest.raises(LookupError):
+        router.run("edit", [], call)
@@ -0,0 +1,110 @@
+import time
+
+import httpx
+import pytest
+
+from backend.http_pool import UpstreamHTTPPool
+from backend.resilience import CircuitOpen, DeadlineExceeded, Resilience, request_deadline
+
+
+def test_breaker_opens_then_half_open_probe_closes_it():
+    r = Resilience(failure_threshold=2, cooldown=0.05)
+    for _ in range(2):
+        r.guard("ep", 60)
+        r.failure("ep")
+    with pytest.raises(CircuitOpen) as info:
+        r.guard("ep", 60)
+    assert info.value.retry_after >= 1
+
+    time.sleep(0.06)
+    r.guard("ep", 60)  # the single half-open probe
+    with pytest.raises(CircuitOpen):
+        r.guard("ep", 60)
+    r.success("ep", 0.5)
+    assert r.stats()["ep"]["state"] == "closed"
+    r.guard("ep", 60)
+
+
+def test_failed_probe_reopens():
+    r = Resilience(failure_threshold=1, cooldown=0.01)
+    r.failure("ep")
+    time.sleep(0.02)
+    r.guard("ep", 60)
+    r.failure("ep")
+    with pytest.raises(CircuitOpen):
+        r.guard("ep", 60)
+
+
+def test_timeout_follows_latency_percentile_and_deadline():
+    r = Resilience(min_timeout=1, multiplier=2, min_samples=10)
+    assert r.guard("ep", 90) == 90  # not enough samples yet
+    for _ in range(10):
+        r.success("ep", 3.0)
+    assert r.guard("ep", 90) == pytest.approx(6.0)
+    assert r.guard("ep", 4) == 4  # the caller's timeout stays a ceiling
+
+    token = request_deadline.set(time.monotonic() + 2.5)
+    try:
+        assert r.guard("ep", 90) == pytest.approx(2.5, abs=0.1)
+    finally:
+        request_deadline.reset(token)
+    token = request_deadline.set(time.monotonic() + 0.5)
+    try:
+        with pytest.raises(DeadlineExceeded):
+            r.guard("ep", 90)
+    finally:
+        request_deadline.reset(token)
+
+
+def test_pool_counts_5xx_and_transport_errors_as_failures(monkeypatch):
+    statuses = iter([503, 200])
+
+    def handler(request):
+        if request.url.path == "/down":
+            raise httpx.ConnectError("refused")
+        return httpx.Response(next(statuses))
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    r = Resilience(failure_threshold=2, cooldown=60)
+    pool = UpstreamHTTPPool(resilience=r)
+    monkeypatch.setattr(pool, "client", lambda url: client)
+
+    assert pool.post("https://x.test/ok", endpoint="x", timeout=10).status_code == 503
+    assert pool.post("https://x.test/ok", endpoint="x", timeout=10).status_code == 200
+    assert r.stats()["x"] == {"state": "closed", "failures": 0, "samples": 1, "timeout": None}
+    for _ in range(2):
+        with pytest.raises(httpx.ConnectError):
+            pool.get("https://x.test/down", endpoint="x", timeout=10)
+    with pytest.raises(CircuitOpen):
+        pool.get("https://x.test/ok", endpoint="x", timeout=10)
+    # unnamed requests bypass the breaker
+    monkeypatch.setattr(pool, "client", lambda url: httpx.Client(transport=httpx.MockTransport(lambda req: httpx.Response(204))))
+    assert pool.get("https://x.test/ok").status_code == 204
+
+
+def test_stream_keeps_the_ceiling_as_its_read_timeout(monkeypatch):
+    seen = []
+
+    def handler(request):
+        seen.append(request.extensions["timeout"])
+        return httpx.Response(200, content=b"data: x\n\n")
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    r = Resilience(min_samples=3, min_timeout=1)
+    pool = UpstreamHTTPPool(resilience=r)
+    monkeypatch.setattr(pool, "client", lambda url: client)
+    for _ in range(3):
+        r.success("s", 0.1)
+
+    with pool.stream("POST", "https://x.test/s", endpoint="s", timeout=180) as resp:
+        assert list(resp.iter_lines()) == ["data: x", ""]
+    assert seen[-1]["connect"] == 1.0
+    assert seen[-1]["read"] == 180.0
+
+    token = request_deadline.set(time.monotonic() + 30)
+    try:
+        with pool.stream("POST", "https://x.test/s", endpoint="s", timeout=180):
+            pass
+    finally:
+        request_deadline.reset(token)
+    assert 1.0 <= seen[-1]["read"] <= 30.0
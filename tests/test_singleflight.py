@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+from backend.metrics import metrics
+from backend.singleflight import EventFanout, FanoutRegistry, SingleFlight, StreamCost, flight_key
+
+
+def test_flight_key_is_stable_and_param_sensitive():
+    assert flight_key("op", {"a": 1, "b": 2}) == flight_key("op", {"b": 2, "a": 1})
+    assert flight_key("op", {"a": 1}) != flight_key("op", {"a": 2})
+    assert flight_key("op", 1).startswith("op:")
+
+
+def test_singleflight_shares_result_and_errors():
+    sf = SingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"ok": True}
+
+    async def boom():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+
+    async def scenario():
+        results = await asyncio.gather(*[sf.do("k", work) for _ in range(4)])
+        errors = await asyncio.gather(*[sf.do("e", boom) for _ in range(2)], return_exceptions=True)
+        again = await sf.do("k", work)
+        return results, errors, again
+
+    results, errors, again = asyncio.run(scenario())
+    assert results == [{"ok": True}] * 4
+    assert all(isinstance(e, ValueError) for e in errors)
+    assert again == {"ok": True}
+    assert len(calls) == 2
+    assert sf.inflight() == 0
+
+
+def test_fanout_replays_history_to_late_subscribers():
+    async def scenario():
+        fan = EventFanout(asyncio.get_running_loop())
+
+        async def collect():
+            return [e async for e in fan.subscribe()]
+
+        early = asyncio.ensure_future(collect())
+        await asyncio.sleep(0)
+        fan.publish({"n": 1})
+        await asyncio.sleep(0.01)
+        late = asyncio.ensure_future(collect())
+        fan.publish({"n": 2})
+        fan.close()
+        done = await asyncio.gather(early, late)
+        after = [e async for e in fan.subscribe()]
+        return done, after
+
+    (early, late), after = asyncio.run(scenario())
+    assert early == late == after == [{"n": 1}, {"n": 2}]
+
+
+@pytest.mark.parametrize("n", [0, 3])
+def test_fanout_close_without_subscribers(n):
+    async def scenario():
+        fan = EventFanout(asyncio.get_running_loop())
+        for i in range(n):
+            fan.publish({"i": i})
+        fan.close()
+        await asyncio.sleep(0)
+        return fan.closed, [e async for e in fan.subscribe()]
+
+    closed, events = asyncio.run(scenario())
+    assert closed and len(events) == n
+
+
+def test_fanout_cancelled_when_last_subscriber_leaves():
+    async def scenario():
+        reg = FanoutRegistry()
+        fan = reg.start("op:k")
+        first, second = fan.subscribe(), fan.subscribe()
+        fan.publish({"n": 1})
+        assert await first.__anext__() == {"n": 1}
+        assert await second.__anext__() == {"n": 1}
+        await first.aclose()
+        partial = fan.cancelled.is_set()
+        await second.aclose()
+        return partial, fan.cancelled.is_set(), reg.join("op:k")
+
+    partial, cancelled, joined = asyncio.run(scenario())
+    assert not partial and cancelled
+    assert joined is None  # a cancelled stream is not joined by new requests
+
+
+def test_stream_cost_prices_cancelled_streams():
+    cost = StreamCost()
+    names = ["sse.t_op.cancelled", "sse.t_op.seconds_saved", "sse.t_op.tokens_saved", "sse.t_op.fallbacks_skipped"]
+    before = [metrics.get(n) for n in names]
+    cost.cancelled("t_op", 1.0, 3)  # no completed stream yet: counted, not priced
+    cost.completed("t_op", 10.0, 200)
+    cost.cancelled("t_op", 4.0, 50, fallback_skipped=True)
+    delta = [metrics.get(n) - b for n, b in zip(names, before)]
+    assert delta == [2, pytest.approx(6.0), 150, 1]
@@ -0,0 +1,40 @@
+import json
+
+from backend.stream_json import AnalysisStreamParser
+
+
+def _analysis_doc():
+    return {
+        "ui_analysis": {
+            "photo_basic_info": {"photo_type": "人像 {\"quoted\"}", "face_count": "1"},
+            "photo_quality_analysis": {"light_issue": "偏暗 ]", "color_issue": ""},
+            "professional_analysis": [
+                {"id": str(i), "problem": f"p{{{i}}}", "solution": "s \\ \"q\"", "nested": {"a": [1, {"b": "}"}]}}
+                for i in range(20)
+            ],
+            "summary_ui": "总结 \"ok\"",
+        }
+    }
+
+
+def test_parser_emits_each_item_once_across_arbitrary_chunking():
+    doc = _analysis_doc()
+    text = "```json\n" + json.dumps(doc, ensure_ascii=False) + "\n```"
+    for size in (1, 2, 3, 7, 64, len(text)):
+        parser = AnalysisStreamParser()
+        events = []
+        for i in range(0, len(text), size):
+            events.extend(parser.feed(text[i : i + size]))
+        items = [v for k, v in events if k == "professional_analysis"]
+        sections = {k: v for k, v in events if k != "professional_analysis"}
+        assert items == doc["ui_analysis"]["professional_analysis"]
+        assert sections == {k: doc["ui_analysis"][k] for k in ("photo_basic_info", "photo_quality_analysis", "summary_ui")}
+        assert parser.text() == text
+
+
+def test_parser_reports_sections_before_stream_ends():
+    parser = AnalysisStreamParser()
+    assert parser.feed('{"ui_analysis": {"photo_basic_info": {"photo_type": "风景"') == []
+    assert parser.feed("}, ") == [("photo_basic_info", {"photo_type": "风景"})]
+    assert parser.feed('"professional_analysis": [{"id": "a"}, {"id"') == [("professional_analysis", {"id": "a"})]
+    assert parser.feed(': "b"}') == [("professional_analysis", {"id": "b"})]
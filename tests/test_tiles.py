@@ -0,0 +1,45 @@
+from PIL import Image
+
+from backend.tiles import TilePyramid, level_size, pyramid_levels
+
+
+def test_level_geometry():
+    assert pyramid_levels(200, 100, 256) == 1
+    assert pyramid_levels(600, 300, 256) == 3
+    assert level_size(600, 300, 3, 0) == (150, 75)
+    assert level_size(601, 301, 3, 1) == (301, 151)
+
+
+def test_tile_pyramid_build_renders_all_levels(tmp_path):
+    src = tmp_path / "src.png"
+    Image.new("RGB", (1000, 10), (9, 9, 9)).save(src)
+    tiles = TilePyramid(tmp_path / "tiles", tile_size=256)
+    assert tiles.build("d" * 64, str(src)) == 3
+    assert tiles.build("d" * 64, str(src)) == 0
+    assert Image.open(tiles.tile_path("d" * 64, 2, 3, 0)).size == (232, 10)
+    assert Image.open(tiles.tile_path("d" * 64, 0, 0, 0)).size == (250, 3)
+
+
+def test_tile_cache_evicts_least_recently_used_levels_and_drops_locks(tmp_path):
+    import os
+
+    src = tmp_path / "src.png"
+    Image.new("RGB", (1000, 10), (9, 9, 9)).save(src)
+    tiles = TilePyramid(tmp_path / "tiles", tile_size=256)
+    tiles.build("a" * 64, str(src))
+    tiles.build("b" * 64, str(src))
+    assert tiles._locks == {}
+    full = tiles.stats()["size_bytes"]
+
+    old = tmp_path / "tiles" / ("a" * 64)
+    for marker in old.glob("*/.done"):
+        os.utime(marker, (1, 1))
+    tiles.tile("b" * 64, str(src), 2, 0, 0)  # keeps b's levels recent
+
+    tiles.max_bytes = full // 2 + 1
+    tiles.build("c" * 64, str(src))
+    assert not old.exists()
+    assert tiles.stats()["size_bytes"] <= tiles.max_bytes
+    assert tiles.tile("c" * 64, str(src), 2, 3, 0).is_file()
+    # an evicted level renders again on demand
+    assert tiles.tile("a" * 64, str(src), 1, 0, 0).is_file()
@@ -0,0 +1,107 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from backend.upstream_scheduler import SlotCancelled, TokenBucket, UpstreamScheduler
+
+
+def test_interactive_served_before_batch_within_a_lane():
+    sched = UpstreamScheduler({"p": {"concurrency": {"analysis": 1}}})
+
+    async def scenario():
+        order = []
+        first = await sched.acquire("p", "analysis")
+
+        async def call(name, priority):
+            async with await sched.acquire("p", "analysis", priority=priority) as ticket:
+                order.append((name, ticket.queue_seconds > 0))
+
+        jobs = [asyncio.ensure_future(call("batch", "batch")), asyncio.ensure_future(call("interactive", "interactive"))]
+        await asyncio.sleep(0.01)
+        stats = sched.stats()["p.analysis"]
+        first.release()
+        await asyncio.gather(*jobs)
+        return order, stats
+
+    order, stats = asyncio.run(scenario())
+    assert [name for name, _ in order] == ["interactive", "batch"]
+    assert all(waited for _, waited in order)
+    assert stats["active"] == 1 and stats["queued"] == {"interactive": 1, "batch": 1}
+
+
+def test_lanes_do_not_share_concurrency():
+    sched = UpstreamScheduler({"p": {"concurrency": {"analysis": 1, "generation": 1}}})
+
+    async def scenario():
+        gen = await sched.acquire("p", "generation")
+        ana = await asyncio.wait_for(sched.acquire("p", "analysis"), 1)
+        gen.release()
+        ana.release()
+
+    asyncio.run(scenario())
+
+
+def test_per_model_limits_take_precedence():
+    sched = UpstreamScheduler({"p": {"concurrency": {"generation": 5}}, "p/slow": {"concurrency": {"generation": 1}}})
+    slow = sched.acquire_sync("p", "generation", model="slow")
+    other = sched.acquire_sync("p", "generation", model="fast")
+    stats = sched.stats()
+    assert stats["p/slow.generation"]["active"] == 1 and stats["p.generation"]["active"] == 1
+    slow.release()
+    other.release()
+
+
+def test_rpm_bucket_delays_grants():
+    sched = UpstreamScheduler({"p": {"rpm": 600}})  # burst 600, refills 10/s
+    bucket = sched._lane("p", "analysis").buckets["rpm"]
+    bucket.level = 0.0
+    bucket.stamp = time.monotonic()
+    start = time.monotonic()
+    sched.acquire_sync("p", "analysis").release()
+    assert time.monotonic() - start >= 0.05
+
+
+def test_cancelled_waiter_gives_up_its_place():
+    sched = UpstreamScheduler({"p": {"concurrency": {"analysis": 1}}})
+
+    async def scenario():
+        held = await sched.acquire("p", "analysis")
+        waiter = asyncio.ensure_future(sched.acquire("p", "analysis"))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        held.release()
+        again = await asyncio.wait_for(sched.acquire("p", "analysis"), 1)
+        again.release()
+        return sched.stats()["p.analysis"]
+
+    assert asyncio.run(scenario())["active"] == 0
+
+
+def test_blocking_waiter_leaves_the_queue_on_cancel_or_timeout():
+    sched = UpstreamScheduler({"p": {"concurrency": {"analysis": 1}}})
+    held = sched.acquire_sync("p", "analysis")
+
+    with pytest.raises(TimeoutError):
+        sched.acquire_sync("p", "analysis", timeout=0.05)
+
+    cancel = threading.Event()
+    threading.Timer(0.05, cancel.set).start()
+    with pytest.raises(SlotCancelled):
+        sched.acquire_sync("p", "analysis", cancel=cancel)
+    assert sched.stats()["p.analysis"]["queued"] == {"interactive": 0, "batch": 0}
+
+    held.release()
+    sched.acquire_sync("p", "analysis", cancel=cancel, timeout=1).release()
+    assert sched.stats()["p.analysis"]["active"] == 0
+
+
+def test_token_bucket_delay():
+    bucket = TokenBucket(60)
+    now = bucket.stamp
+    bucket.take(60, now)
+    assert bucket.delay(1, now) == pytest.approx(1.0)
+    assert bucket.delay(1, now + 1.0) == 0.0